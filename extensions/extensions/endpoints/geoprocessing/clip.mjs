@@ -9,6 +9,7 @@ export default async (req, res, next, database, logger) => {
     clip_table: clipTable,
     output_table: outputTable,
     filter = null,
+    additional_config: additionalConfig = null,
   } = req.body;
 
   if (!inputTable) {
@@ -37,6 +38,16 @@ export default async (req, res, next, database, logger) => {
       })
     );
   }
+  if (
+    additionalConfig !== null &&
+    (typeof additionalConfig !== "object" || Array.isArray(additionalConfig))
+  ) {
+    return next(
+      new InvalidPayloadError({
+        reason: "additional_config must be an object",
+      })
+    );
+  }
   if (filter && !Array.isArray(filter)) {
     return next(
       new InvalidPayloadError({
@@ -179,6 +190,7 @@ export default async (req, res, next, database, logger) => {
             output_table: outputTable,
             user_id: accountability.user,
             filter,
+            additional_config: additionalConfig,
           },
           options: {},
           actor_name: "clip",
@@ -9,7 +9,18 @@ export default async (req, res, next, database, logger) => {
     fields,
     output_table: outputTable,
     filter = null,
+    additional_config: additionalConfig = null,
   } = req.body;
+  if (
+    additionalConfig !== null &&
+    (typeof additionalConfig !== "object" || Array.isArray(additionalConfig))
+  ) {
+    return next(
+      new InvalidPayloadError({
+        reason: "additional_config must be an object",
+      })
+    );
+  }
 
   if (!inputTable) {
     return next(new InvalidPayloadError({ reason: "input_table is required" }));
@@ -161,6 +172,7 @@ export default async (req, res, next, database, logger) => {
             output_table: outputTable,
             user_id: accountability.user,
             filter,
+            additional_config: additionalConfig,
           },
           options: {},
           actor_name: "dissolve",
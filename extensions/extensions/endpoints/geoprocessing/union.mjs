@@ -4,7 +4,21 @@ import isValidTableName from "../../utils/isValidTableName.mjs";
 
 export default async (req, res, next, database, logger) => {
   const { accountability } = req;
-  const { input_table: inputTable, output_table: outputTable } = req.body;
+  const {
+    input_table: inputTable,
+    output_table: outputTable,
+    additional_config: additionalConfig = null,
+  } = req.body;
+  if (
+    additionalConfig !== null &&
+    (typeof additionalConfig !== "object" || Array.isArray(additionalConfig))
+  ) {
+    return next(
+      new InvalidPayloadError({
+        reason: "additional_config must be an object",
+      })
+    );
+  }
   if (!Array.isArray(inputTable) || inputTable.length < 2) {
     return next(
       new InvalidPayloadError({
@@ -136,6 +150,7 @@ export default async (req, res, next, database, logger) => {
             input_table: inputTable,
             output_table: outputTable,
             user_id: accountability.user,
+            additional_config: additionalConfig,
           },
           options: {},
           actor_name: "union",
@@ -8,6 +8,7 @@ import {
 } from "@directus/errors";
 
 import minioClient from "../../utils/minioClient.mjs";
+import { readPmtilesTile } from "../../utils/pmtiles.mjs";
 import validateUuid from "../../utils/validateUuid.mjs";
 
 const TileNotFoundError = createError(
@@ -38,7 +39,7 @@ export default (router, { database, env, logger }) => {
           FROM raster_tiles_directus_roles
           WHERE raster_tiles_layer_id = :layerId
         )
-        SELECT permission_type, allowed_roles
+        SELECT permission_type, allowed_roles, tile_archive
         FROM raster_tiles, allowed_roles_query
         WHERE layer_id = :layerId
       `,
@@ -110,6 +111,34 @@ export default (router, { database, env, logger }) => {
       return next(new InvalidQueryError({ reason: "Invalid z, x, y" }));
     }
 
+    // tiles of an archive are read with range requests
+    if (rasterTileRows[0].tile_archive) {
+      let tile;
+      try {
+        tile = await readPmtilesTile(
+          env.STORAGE_S3_BUCKET,
+          (env.STORAGE_S3_ROOT ? env.STORAGE_S3_ROOT + "/" : "") +
+            rasterTileRows[0].tile_archive,
+          z,
+          x,
+          y
+        );
+      } catch (error) {
+        logger.error(error);
+        return next(
+          new ServiceUnavailableError({
+            service: "raster-tiles",
+            reason: "Failed to fetch tile",
+          })
+        );
+      }
+      if (!tile) {
+        return next(new TileNotFoundError({ z, x, y, layerId }));
+      }
+      res.setHeader("Content-Type", "image/png");
+      return res.end(tile);
+    }
+
     const objectKey =
       (env.STORAGE_S3_ROOT ? env.STORAGE_S3_ROOT + "/" : "") +
       `raster-tiles/${layerId}/${z}/${x}/${y}.png`;
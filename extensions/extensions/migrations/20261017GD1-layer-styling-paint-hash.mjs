@@ -0,0 +1,64 @@
+export async function up(knex) {
+  await knex.raw(`
+    ALTER TABLE public.fill ADD COLUMN paint_hash varchar(64) NULL;
+    ALTER TABLE public.line ADD COLUMN paint_hash varchar(64) NULL;
+    ALTER TABLE public.circle ADD COLUMN paint_hash varchar(64) NULL;
+
+    CREATE UNIQUE INDEX fill_paint_hash_idx ON public.fill (paint_hash) WHERE paint_hash IS NOT NULL;
+    CREATE UNIQUE INDEX line_paint_hash_idx ON public.line (paint_hash) WHERE paint_hash IS NOT NULL;
+    CREATE UNIQUE INDEX circle_paint_hash_idx ON public.circle (paint_hash) WHERE paint_hash IS NOT NULL;
+
+    -- an edited style no longer matches the paint it was hashed from
+    CREATE OR REPLACE FUNCTION handle_layer_styling_update()
+      RETURNS trigger
+      LANGUAGE 'plpgsql'
+    AS $BODY$
+      BEGIN
+        IF NEW.paint_hash IS NOT DISTINCT FROM OLD.paint_hash THEN
+          NEW.paint_hash := NULL;
+        END IF;
+        RETURN NEW;
+      END;
+    $BODY$;
+
+    CREATE OR REPLACE TRIGGER on_fill_update
+    BEFORE UPDATE
+    ON fill
+    FOR EACH ROW
+    EXECUTE FUNCTION handle_layer_styling_update();
+
+    CREATE OR REPLACE TRIGGER on_line_update
+    BEFORE UPDATE
+    ON line
+    FOR EACH ROW
+    EXECUTE FUNCTION handle_layer_styling_update();
+
+    CREATE OR REPLACE TRIGGER on_circle_update
+    BEFORE UPDATE
+    ON circle
+    FOR EACH ROW
+    EXECUTE FUNCTION handle_layer_styling_update();
+
+    INSERT INTO directus_fields (
+      collection, field, special, interface, options, readonly, hidden, sort, translations, required
+    ) VALUES
+      ('fill', 'paint_hash', NULL, 'input', NULL, true, true, NULL, NULL, false),
+      ('line', 'paint_hash', NULL, 'input', NULL, true, true, NULL, NULL, false),
+      ('circle', 'paint_hash', NULL, 'input', NULL, true, true, NULL, NULL, false);
+  `);
+}
+
+export async function down(knex) {
+  await knex.raw(`
+    DELETE FROM directus_fields WHERE collection IN ('fill', 'line', 'circle') AND field = 'paint_hash';
+
+    DROP TRIGGER IF EXISTS on_fill_update ON fill;
+    DROP TRIGGER IF EXISTS on_line_update ON line;
+    DROP TRIGGER IF EXISTS on_circle_update ON circle;
+    DROP FUNCTION IF EXISTS handle_layer_styling_update;
+
+    ALTER TABLE public.fill DROP COLUMN IF EXISTS paint_hash;
+    ALTER TABLE public.line DROP COLUMN IF EXISTS paint_hash;
+    ALTER TABLE public.circle DROP COLUMN IF EXISTS paint_hash;
+  `);
+}
@@ -0,0 +1,41 @@
+export async function up(knex) {
+  await knex.raw(`
+    -- private copies of cached results, outside of the schema served by directus
+    CREATE SCHEMA IF NOT EXISTS geoprocessing_cache;
+
+    CREATE TABLE IF NOT EXISTS geoprocessing_result_cache (
+      cache_key varchar(64) PRIMARY KEY,
+      actor varchar(64) NOT NULL,
+      cache_table varchar(63) NOT NULL,
+      size_bytes bigint NOT NULL DEFAULT 0,
+      hits integer NOT NULL DEFAULT 0,
+      date_created timestamp with time zone DEFAULT CURRENT_TIMESTAMP,
+      last_used timestamp with time zone DEFAULT CURRENT_TIMESTAMP
+    );
+
+    CREATE INDEX ON geoprocessing_result_cache (last_used);
+
+    INSERT INTO directus_collections(collection, "group", icon, color)
+    VALUES ('geoprocessing_result_cache', 'internal', 'cached', '#E35169');
+
+    INSERT INTO directus_fields(collection, field, special, interface, options, display, readonly)
+    VALUES
+      ('geoprocessing_result_cache', 'cache_key', NULL, 'input', NULL, NULL, true),
+      ('geoprocessing_result_cache', 'actor', NULL, 'input', NULL, NULL, true),
+      ('geoprocessing_result_cache', 'cache_table', NULL, 'input', NULL, NULL, true),
+      ('geoprocessing_result_cache', 'size_bytes', NULL, 'input', NULL, 'formatted-value', true),
+      ('geoprocessing_result_cache', 'hits', NULL, 'input', NULL, NULL, true),
+      ('geoprocessing_result_cache', 'date_created', 'date-created', 'datetime', NULL, 'datetime', true),
+      ('geoprocessing_result_cache', 'last_used', NULL, 'datetime', NULL, 'datetime', true);
+  `);
+}
+
+export async function down(knex) {
+  await knex.raw(`
+    DELETE FROM directus_fields WHERE collection = 'geoprocessing_result_cache';
+    DELETE FROM directus_collections WHERE collection = 'geoprocessing_result_cache';
+
+    DROP TABLE IF EXISTS geoprocessing_result_cache;
+    DROP SCHEMA IF EXISTS geoprocessing_cache CASCADE;
+  `);
+}
@@ -0,0 +1,18 @@
+export async function up(knex) {
+  await knex.raw(`
+    ALTER TABLE public.raster_tiles ADD COLUMN tile_archive character varying(255) NULL;
+
+    INSERT INTO directus_fields (
+      collection, field, special, interface, options, readonly, hidden, sort, translations, note, required
+    ) VALUES
+      ('raster_tiles', 'tile_archive', NULL, 'input', NULL, true, false, NULL, NULL, 'PMTiles archive of the tiles, relative to the storage root', false);
+  `);
+}
+
+export async function down(knex) {
+  await knex.raw(`
+    DELETE FROM directus_fields WHERE collection = 'raster_tiles' AND field = 'tile_archive';
+
+    ALTER TABLE public.raster_tiles DROP COLUMN IF EXISTS tile_archive;
+  `);
+}
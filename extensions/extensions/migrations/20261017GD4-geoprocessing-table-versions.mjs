@@ -0,0 +1,73 @@
+export async function up(knex) {
+  await knex.raw(`
+    -- transactional version of every layer table, bumped by each write statement
+    CREATE TABLE IF NOT EXISTS geoprocessing_table_versions (
+      table_oid oid PRIMARY KEY,
+      version bigint NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION handle_geoprocessing_table_write()
+      RETURNS trigger
+      LANGUAGE 'plpgsql'
+    AS $BODY$
+      BEGIN
+        INSERT INTO geoprocessing_table_versions (table_oid, version)
+        VALUES (TG_RELID, 1)
+        ON CONFLICT (table_oid)
+        DO UPDATE SET version = geoprocessing_table_versions.version + 1;
+        RETURN NULL;
+      END;
+    $BODY$;
+
+    -- versions of dropped tables are removed, their oid may be reused
+    CREATE OR REPLACE FUNCTION handle_geoprocessing_table_drop()
+      RETURNS event_trigger
+      LANGUAGE 'plpgsql'
+    AS $BODY$
+      BEGIN
+        DELETE FROM geoprocessing_table_versions
+        WHERE table_oid IN (
+          SELECT objid FROM pg_event_trigger_dropped_objects()
+          WHERE object_type = 'table'
+        );
+      END;
+    $BODY$;
+
+    DROP EVENT TRIGGER IF EXISTS on_geoprocessing_table_drop;
+    CREATE EVENT TRIGGER on_geoprocessing_table_drop ON sql_drop
+      EXECUTE FUNCTION handle_geoprocessing_table_drop();
+
+    -- tables created before this migration
+    DO $BODY$
+      DECLARE
+        layer_table regclass;
+      BEGIN
+        FOR layer_table IN
+          SELECT c.oid::regclass
+          FROM vector_tiles v
+          JOIN pg_class c
+            ON c.relname = v.layer_name
+            AND c.relnamespace = 'public'::regnamespace
+            AND c.relkind = 'r'
+        LOOP
+          EXECUTE format(
+            'CREATE OR REPLACE TRIGGER on_geoprocessing_table_write AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %s FOR EACH STATEMENT EXECUTE FUNCTION handle_geoprocessing_table_write()',
+            layer_table
+          );
+          INSERT INTO geoprocessing_table_versions (table_oid, version)
+          VALUES (layer_table, 0)
+          ON CONFLICT (table_oid) DO NOTHING;
+        END LOOP;
+      END;
+    $BODY$;
+  `);
+}
+
+export async function down(knex) {
+  await knex.raw(`
+    DROP EVENT TRIGGER IF EXISTS on_geoprocessing_table_drop;
+    DROP FUNCTION IF EXISTS handle_geoprocessing_table_drop();
+    DROP FUNCTION IF EXISTS handle_geoprocessing_table_write() CASCADE;
+    DROP TABLE IF EXISTS geoprocessing_table_versions;
+  `);
+}
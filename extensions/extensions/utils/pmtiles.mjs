@@ -0,0 +1,218 @@
+import { promisify } from "node:util";
+import { gunzip } from "node:zlib";
+
+import minioClient from "./minioClient.mjs";
+
+const gunzipAsync = promisify(gunzip);
+
+const HEADER_SIZE = 127;
+// header and root directory are read together, they fit in the first 16 KiB
+const INITIAL_FETCH_SIZE = 16384;
+const COMPRESSION_NONE = 1;
+const COMPRESSION_GZIP = 2;
+const MAX_CACHED_DIRECTORIES = 256;
+
+// archives are immutable, a new tiling gets a new layer id
+const directoryCache = new Map();
+
+// tile ids go beyond 32 bits, so no bitwise operators on them
+export function zxyToTileId(z, x, y) {
+  let tileId = (4 ** z - 1) / 3;
+  for (let level = z - 1; level >= 0; level--) {
+    const size = 2 ** level;
+    const rx = Math.floor(x / size) % 2;
+    const ry = Math.floor(y / size) % 2;
+    tileId += ((3 * rx) ^ ry) * size * size;
+    // rotate the quadrant
+    if (ry === 0) {
+      if (rx === 1) {
+        x = size - 1 - (x % size);
+        y = size - 1 - (y % size);
+      }
+      [x, y] = [y, x];
+    }
+  }
+  return tileId;
+}
+
+function readVarint(buffer, state) {
+  let value = 0;
+  let shift = 1;
+  let byte;
+  do {
+    byte = buffer[state.position++];
+    value += (byte & 0x7f) * shift;
+    shift *= 128;
+  } while (byte >= 0x80);
+  return value;
+}
+
+async function decompress(buffer, compression) {
+  if (compression === COMPRESSION_NONE) {
+    return buffer;
+  }
+  if (compression === COMPRESSION_GZIP) {
+    return gunzipAsync(buffer);
+  }
+  throw new Error(`Unsupported PMTiles compression ${compression}`);
+}
+
+async function deserializeDirectory(buffer, compression) {
+  const data = await decompress(buffer, compression);
+  const state = { position: 0 };
+  const count = readVarint(data, state);
+  const entries = [];
+  let tileId = 0;
+  for (let i = 0; i < count; i++) {
+    tileId += readVarint(data, state);
+    entries.push({ tileId, offset: 0, length: 0, runLength: 1 });
+  }
+  for (const entry of entries) {
+    entry.runLength = readVarint(data, state);
+  }
+  for (const entry of entries) {
+    entry.length = readVarint(data, state);
+  }
+  for (let i = 0; i < count; i++) {
+    const offset = readVarint(data, state);
+    entries[i].offset =
+      offset === 0 && i > 0
+        ? entries[i - 1].offset + entries[i - 1].length
+        : offset - 1;
+  }
+  return entries;
+}
+
+function parseHeader(buffer) {
+  if (buffer.toString("utf8", 0, 7) !== "PMTiles" || buffer[7] !== 3) {
+    throw new Error("Not a PMTiles v3 archive");
+  }
+  const readOffset = (position) => Number(buffer.readBigUInt64LE(position));
+  return {
+    rootDirectoryOffset: readOffset(8),
+    rootDirectoryLength: readOffset(16),
+    leafDirectoriesOffset: readOffset(40),
+    tileDataOffset: readOffset(56),
+    internalCompression: buffer[97],
+  };
+}
+
+async function readRange(bucket, objectKey, offset, length) {
+  const stream = await minioClient.getPartialObject(
+    bucket,
+    objectKey,
+    offset,
+    length
+  );
+  const chunks = [];
+  for await (const chunk of stream) {
+    chunks.push(chunk);
+  }
+  return Buffer.concat(chunks);
+}
+
+function cacheDirectory(key, value) {
+  if (directoryCache.size >= MAX_CACHED_DIRECTORIES) {
+    directoryCache.delete(directoryCache.keys().next().value);
+  }
+  directoryCache.set(key, value);
+}
+
+async function getRoot(bucket, objectKey) {
+  const cacheKey = `${bucket}/${objectKey}`;
+  if (!directoryCache.has(cacheKey)) {
+    const buffer = await readRange(bucket, objectKey, 0, INITIAL_FETCH_SIZE);
+    const header = parseHeader(buffer);
+    const rootDirectory = await deserializeDirectory(
+      buffer.subarray(
+        header.rootDirectoryOffset,
+        header.rootDirectoryOffset + header.rootDirectoryLength
+      ),
+      header.internalCompression
+    );
+    cacheDirectory(cacheKey, { header, directory: rootDirectory });
+  }
+  return directoryCache.get(cacheKey);
+}
+
+async function getLeafDirectory(bucket, objectKey, header, offset, length) {
+  const cacheKey = `${bucket}/${objectKey}:${offset}`;
+  if (!directoryCache.has(cacheKey)) {
+    const buffer = await readRange(
+      bucket,
+      objectKey,
+      header.leafDirectoriesOffset + offset,
+      length
+    );
+    cacheDirectory(cacheKey, {
+      directory: await deserializeDirectory(
+        buffer,
+        header.internalCompression
+      ),
+    });
+  }
+  return directoryCache.get(cacheKey).directory;
+}
+
+function findEntry(entries, tileId) {
+  // last entry starting at or before the tile id
+  let low = 0;
+  let high = entries.length - 1;
+  let found = null;
+  while (low <= high) {
+    const middle = (low + high) >> 1;
+    if (entries[middle].tileId <= tileId) {
+      found = entries[middle];
+      low = middle + 1;
+    } else {
+      high = middle - 1;
+    }
+  }
+  if (
+    found &&
+    found.runLength > 0 &&
+    tileId >= found.tileId + found.runLength
+  ) {
+    return null;
+  }
+  return found;
+}
+
+/**
+ * Reads a tile of a PMTiles v3 archive with range requests, the header and
+ * directories are cached.
+ *
+ * @returns the tile data, null when the archive does not have the tile
+ */
+export async function readPmtilesTile(bucket, objectKey, z, x, y) {
+  const tileId = zxyToTileId(z, x, y);
+  const { header, directory: rootDirectory } = await getRoot(
+    bucket,
+    objectKey
+  );
+
+  let directory = rootDirectory;
+  // leaf directories can be nested, the spec allows a few levels
+  for (let depth = 0; depth < 4; depth++) {
+    const entry = findEntry(directory, tileId);
+    if (!entry) {
+      return null;
+    }
+    if (entry.runLength > 0) {
+      return readRange(
+        bucket,
+        objectKey,
+        header.tileDataOffset + entry.offset,
+        entry.length
+      );
+    }
+    directory = await getLeafDirectory(
+      bucket,
+      objectKey,
+      header,
+      entry.offset,
+      entry.length
+    );
+  }
+  return null;
+}
@@ -1,8 +1,36 @@
+import time
+
+from psycopg2 import sql
+
 from lib.get_header_info import HeaderInfo
 from utils import logger
 
 
-def create_table_from_header_info(conn, header_info: HeaderInfo, table_name: str):
+def track_table_version(cur, table_name: str):
+    """
+    Attaches the statement trigger bumping the version of the table on every
+    write, which keys the geoprocessing results cached from it. Attached once the
+    table is loaded, so bulk load statements do not contend on the version row.
+    """
+    cur.execute(
+        sql.SQL(
+            "CREATE OR REPLACE TRIGGER on_geoprocessing_table_write AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} FOR EACH STATEMENT EXECUTE FUNCTION handle_geoprocessing_table_write()"
+        ).format(table=sql.Identifier(table_name))
+    )
+    # a stale version left by a dropped table with the same oid is moved past
+    cur.execute(
+        "INSERT INTO geoprocessing_table_versions (table_oid, version) VALUES (%s::regclass, 0) ON CONFLICT (table_oid) DO UPDATE SET version = geoprocessing_table_versions.version + 1",
+        [sql.Identifier(table_name).as_string(cur)],
+    )
+
+
+def create_table_from_header_info(
+    conn,
+    header_info: HeaderInfo,
+    table_name: str,
+    with_index: bool = True,
+    srid: int | None = 4326,
+):
     # Mapping shapefile field types to PostgreSQL column types
     type_mapping = {
         "Integer": "integer",
@@ -21,19 +49,60 @@ def create_table_from_header_info(conn, header_info: HeaderInfo, table_name: str
 
     fields = header_info["fields"]
     # Adding an auto-incrementing primary key column and geom column for geometry; assuming 2D geometries in WGS 84 for now
+    # unless a source SRID is pushed down to be transformed after load, or left unconstrained
+    # when geometries are loaded as is and normalized afterwards
+    geom_type = f"geometry(Geometry, {srid})" if srid else "geometry"
     columns_sql = ", ".join(
         ["ogc_fid serial PRIMARY KEY"]
         + [
             f'"{field["name"].lower()}" {type_mapping.get(field["type"], "text")}'
             for field in fields
         ]
-        + ["geom geometry(Geometry, 4326)"]
+        + [f"geom {geom_type}"]
     )
 
-    create_table_sql = f"""CREATE TABLE {table_name} ({columns_sql}); 
-        CREATE INDEX IF NOT EXISTS {table_name}_geom_geom_idx ON {table_name} USING gist (geom);"""
+    create_table_sql = f"CREATE TABLE {table_name} ({columns_sql});"
+    if with_index:
+        create_table_sql += f" CREATE INDEX IF NOT EXISTS {table_name}_geom_geom_idx ON {table_name} USING gist (geom);"
 
     with conn:
         with conn.cursor() as cur:
             cur.execute(create_table_sql)
     logger.info("Create table based on header info")
+
+
+def index_and_analyze_table(
+    conn,
+    table_name: str,
+    maintenance_workers: int | None = None,
+    cluster: bool = False,
+) -> dict[str, float]:
+    # Build spatial index after bulk load so rows don't pay for index maintenance,
+    # then refresh planner statistics before the layer gets served
+    timings: dict[str, float] = {}
+    index_name = f"{table_name}_geom_geom_idx"
+    with conn:
+        with conn.cursor() as cur:
+            phase_start = time.perf_counter()
+            if maintenance_workers is not None:
+                cur.execute(
+                    "SELECT set_config('max_parallel_maintenance_workers', %s, true)",
+                    [str(int(maintenance_workers))],
+                )
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} USING gist (geom)"
+            )
+            timings["index"] = round(time.perf_counter() - phase_start, 3)
+            logger.info("Spatial index built")
+
+            if cluster:
+                phase_start = time.perf_counter()
+                cur.execute(f"CLUSTER {table_name} USING {index_name}")
+                timings["cluster"] = round(time.perf_counter() - phase_start, 3)
+                logger.info("Table clustered on spatial index")
+
+            phase_start = time.perf_counter()
+            cur.execute(f"ANALYZE {table_name}")
+            timings["analyze"] = round(time.perf_counter() - phase_start, 3)
+            logger.info("Table analyzed")
+    return timings
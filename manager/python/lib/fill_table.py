@@ -1,9 +1,14 @@
+import os
+
 from osgeo import osr, ogr
-from typing import Any
+from typing import Any, Iterable, Iterator, TypedDict
 
 from lib.get_header_info import HeaderInfo
 from utils import logger
 
+# numpy arrays of arrow timestamps drop the time zone of the values
+ARROW_UNSUPPORTED_FIELD_TYPES = ["DateTime", "Time"]
+
 
 def detect_and_import_srs(srs_string: str):
     """
@@ -44,15 +49,7 @@ def detect_and_import_srs(srs_string: str):
     return srs
 
 
-def fill_table_with_layer_feature(
-    layer: ogr.Layer,
-    header_info: HeaderInfo,
-    conn: Any,
-    table_name: str,
-    srs_string: str | None,
-):
-    fields = header_info["fields"]
-
+def get_coord_transform(header_info: HeaderInfo, srs_string: str | None):
     # Define the source and target spatial reference systems
     source_srs = detect_and_import_srs(
         srs_string or header_info["srs_code"]
@@ -64,11 +61,190 @@ def fill_table_with_layer_feature(
     need_transform = (
         header_info["srs_code"] is not None and "4326" not in header_info["srs_code"]
     ) or (srs_string is not None and "4326" not in srs_string)
+    return coord_transform, need_transform
+
+
+def get_pushdown_srid(conn, header_info: HeaderInfo, srs_string: str | None):
+    """
+    Returns the EPSG code of the source data when reprojection can be pushed down
+    to PostGIS as a single set based ST_Transform after load, None otherwise.
+
+    :param conn: Database connection used to check spatial_ref_sys
+    :param header_info: Header info of the layer being loaded
+    :param srs_string: The SRS string provided by the user, overriding the layer SRS
+    :return: Source SRID, or None when no transform is needed or SRS is not an EPSG code
+    """
+    if srs_string:
+        srs_code = srs_string.lower().removeprefix("epsg:")
+    elif header_info["srs_name"] == "EPSG":
+        srs_code = header_info["srs_code"]
+    else:
+        return None
+    if not srs_code or not srs_code.isdigit() or int(srs_code) == 4326:
+        return None
+
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM spatial_ref_sys WHERE srid = %s", [int(srs_code)]
+            )
+            if cur.fetchone() is None:
+                return None
+    return int(srs_code)
+
+
+def transform_table_geometry(
+    conn, table_name: str, source_srid: int | None, force_2d: bool = False
+):
+    # Single table rewrite instead of per feature reprojection on the client
+    geom_expression = "ST_Transform(geom, 4326)"
+    if force_2d:
+        geom_expression = f"ST_Force2D({geom_expression})"
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"ALTER TABLE {table_name} ALTER COLUMN geom TYPE geometry(Geometry, 4326) USING {geom_expression}"
+            )
+    logger.info(f"Transform table geometry from EPSG:{source_srid or 4326} completed")
+
+
+class LoadStats(TypedDict):
+    rows: int
+    # lon_min, lat_min, lon_max, lat_max in EPSG:4326, None when nothing to bound
+    bounds: list[float] | None
+    geometry_types: dict[str, int]
+
+
+WKB_GEOMETRY_NAMES = {
+    1: "POINT",
+    2: "LINESTRING",
+    3: "POLYGON",
+    4: "MULTIPOINT",
+    5: "MULTILINESTRING",
+    6: "MULTIPOLYGON",
+    7: "GEOMETRYCOLLECTION",
+}
+
+
+def get_wkb_geometry_name(wkb: bytes) -> str:
+    byte_order = "little" if wkb[0] == 1 else "big"
+    # drop EWKB flags, then ISO Z/M/ZM offsets
+    geom_type = int.from_bytes(wkb[1:5], byte_order) & 0x0FFFFFFF
+    return WKB_GEOMETRY_NAMES.get(geom_type % 1000, "GEOMETRY")
+
+
+def transform_bounds_to_wgs84(
+    header_info: HeaderInfo, srs_string: str | None, bounds: list[float]
+) -> list[float]:
+    source_srs = detect_and_import_srs(srs_string or header_info["srs_code"])
+    source_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target_srs = osr.SpatialReference()
+    target_srs.ImportFromEPSG(4326)
+    target_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    coord_transform = osr.CoordinateTransformation(source_srs, target_srs)
+    return list(coord_transform.TransformBounds(*bounds, 21))
+
+
+class LayerStats:
+    """
+    Accumulates the envelope and geometry type counts of loaded features, so
+    registration does not need another full scan of the table.
+    """
+
+    def __init__(self):
+        # min_x, max_x, min_y, max_y like ogr.Geometry.GetEnvelope
+        self.envelope: list[float] | None = None
+        self.geometry_types: dict[str, int] = {}
+
+    def add_envelope(self, envelope: tuple[float, float, float, float]):
+        if self.envelope is None:
+            self.envelope = list(envelope)
+            return
+        current = self.envelope
+        if envelope[0] < current[0]:
+            current[0] = envelope[0]
+        if envelope[1] > current[1]:
+            current[1] = envelope[1]
+        if envelope[2] < current[2]:
+            current[2] = envelope[2]
+        if envelope[3] > current[3]:
+            current[3] = envelope[3]
+
+    def add_geometry(self, geometry: ogr.Geometry):
+        if geometry.IsEmpty():
+            return
+        self.add_envelope(geometry.GetEnvelope())
+        name = geometry.GetGeometryName()
+        self.geometry_types[name] = self.geometry_types.get(name, 0) + 1
+
+    def to_load_stats(
+        self,
+        rows: int,
+        header_info: HeaderInfo,
+        srs_string: str | None,
+        in_source_srs: bool,
+    ) -> LoadStats:
+        """
+        :param in_source_srs: Whether the envelope is still in the source SRS, as
+            when reprojection is pushed down to PostGIS
+        """
+        bounds = None
+        if self.envelope is not None:
+            min_x, max_x, min_y, max_y = self.envelope
+            bounds = [min_x, min_y, max_x, max_y]
+            if in_source_srs:
+                bounds = transform_bounds_to_wgs84(header_info, srs_string, bounds)
+        return {
+            "rows": rows,
+            "bounds": bounds,
+            "geometry_types": self.geometry_types,
+        }
+
+
+def merge_load_stats(load_stats: list[LoadStats]) -> LoadStats:
+    bounds = None
+    geometry_types = {}
+    for stats in load_stats:
+        if stats["bounds"] is not None:
+            bounds = (
+                stats["bounds"]
+                if bounds is None
+                else [
+                    min(bounds[0], stats["bounds"][0]),
+                    min(bounds[1], stats["bounds"][1]),
+                    max(bounds[2], stats["bounds"][2]),
+                    max(bounds[3], stats["bounds"][3]),
+                ]
+            )
+        for name, count in stats["geometry_types"].items():
+            geometry_types[name] = geometry_types.get(name, 0) + count
+    return {
+        "rows": sum(stats["rows"] for stats in load_stats),
+        "bounds": bounds,
+        "geometry_types": geometry_types,
+    }
+
+
+def fill_table_with_layer_feature(
+    layer: Iterable[ogr.Feature],
+    header_info: HeaderInfo,
+    conn: Any,
+    table_name: str,
+    srs_string: str | None,
+    source_srid: int | None = None,
+) -> LoadStats:
+    fields = header_info["fields"]
+    coord_transform, need_transform = get_coord_transform(header_info, srs_string)
+    # Reprojection is done afterwards by PostGIS when source SRID is pushed down
+    geom_srid = source_srid or 4326
+    need_transform = need_transform and source_srid is None
+    layer_stats = LayerStats()
 
     # Process in batches
     batch_size = 1000  # Adjust based on your system's capability
     batch = []
     batch_count = 0
+    row_count = 0
 
     for feature in layer:
         geometry = feature.GetGeometryRef()
@@ -77,6 +253,7 @@ def fill_table_with_layer_feature(
             if need_transform:
                 geometry.Transform(coord_transform)
             geometry.FlattenTo2D()
+            layer_stats.add_geometry(geometry)
             wkt_geom = geometry.ExportToWkt()
 
         columns = [f'"{field["name"].lower()}"' for field in fields]
@@ -91,10 +268,13 @@ def fill_table_with_layer_feature(
 
             values.append(value)
 
-        geom_text = f"ST_GeomFromText('{wkt_geom}', 4326)" if wkt_geom else "NULL"
+        geom_text = (
+            f"ST_GeomFromText('{wkt_geom}', {geom_srid})" if wkt_geom else "NULL"
+        )
         geom_and_placeholders = ", ".join([geom_text] + ["%s" for _ in values])
         insert_sql = f"INSERT INTO {table_name} ({', '.join(['geom'] + columns)}) VALUES ({geom_and_placeholders});"
         batch.append((insert_sql, values))
+        row_count += 1
 
         if len(batch) >= batch_size:
             with conn.cursor() as cur:
@@ -113,3 +293,260 @@ def fill_table_with_layer_feature(
             conn.commit()
 
     logger.info("Fill table with layer feature completed")
+    return layer_stats.to_load_stats(
+        row_count, header_info, srs_string, source_srid is not None
+    )
+
+
+def wkb_to_hex_ewkb(wkb: bytes, srid: int) -> str:
+    """
+    Converts WKB (ISO or extended, either byte order) into hex encoded EWKB carrying
+    the given SRID, which is accepted as is by the PostGIS geometry input function
+    inside COPY.
+    """
+    byte_order = "little" if wkb[0] == 1 else "big"
+    geom_type = int.from_bytes(wkb[1:5], byte_order) | 0x20000000  # EWKB SRID flag
+    return (
+        wkb[0:1]
+        + geom_type.to_bytes(4, byte_order)
+        + srid.to_bytes(4, byte_order)
+        + wkb[5:]
+    ).hex()
+
+
+def to_hex_ewkb(geometry: ogr.Geometry, srid: int) -> str:
+    """
+    Exports an OGR geometry into hex encoded EWKB carrying the given SRID
+    """
+    return wkb_to_hex_ewkb(geometry.ExportToWkb(ogr.wkbNDR), srid)
+
+
+def escape_copy_text(value: str) -> str:
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def format_array_element(value: Any) -> str:
+    if value is None:
+        return "NULL"
+    if isinstance(value, (int, float)):
+        return str(value)
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def format_copy_value(value: Any) -> str:
+    """
+    Formats a python value into a single column of PostgreSQL COPY text format
+    """
+    if value is None:
+        return "\\N"
+    # numpy arrays and scalars coming from arrow batches
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    # Convert boolean-like values to 0 or 1
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return escape_copy_text(
+            "{" + ",".join(format_array_element(v) for v in value) + "}"
+        )
+    return escape_copy_text(str(value))
+
+
+def decode_arrow_value(value: Any, field_type: str) -> Any:
+    """
+    Arrow batches read as numpy carry String and StringList values as UTF-8
+    bytes, only Binary fields hold raw bytes to be copied as bytea
+    """
+    if value is None or field_type == "Binary":
+        return value
+    if hasattr(value, "tolist"):
+        value = value.tolist()
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode("utf-8")
+    if isinstance(value, (list, tuple)):
+        return [decode_arrow_value(v, field_type) for v in value]
+    return value
+
+
+class CopyRowStream:
+    """
+    Minimal file-like object that lazily pulls COPY text rows from an iterator, so
+    copy_expert can stream a whole layer while only a few rows live in memory.
+    """
+
+    def __init__(self, rows: Iterator[str]):
+        self.rows = rows
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            chunks.append(row)
+            length += len(row)
+        data = "".join(chunks)
+        if size < 0:
+            self.buffer = ""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+def copy_table_with_layer_feature(
+    layer: Iterable[ogr.Feature],
+    header_info: HeaderInfo,
+    conn: Any,
+    table_name: str,
+    srs_string: str | None,
+    source_srid: int | None = None,
+) -> LoadStats:
+    fields = header_info["fields"]
+    field_names = [field["name"] for field in fields]
+    coord_transform, need_transform = get_coord_transform(header_info, srs_string)
+    # Reprojection is done afterwards by PostGIS when source SRID is pushed down
+    geom_srid = source_srid or 4326
+    need_transform = need_transform and source_srid is None
+    layer_stats = LayerStats()
+    row_count = 0
+
+    def generate_rows():
+        nonlocal row_count
+        for feature in layer:
+            geometry = feature.GetGeometryRef()
+            ewkb_geom = "\\N"
+            if geometry:
+                if need_transform:
+                    geometry.Transform(coord_transform)
+                geometry.FlattenTo2D()
+                layer_stats.add_geometry(geometry)
+                ewkb_geom = to_hex_ewkb(geometry, geom_srid)
+
+            values = [format_copy_value(feature.GetField(name)) for name in field_names]
+            row_count += 1
+            if row_count % 100000 == 0:
+                logger.info(f"Copied {row_count} features")
+            yield "\t".join([ewkb_geom] + values) + "\n"
+
+    columns = ["geom"] + [f'"{name.lower()}"' for name in field_names]
+    copy_sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN"
+    with conn.cursor() as cur:
+        cur.copy_expert(copy_sql, CopyRowStream(generate_rows()))
+    conn.commit()
+
+    logger.info(f"Copy {row_count} layer features into table completed")
+    return layer_stats.to_load_stats(
+        row_count, header_info, srs_string, source_srid is not None
+    )
+
+
+def copy_table_with_layer_arrow_stream(
+    layer: ogr.Layer,
+    header_info: HeaderInfo,
+    conn: Any,
+    table_name: str,
+    srs_string: str | None,
+    source_srid: int | None = None,
+) -> LoadStats:
+    """
+    Columnar variant of copy_table_with_layer_feature. Record batches of WKB
+    geometry and attribute arrays are read through the layer arrow stream, so no
+    ogr.Feature is materialized per row. Geometries are copied as is, so the target
+    table geometry column must be unconstrained and normalized afterwards with
+    transform_table_geometry(force_2d=True).
+
+    :param layer: Layer to read, optionally with an attribute filter set
+    :param source_srid: SRID of the source geometries, None when already in EPSG:4326
+    :return: Load stats, bounds are taken from the layer extent
+    """
+    _, need_transform = get_coord_transform(header_info, srs_string)
+    if need_transform and source_srid is None:
+        raise Exception("Arrow reader requires the source SRS to be an EPSG code")
+
+    fields = header_info["fields"]
+    if any(field["type"] in ARROW_UNSUPPORTED_FIELD_TYPES for field in fields):
+        raise Exception("Arrow reader does not keep the time zone of time fields")
+    field_names = [field["name"] for field in fields]
+    field_types = [field["type"] for field in fields]
+    geom_srid = source_srid or 4326
+    geom_column = None
+    if layer.GetGeomType() != ogr.wkbNone:
+        geom_column = layer.GetGeometryColumn() or "wkb_geometry"
+    batch_size = int(os.environ.get("VECTOR_ARROW_BATCH_SIZE", 65536))
+    stream = layer.GetArrowStreamAsNumPy(
+        options=[
+            "USE_MASKED_ARRAYS=YES",
+            "INCLUDE_FID=NO",
+            "GEOMETRY_ENCODING=WKB",
+            f"MAX_FEATURES_IN_BATCH={batch_size}",
+        ]
+    )
+    layer_stats = LayerStats()
+    geometry_types = layer_stats.geometry_types
+    row_count = 0
+
+    def generate_rows():
+        nonlocal row_count
+        for batch in stream:
+            columns = [
+                [
+                    format_copy_value(decode_arrow_value(value, field_type))
+                    for value in batch[name].tolist()
+                ]
+                for name, field_type in zip(field_names, field_types)
+            ]
+            if geom_column:
+                geoms = []
+                for wkb in batch[geom_column].tolist():
+                    if wkb:
+                        name = get_wkb_geometry_name(wkb)
+                        geometry_types[name] = geometry_types.get(name, 0) + 1
+                        geoms.append(wkb_to_hex_ewkb(wkb, geom_srid))
+                    else:
+                        geoms.append("\\N")
+            else:
+                geoms = ["\\N"] * (len(columns[0]) if columns else 0)
+
+            for row in zip(geoms, *columns):
+                yield "\t".join(row) + "\n"
+            row_count += len(geoms)
+            logger.info(f"Copied {row_count} features")
+
+    columns = ["geom"] + [f'"{name.lower()}"' for name in field_names]
+    copy_sql = f"COPY {table_name} ({', '.join(columns)}) FROM STDIN"
+    with conn.cursor() as cur:
+        cur.copy_expert(copy_sql, CopyRowStream(generate_rows()))
+    conn.commit()
+
+    logger.info(f"Copy {row_count} layer features from arrow stream completed")
+    if geometry_types:
+        # geometries are not materialized, so bound them with the layer extent,
+        # which is the whole layer extent for FID filtered partitions too
+        layer_stats.add_envelope(layer.GetExtent())
+    return layer_stats.to_load_stats(
+        row_count, header_info, srs_string, source_srid is not None
+    )
+
+
+def get_layer_loader(load_method: str):
+    match load_method:
+        case "copy":
+            return copy_table_with_layer_feature
+        case "arrow":
+            return copy_table_with_layer_arrow_stream
+        case "insert":
+            return fill_table_with_layer_feature
+        case _:
+            raise Exception(f"Unexpected load method: {load_method}")
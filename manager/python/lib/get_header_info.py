@@ -1,4 +1,3 @@
-import os
 from typing import TypedDict
 
 from osgeo import ogr, gdal, osr
@@ -8,6 +7,7 @@ from lib.get_input_data import (
     get_input_data_without_vsi_with_vrt,
     get_input_data_with_vsi_with_vrt,
 )
+from lib.source_cache import get_source_path
 from utils import logger
 
 
@@ -78,15 +78,10 @@ def get_driver_short_name(format_file: str):
 
 
 def get_gdb_directory(bucket: str, object_key: str):
-    storage_root = (
-        os.environ.get("STORAGE_S3_ROOT", "") + "/"
-        if os.environ.get("STORAGE_S3_ROOT")
-        else ""
-    )
-    src_path = f"/vsizip//vsis3/{bucket}/{storage_root}{object_key}"
+    src_path = get_source_path(bucket, object_key, True)
     gdb_directory = gdal.ReadDir(src_path)
 
-    return f"{object_key}/{gdb_directory[0]}"
+    return gdb_directory[0]
 
 
 def get_gdal_dataset(
@@ -122,9 +117,9 @@ def get_gdal_dataset(
             )
 
         case "gdb":
-            object_key_gdb = get_gdb_directory(bucket, object_key)
+            gdb_directory = get_gdb_directory(bucket, object_key)
             data_source = get_input_data_with_vsi(
-                bucket, object_key_gdb, is_zipped, "OpenFileGDB"
+                bucket, object_key, True, "OpenFileGDB", [], gdb_directory
             )
 
         case _:
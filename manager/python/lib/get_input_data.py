@@ -2,6 +2,11 @@ import os
 
 from osgeo import ogr, gdal
 
+from lib.source_cache import (
+    fetch_source_file,
+    get_source_path,
+    is_source_cache_enabled,
+)
 from utils import minio_client, generate_local_temp_dir_path, generate_vrt_path
 
 
@@ -11,17 +16,11 @@ def get_input_data_with_vsi(
     is_zipped: bool,
     driver_short_name: str,
     open_opts: list[str] = [],
+    inner_path: str | None = None,
 ):
-    storage_root = (
-        os.environ.get("STORAGE_S3_ROOT", "") + "/"
-        if os.environ.get("STORAGE_S3_ROOT")
-        else ""
-    )
-    src_path = (
-        f"/vsizip//vsis3/{bucket}/{storage_root}{object_key}"
-        if is_zipped
-        else f"/vsis3/{bucket}/{storage_root}{object_key}"
-    )
+    src_path = get_source_path(bucket, object_key, is_zipped)
+    if inner_path:
+        src_path = f"{src_path}/{inner_path}"
     data_source: gdal.Dataset = gdal.OpenEx(
         src_path,
         gdal.GA_ReadOnly | gdal.OF_VECTOR,
@@ -41,16 +40,20 @@ def get_input_data_without_vsi_with_vrt(
     if is_zipped:
         raise Exception("Zipped file for this format is not supported yet")
 
-    storage_root = (
-        os.environ.get("STORAGE_S3_ROOT", "") + "/"
-        if os.environ.get("STORAGE_S3_ROOT")
-        else ""
-    )
-    temp_dir_path = generate_local_temp_dir_path(object_key)
-    temp_file_path = os.path.join(temp_dir_path, object_key)
-
-    # download data to temp directory
-    minio_client.fget_object(bucket, storage_root + object_key, temp_file_path)
+    # the driver cannot read through /vsis3, so the data is always local
+    if is_source_cache_enabled():
+        temp_file_path = fetch_source_file(bucket, object_key)
+    else:
+        storage_root = (
+            os.environ.get("STORAGE_S3_ROOT", "") + "/"
+            if os.environ.get("STORAGE_S3_ROOT")
+            else ""
+        )
+        temp_dir_path = generate_local_temp_dir_path(object_key)
+        temp_file_path = os.path.join(temp_dir_path, object_key)
+
+        # download data to temp directory
+        minio_client.fget_object(bucket, storage_root + object_key, temp_file_path)
 
     # get layer name
     data_source: gdal.Dataset = gdal.OpenEx(
@@ -111,17 +114,8 @@ def get_input_data_with_vsi_with_vrt(
     del data_source
 
     # create in memory VRT
-    storage_root = (
-        os.environ.get("STORAGE_S3_ROOT", "") + "/"
-        if os.environ.get("STORAGE_S3_ROOT")
-        else ""
-    )
     vrt_path = generate_vrt_path(object_key)
-    src_path = (
-        f"/vsizip//vsis3/{bucket}/{storage_root}{object_key}"
-        if is_zipped
-        else f"/vsis3/{bucket}/{storage_root}{object_key}"
-    )
+    src_path = get_source_path(bucket, object_key, is_zipped)
     gdal.FileFromMemBuffer(
         vrt_path,
         f"""<OGRVRTDataSource>
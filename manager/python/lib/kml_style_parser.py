@@ -1,39 +1,141 @@
+import hashlib
+import json
 import os
 import re
 import xml.etree.ElementTree as ET
-from pathlib import Path
+from functools import lru_cache
 
-import psycopg2
 from osgeo import gdal
-from utils import minio_client
+from psycopg2.extras import execute_values
+from lib.source_cache import fetch_source_file
+from utils import pool
 
 
-def extract_kml_styles(kml_path, layer_name):
-    # Parse the KML as XML
-    tree = ET.parse(kml_path)
-    root = tree.getroot()
+KML_NS = "{http://www.opengis.net/kml/2.2}"
+
+
+def get_child_text(element: ET.Element, tag: str) -> str | None:
+    child = element.find(KML_NS + tag)
+    return child.text if child is not None else None
+
+
+def extract_style_paint(style: ET.Element) -> dict:
+    # Extract geometry-specific styling
+    paint = {}
+    iconstyle = style.find(KML_NS + "IconStyle")
+    linestyle = style.find(KML_NS + "LineStyle")
+    polystyle = style.find(KML_NS + "PolyStyle")
 
-    # KML uses this namespace
-    ns = {'kml': 'http://www.opengis.net/kml/2.2'}
+    if iconstyle is not None:
+        circle = {}
+        color = get_child_text(iconstyle, "color")
+        scale = get_child_text(iconstyle, "scale")
+        if color is not None:
+            circle["circle-color"] = hex_color(color)
+            circle["circle-opacity"] = opacity_from_kml(color)
+        if scale is not None:
+            circle["circle-radius"] = float(scale) * 5  # scale multiplier heuristic
+        paint["circle"] = circle
 
-    # Collect <Style> and <StyleMap> definitions
+    if linestyle is not None:
+        line = {}
+        color = get_child_text(linestyle, "color")
+        width = get_child_text(linestyle, "width")
+        if color is not None:
+            line["line-color"] = hex_color(color)
+            line["line-opacity"] = opacity_from_kml(color)
+        if width is not None:
+            line["line-width"] = float(width)
+        paint["line"] = line
+
+    if polystyle is not None:
+        fill = {}
+        color = get_child_text(polystyle, "color")
+        fill_flag = get_child_text(polystyle, "fill")
+        if color is not None:
+            fill["fill-color"] = hex_color(color)
+            fill["fill-opacity"] = opacity_from_kml(color)
+        if fill_flag == "0":
+            fill["fill-opacity"] = 0.0
+        paint["fill"] = fill
+
+    return paint
+
+
+@lru_cache(maxsize=4)
+def parse_kml_placemark_paints(kml_path: str) -> list[dict | None]:
+    """
+    Streams the KML once and returns the resolved paint of every <Placemark>, indexed
+    by document order. Elements are cleared as soon as they are consumed, so only
+    one placemark lives in memory, and placemarks sharing a style share one dict.
+    Cached per path, source cache paths change with the object content.
+    """
     styles = {}
     stylemaps = {}
+    # per placemark either ("inline", paint) or ("url", style reference)
+    placemark_styles = []
+    inline_paints = {}
 
-    for style in root.findall(".//kml:Style", ns):
-        sid = style.get("id")
-        if sid:
-            styles[f"#{sid}"] = style
-
-    for stylemap in root.findall(".//kml:StyleMap", ns):
-        sid = stylemap.get("id")
-        if sid:
-            pairs = stylemap.findall(".//kml:Pair", ns)
-            for pair in pairs:
-                key = pair.find("kml:key", ns).text
-                styleurl = pair.find("kml:styleUrl", ns).text
-                if key == "normal":
-                    stylemaps[f"#{sid}"] = styleurl
+    stack = []
+    placemark = None
+    for event, element in ET.iterparse(kml_path, events=("start", "end")):
+        if event == "start":
+            if element.tag == KML_NS + "Placemark":
+                placemark = [None, None]
+            stack.append(element)
+            continue
+
+        stack.pop()
+        parent = stack[-1] if stack else None
+        is_placemark_child = parent is not None and parent.tag == KML_NS + "Placemark"
+        match element.tag.removeprefix(KML_NS):
+            case "Style":
+                paint = extract_style_paint(element)
+                sid = element.get("id")
+                if sid:
+                    styles[f"#{sid}"] = paint
+                if is_placemark_child and placemark[0] is None:
+                    # identical inline styles share a single paint dict
+                    key = repr(paint)
+                    placemark[0] = inline_paints.setdefault(key, paint)
+            case "styleUrl":
+                if is_placemark_child and placemark[1] is None and element.text:
+                    placemark[1] = element.text.strip()
+                continue
+            case "StyleMap":
+                sid = element.get("id")
+                if sid:
+                    for pair in element.iter(KML_NS + "Pair"):
+                        if get_child_text(pair, "key") == "normal":
+                            stylemaps[f"#{sid}"] = get_child_text(pair, "styleUrl")
+            case "Placemark":
+                if placemark[0] is not None:
+                    placemark_styles.append(("inline", placemark[0]))
+                else:
+                    placemark_styles.append(("url", placemark[1]))
+                placemark = None
+            case _:
+                continue
+
+        # drop consumed elements so the tree never grows with the file
+        element.clear()
+        if parent is not None:
+            parent.remove(element)
+
+    # styles may be defined after the placemarks using them, so resolve afterwards
+    placemark_paints = []
+    for kind, value in placemark_styles:
+        if kind == "inline":
+            placemark_paints.append(value)
+        elif value is not None:
+            placemark_paints.append(styles.get(stylemaps.get(value, value)))
+        else:
+            placemark_paints.append(None)
+    return placemark_paints
+
+
+def extract_kml_styles(kml_path, layer_name):
+    placemark_paints = parse_kml_placemark_paints(kml_path)
 
     # Prepare output
     style_dict = {
@@ -51,61 +153,25 @@ def extract_kml_styles(kml_path, layer_name):
     if not layer:
         raise ValueError(f"Layer '{layer_name}' not found in KML.")
 
-    # Scan features
+    # only FIDs are needed, skip reading geometries and attributes
+    layer_defn = layer.GetLayerDefn()
+    field_names = [
+        layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())
+    ]
+    layer.SetIgnoredFields(["OGR_GEOMETRY", "OGR_STYLE"] + field_names)
+
+    # Scan features, the placemark of a feature is found by its FID
+    last_paint = None
     for feature in layer:
-        # Try to find <Placemark> corresponding to this feature
         fid = feature.GetFID()
-        placemarks = root.findall(".//kml:Placemark", ns)
-        if fid >= len(placemarks):
+        if fid < 0 or fid >= len(placemark_paints):
             continue
-        pm = placemarks[fid]
-
-        # 1. Inline style
-        style_tag = pm.find("kml:Style", ns)
-        style_url_tag = pm.find("kml:styleUrl", ns)
-
-        final_style = None
-
-        if style_tag is not None:
-            final_style = style_tag
-        elif style_url_tag is not None:
-            style_ref = style_url_tag.text.strip()
-            if style_ref in stylemaps:
-                style_ref = stylemaps[style_ref]
-            final_style = styles.get(style_ref, None)
-
-        if final_style is not None:
-            # Extract geometry-specific styling
-            iconstyle = final_style.find("kml:IconStyle", ns)
-            linestyle = final_style.find("kml:LineStyle", ns)
-            polystyle = final_style.find("kml:PolyStyle", ns)
-
-            if iconstyle is not None:
-                color = iconstyle.find("kml:color", ns)
-                scale = iconstyle.find("kml:scale", ns)
-                if color is not None:
-                    style_dict["circle"]["circle-color"] = hex_color(color.text)
-                    style_dict["circle"]["circle-opacity"] = opacity_from_kml(color.text)
-                if scale is not None:
-                    style_dict["circle"]["circle-radius"] = float(scale.text) * 5  # scale multiplier heuristic
-
-            if linestyle is not None:
-                color = linestyle.find("kml:color", ns)
-                width = linestyle.find("kml:width", ns)
-                if color is not None:
-                    style_dict["line"]["line-color"] = hex_color(color.text)
-                    style_dict["line"]["line-opacity"] = opacity_from_kml(color.text)
-                if width is not None:
-                    style_dict["line"]["line-width"] = float(width.text)
-
-            if polystyle is not None:
-                color = polystyle.find("kml:color", ns)
-                fill = polystyle.find("kml:fill", ns)
-                if color is not None:
-                    style_dict["fill"]["fill-color"] = hex_color(color.text)
-                    style_dict["fill"]["fill-opacity"] = opacity_from_kml(color.text)
-                if fill is not None and fill.text == "0":
-                    style_dict["fill"]["fill-opacity"] = 0.0
+        paint = placemark_paints[fid]
+        if paint is None or paint is last_paint:
+            continue
+        for geom_type, geom_paint in paint.items():
+            style_dict[geom_type].update(geom_paint)
+        last_paint = paint
 
     return style_dict
 
@@ -125,57 +191,120 @@ def opacity_from_kml(kml_color: str) -> float:
     return round(alpha / 255, 2)
 
 
-def process_layer_style(kml_storage_path: str, layer_name: str, geom_name: str) -> int | None:
-    # === 1. Check if the KML file already exists locally, if not, download it ===
-    kml_filename = os.path.basename(kml_storage_path)
-    local_path = Path("/tmp") / kml_filename
+def get_style_geom_type(geom_name: str) -> str | None:
+    match geom_name:
+        case "POLYGON" | "MULTIPOLYGON":
+            return "fill"
+        case "LINESTRING" | "MULTILINESTRING":
+            return "line"
+        case "POINT" | "MULTIPOINT":
+            return "circle"
+        case _:
+            return None
 
-    # Check if the local file already exists
-    if not local_path.exists():
-        # Download the KML file
-        minio_client.fget_object(os.getenv("STORAGE_S3_BUCKET"), kml_storage_path, str(local_path))
-    else:
-        print(f"File {local_path} already exists. Skipping download.")
 
-    # === 2. Extract styles by layer name ===
-    layer_styles = extract_kml_styles(str(local_path), layer_name)
+def get_paint_hash(geom_type: str, paint: dict) -> str:
+    # layer name is not part of the hash, identical paints are shared between layers
+    content = json.dumps({"type": geom_type, "paint": paint}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
 
-    # === 3. Insert each style into DB ===
-    db_url = os.getenv("DB_CONNECTION_STRING")
-    conn = psycopg2.connect(db_url)
 
-    # TODO: 1 kml style could be inserted as multiple items into different geometry styles
+def find_styles_by_hash(cur, hashes: list[str]) -> dict[str, int]:
+    cur.execute(
+        """
+        SELECT paint_hash, id FROM fill WHERE paint_hash = ANY(%(hashes)s)
+        UNION ALL
+        SELECT paint_hash, id FROM line WHERE paint_hash = ANY(%(hashes)s)
+        UNION ALL
+        SELECT paint_hash, id FROM circle WHERE paint_hash = ANY(%(hashes)s)
+        """,
+        {"hashes": hashes},
+    )
+    return dict(cur.fetchall())
+
+
+def register_layer_styles(conn, styles: list[tuple[str, dict, str]]) -> list[int]:
+    """
+    Returns the style id of every (geom_type, paint, name) item, reusing existing
+    style rows with the same paint hash. All items are looked up in one query and
+    missing styles are inserted with one statement per style table and column set.
+    """
+    hashes = [get_paint_hash(geom_type, paint) for geom_type, paint, _ in styles]
     with conn:
         with conn.cursor() as cur:
-            match geom_name:
-                case "POLYGON" | "MULTIPOLYGON":
-                    geom_type = "fill"
-                case "LINESTRING" | "MULTILINESTRING":
-                    geom_type = "line"
-                case "POINT" | "MULTIPOINT":
-                    geom_type = "circle"
-                case _:
-                    return 0
-            style_dict = layer_styles[geom_type]
-            columns = []
-            values = []
-            for k, v in style_dict.items():
-                col = k.replace("-", "_")  # line-color → line_color
-                columns.append(f"paint_{col}")
-                values.append(v)
-            columns.insert(0, '"name"')
-            values.insert(0, layer_name)
-            placeholders = ", ".join(["%s"] * len(values))
-            colnames = ", ".join(columns)
-            insert_sql = f"""
-                INSERT INTO {geom_type} ({colnames})
-                VALUES ({placeholders})
-                RETURNING id
-            """
-            cur.execute(insert_sql, values)
-            style_ids = cur.fetchone()
-            if not style_ids:
-                raise Exception('Failed to save kml style')
-            style_id = style_ids[0]
-
-    return style_id
+            style_ids = find_styles_by_hash(cur, list(set(hashes)))
+
+            pending = {}
+            for paint_hash, (geom_type, paint, name) in zip(hashes, styles):
+                if paint_hash in style_ids:
+                    continue
+                # line-color → paint_line_color
+                columns = tuple(f"paint_{k.replace('-', '_')}" for k in paint)
+                rows = pending.setdefault((geom_type, columns), {})
+                rows.setdefault(paint_hash, (paint_hash, name, *paint.values()))
+
+            for (geom_type, columns), rows in pending.items():
+                colnames = ", ".join(("paint_hash", '"name"') + columns)
+                inserted = execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO {geom_type} ({colnames})
+                    VALUES %s
+                    ON CONFLICT (paint_hash) WHERE paint_hash IS NOT NULL DO NOTHING
+                    RETURNING paint_hash, id
+                    """,
+                    list(rows.values()),
+                    fetch=True,
+                )
+                style_ids.update(inserted)
+
+            # styles inserted concurrently by another worker
+            missing = [h for h in set(hashes) if h not in style_ids]
+            if missing:
+                style_ids.update(find_styles_by_hash(cur, missing))
+
+    if any(paint_hash not in style_ids for paint_hash in hashes):
+        raise Exception("Failed to save kml style")
+    return [style_ids[paint_hash] for paint_hash in hashes]
+
+
+def process_layer_styles(
+    kml_storage_path: str, layers: list[tuple[str, str]], conn=None
+) -> dict[str, int]:
+    """
+    Registers the styles of the given (layer_name, geom_name) KML layers and returns
+    the style id of each layer, 0 for layers without a supported geometry type.
+    Styles are registered with the given connection, or a pooled one.
+    """
+    # === 1. Get the KML file from the local source cache, downloading it once ===
+    local_path = fetch_source_file(os.getenv("STORAGE_S3_BUCKET"), kml_storage_path)
+
+    # === 2. Extract styles by layer name ===
+    # TODO: 1 kml style could be inserted as multiple items into different geometry styles
+    layer_style_ids = {}
+    styled_layers = []
+    styles = []
+    for layer_name, geom_name in layers:
+        geom_type = get_style_geom_type(geom_name)
+        if geom_type is None:
+            layer_style_ids[layer_name] = 0
+            continue
+        layer_styles = extract_kml_styles(local_path, layer_name)
+        styled_layers.append(layer_name)
+        styles.append((geom_type, layer_styles[geom_type], layer_name))
+
+    if not styles:
+        return layer_style_ids
+
+    # === 3. Reuse or insert styles in DB ===
+    if conn is not None:
+        style_ids = register_layer_styles(conn, styles)
+    else:
+        conn = pool.getconn()
+        try:
+            style_ids = register_layer_styles(conn, styles)
+        finally:
+            pool.putconn(conn)
+    layer_style_ids.update(zip(styled_layers, style_ids))
+    return layer_style_ids
+
@@ -0,0 +1,119 @@
+import os
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor
+
+from lib.create_table import track_table_version
+from utils import logger
+
+
+def use_unlogged_output(additional_config: dict | None = None) -> bool:
+    unlogged = (additional_config or {}).get(
+        "unlogged_output",
+        os.environ.get("GEOPROCESSING_UNLOGGED_OUTPUT", "false").lower() == "true",
+    )
+    return bool(unlogged)
+
+
+def create_output_table(
+    cur: cursor,
+    output_table: str,
+    columns: list[str],
+    select_query: sql.Composable,
+    query_params: list | None = None,
+    unlogged: bool = False,
+    with_data: bool = True,
+) -> int:
+    """
+    Creates a geoprocessing output table straight from its query with CREATE
+    TABLE AS, so rows are written in bulk without any index to maintain. The
+    table gets a serial ogc_fid, the given columns and a geometry column.
+
+    Unless created without data, the table is finalized right away. Otherwise
+    rows can still be inserted, and finalize_output_table must be called once
+    they are all in.
+
+    :param columns: Output column names, except ogc_fid and geom
+    :param select_query: Query returning the columns, in order, then the geometry
+    :param unlogged: Create the table unlogged and switch it to logged when
+        finalized, so the rows are written to WAL only once
+    :param with_data: Whether to fill the table with the query result
+    :return: Number of rows written
+    """
+    output_table_ident = sql.Identifier(output_table)
+    column_idents = [sql.Identifier(column) for column in columns]
+    cur.execute(
+        sql.SQL(""" CREATE {unlogged} TABLE {output_table} AS
+                SELECT (row_number() OVER ())::integer AS ogc_fid,{output_columns}q.geom::geometry(Geometry, 4326) AS geom
+                FROM ({select_query}) q ({query_columns}geom)
+                {with_data} """).format(
+            unlogged=sql.SQL("UNLOGGED" if unlogged else ""),
+            output_table=output_table_ident,
+            output_columns=sql.SQL("").join(
+                sql.SQL("q.{},").format(column_ident) for column_ident in column_idents
+            ),
+            select_query=select_query,
+            query_columns=sql.SQL("").join(
+                sql.SQL("{},").format(column_ident) for column_ident in column_idents
+            ),
+            with_data=sql.SQL("" if with_data else "WITH NO DATA"),
+        ),
+        query_params,
+    )
+    row_count = max(cur.rowcount, 0) if with_data else 0
+
+    # continue the fid sequence after the bulk written rows
+    sequence_ident = sql.Identifier(f"{output_table}_ogc_fid_seq")
+    cur.execute(
+        sql.SQL("CREATE SEQUENCE {sequence} OWNED BY {output_table}.ogc_fid").format(
+            sequence=sequence_ident, output_table=output_table_ident
+        )
+    )
+    cur.execute(
+        "SELECT setval(%s, %s, false)",
+        [f'"{output_table}_ogc_fid_seq"', row_count + 1],
+    )
+    cur.execute(
+        sql.SQL(
+            "ALTER TABLE {output_table} ALTER COLUMN ogc_fid SET DEFAULT nextval(%s)"
+        ).format(output_table=output_table_ident),
+        [f'"{output_table}_ogc_fid_seq"'],
+    )
+    logger.info(f"Table created with {row_count} rows")
+
+    if with_data:
+        finalize_output_table(cur, output_table, unlogged)
+    return row_count
+
+
+def finalize_output_table(cur: cursor, output_table: str, unlogged: bool = False):
+    """
+    Adds the primary key and the spatial index of an output table once all rows
+    are written, then refreshes its planner statistics and starts tracking its
+    version.
+    """
+    output_table_ident = sql.Identifier(output_table)
+    # SET LOGGED rewrites the table into WAL with its indexes, so it goes first
+    # and the indexes are written to WAL once, as they are built
+    if unlogged:
+        cur.execute(
+            sql.SQL("ALTER TABLE {output_table} SET LOGGED").format(
+                output_table=output_table_ident
+            )
+        )
+    cur.execute(
+        sql.SQL("ALTER TABLE {output_table} ADD PRIMARY KEY (ogc_fid)").format(
+            output_table=output_table_ident
+        )
+    )
+    cur.execute(
+        sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
+        ).format(
+            idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
+            output_table=output_table_ident,
+        )
+    )
+    cur.execute(sql.SQL("ANALYZE {}").format(output_table_ident))
+    logger.info("Table indexed and analyzed")
+    track_table_version(cur, output_table)
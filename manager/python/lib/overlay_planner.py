@@ -0,0 +1,178 @@
+from typing import NamedTuple
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor
+
+from utils import logger
+
+Extent = tuple[float, float, float, float]
+
+
+class TableEstimate(NamedTuple):
+    rows: float
+    extent: Extent | None
+
+
+def estimate_table(cur: cursor, table: str) -> TableEstimate:
+    """
+    Estimates the row count and extent of the table from the planner statistics,
+    analyzing it first when it was never analyzed.
+    """
+    cur.execute(
+        "SELECT reltuples FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = %s",
+        [table],
+    )
+    (rows,) = cur.fetchone()
+    if rows < 0:
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table)))
+        cur.execute(
+            "SELECT reltuples FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = %s",
+            [table],
+        )
+        (rows,) = cur.fetchone()
+
+    cur.execute(
+        "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM ST_EstimatedExtent('public', %s, 'geom') e",
+        [table],
+    )
+    extent = cur.fetchone()
+    if extent[0] is None:
+        cur.execute(
+            sql.SQL(
+                "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(geom) e FROM {}) s"
+            ).format(sql.Identifier(table))
+        )
+        extent = cur.fetchone()
+    return TableEstimate(max(rows, 0), extent if extent[0] is not None else None)
+
+
+def intersect_extents(a: Extent | None, b: Extent | None) -> Extent | None:
+    if a is None or b is None:
+        return None
+    xmin, ymin = max(a[0], b[0]), max(a[1], b[1])
+    xmax, ymax = min(a[2], b[2]), min(a[3], b[3])
+    if xmin > xmax or ymin > ymax:
+        return None
+    return (xmin, ymin, xmax, ymax)
+
+
+def overlap_fraction(extent: Extent | None, other: Extent | None) -> float:
+    """
+    Returns the fraction of the extent that is overlapped by the other extent.
+    """
+    overlap = intersect_extents(extent, other)
+    if overlap is None:
+        return 0.0
+    # degenerate extents (a single point, a straight line) are either in or out
+    fractions = [
+        (
+            (overlap[2] - overlap[0]) / (extent[2] - extent[0])
+            if extent[2] > extent[0]
+            else 1.0
+        ),
+        (
+            (overlap[3] - overlap[1]) / (extent[3] - extent[1])
+            if extent[3] > extent[1]
+            else 1.0
+        ),
+    ]
+    return fractions[0] * fractions[1]
+
+
+def estimate_intersection(a: TableEstimate, b: TableEstimate) -> TableEstimate:
+    """
+    Estimates the intersection of two inputs, assuming features are spread
+    uniformly over their extent. Only the features inside the common extent can
+    take part, and an overlay outputs about as many pieces as it has inputs.
+    """
+    overlap = intersect_extents(a.extent, b.extent)
+    rows = a.rows * overlap_fraction(a.extent, overlap) + b.rows * overlap_fraction(
+        b.extent, overlap
+    )
+    return TableEstimate(rows, overlap)
+
+
+def plan_intersection_order(cur: cursor, tables: list[str]) -> list[str]:
+    """
+    Orders the inputs of an intersection so that the intermediate results stay
+    small: the pair with the smallest estimated intersection first, then greedily
+    the input that keeps the next intermediate the smallest.
+    """
+    estimates = {table: estimate_table(cur, table) for table in tables}
+    first_pair = min(
+        ((a, b) for i, a in enumerate(tables) for b in tables[i + 1 :]),
+        key=lambda pair: estimate_intersection(
+            estimates[pair[0]], estimates[pair[1]]
+        ).rows,
+    )
+    order = list(first_pair)
+    intermediate = estimate_intersection(
+        estimates[first_pair[0]], estimates[first_pair[1]]
+    )
+    remaining = [table for table in tables if table not in first_pair]
+    while remaining:
+        next_table = min(
+            remaining,
+            key=lambda table: estimate_intersection(
+                intermediate, estimates[table]
+            ).rows,
+        )
+        intermediate = estimate_intersection(intermediate, estimates[next_table])
+        order.append(next_table)
+        remaining.remove(next_table)
+
+    logger.info(f"Intersection order: {', '.join(order)}")
+    return order
+
+
+def plan_difference_order(cur: cursor, tables: list[str]) -> list[str]:
+    """
+    Orders the subtracted inputs of a difference, the first input is kept first.
+    Inputs covering more of the first input are subtracted earlier, so that the
+    intermediate results shrink as soon as possible, and inputs that cannot
+    overlap it are left out.
+    """
+    estimates = {table: estimate_table(cur, table) for table in tables}
+    base_extent = estimates[tables[0]].extent
+    overlaps = {
+        table: overlap_fraction(base_extent, estimates[table].extent)
+        for table in tables[1:]
+    }
+    order = [tables[0]] + sorted(
+        (table for table in tables[1:] if overlaps[table] > 0),
+        key=lambda table: overlaps[table],
+        reverse=True,
+    )
+
+    logger.info(f"Difference order: {', '.join(order)}")
+    return order
+
+
+def materialize_step(
+    cur: cursor,
+    step_table: str,
+    select_query: sql.Composable,
+    query_params: list | None = None,
+) -> int:
+    """
+    Stores an intermediate result as an indexed and analyzed temporary table,
+    dropped at the end of the transaction.
+
+    :return: Number of rows of the intermediate result
+    """
+    step_table_ident = sql.Identifier(step_table)
+    cur.execute(
+        sql.SQL(
+            "CREATE TEMP TABLE {step_table} ON COMMIT DROP AS {select_query}"
+        ).format(step_table=step_table_ident, select_query=select_query),
+        query_params,
+    )
+    row_count = cur.rowcount
+    cur.execute(
+        sql.SQL("CREATE INDEX ON {step_table} USING gist (geom)").format(
+            step_table=step_table_ident
+        )
+    )
+    cur.execute(sql.SQL("ANALYZE {}").format(step_table_ident))
+    logger.info(f"Materialized {step_table} with {row_count} rows")
+    return row_count
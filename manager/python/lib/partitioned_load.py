@@ -0,0 +1,145 @@
+import math
+from multiprocessing import get_context
+from typing import Iterator
+
+from osgeo import ogr
+
+from lib.fill_table import LoadStats, get_layer_loader, merge_load_stats
+from lib.get_header_info import HeaderInfo, get_gdal_dataset
+from utils import init_gdal_config, logger, pool
+
+# (kind, start, end or count) where kind is "index" for SetNextByIndex based
+# ranges and "fid" for attribute filtered FID ranges with open outer bounds
+LayerPartition = tuple[str, int | None, int | None]
+
+
+def get_layer_partitions(
+    layer: ogr.Layer,
+    feature_count: int,
+    partition_count: int,
+    allow_index_ranges: bool = True,
+) -> list[LayerPartition]:
+    size = math.ceil(feature_count / partition_count)
+    if allow_index_ranges and layer.TestCapability(ogr.OLCFastSetNextByIndex):
+        return [("index", start, size) for start in range(0, feature_count, size)]
+
+    # FIDs are not guaranteed to be dense, so the first and last ranges are left
+    # open and gaps only unbalance partitions instead of dropping features
+    layer.ResetReading()
+    first_feature = layer.GetNextFeature()
+    layer.ResetReading()
+    start_fid = first_feature.GetFID() if first_feature else 0
+    boundaries = [start_fid + size * i for i in range(1, partition_count)]
+    lower_bounds = [None] + boundaries
+    upper_bounds = boundaries + [None]
+    return [("fid", lo, hi) for lo, hi in zip(lower_bounds, upper_bounds)]
+
+
+def iterate_layer_range(layer: ogr.Layer, start: int, count: int) -> Iterator:
+    # iterating the layer directly would reset reading back to the first feature
+    layer.SetNextByIndex(start)
+    for _ in range(count):
+        feature = layer.GetNextFeature()
+        if feature is None:
+            break
+        yield feature
+
+
+def load_layer_partition(
+    dataset_args: tuple,
+    layer_index: int,
+    table_name: str,
+    header_info: HeaderInfo,
+    load_method: str,
+    srs_string: str | None,
+    source_srid: int | None,
+    partition: LayerPartition,
+) -> LoadStats:
+    # runs inside a spawned process, so it needs its own GDAL config, dataset
+    # handle and connection pool
+    init_gdal_config()
+    dataset = get_gdal_dataset(*dataset_args)
+    layer: ogr.Layer = dataset.GetLayerByIndex(layer_index)
+
+    kind, start, end = partition
+    if kind == "index":
+        features = iterate_layer_range(layer, start, end)
+    else:
+        conditions = []
+        if start is not None:
+            conditions.append(f"FID >= {start}")
+        if end is not None:
+            conditions.append(f"FID < {end}")
+        layer.SetAttributeFilter(" AND ".join(conditions))
+        features = layer
+
+    conn = pool.getconn()
+    try:
+        return get_layer_loader(load_method)(
+            features, header_info, conn, table_name, srs_string, source_srid
+        )
+    finally:
+        pool.putconn(conn)
+
+
+def load_layer_partitioned(
+    dataset_args: tuple,
+    layer: ogr.Layer,
+    layer_index: int,
+    table_name: str,
+    header_info: HeaderInfo,
+    load_method: str,
+    srs_string: str | None,
+    source_srid: int | None,
+    partition_count: int,
+) -> tuple[LoadStats, int]:
+    # the arrow reader consumes whole layers, so it can only be split by FID filter
+    partitions = get_layer_partitions(
+        layer,
+        header_info["num_features"],
+        partition_count,
+        load_method != "arrow",
+    )
+    logger.info(f"Loading {table_name} in {len(partitions)} partitions")
+
+    # spawn instead of fork, forked children would inherit the parent's pooled
+    # connections and GDAL handles
+    workers = get_context("spawn").Pool(len(partitions))
+    try:
+        results = [
+            workers.apply_async(
+                load_layer_partition,
+                (
+                    dataset_args,
+                    layer_index,
+                    table_name,
+                    header_info,
+                    load_method,
+                    srs_string,
+                    source_srid,
+                    partition,
+                ),
+            )
+            for partition in partitions
+        ]
+        # waits in short steps, a time limit interrupt is only raised between them
+        pending = results
+        while pending:
+            pending[0].wait(1)
+            pending = [result for result in pending if not result.ready()]
+            for result in results:
+                if result.ready() and not result.successful():
+                    # raises the error of the partition without waiting for others
+                    result.get()
+        load_stats = merge_load_stats([result.get() for result in results])
+        workers.close()
+    except BaseException:
+        # on a failure or time limit the running partitions are killed, which rolls
+        # back their open transactions before the caller drops the table
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+
+    logger.info(f"All {len(partitions)} partitions of {table_name} loaded")
+    return load_stats, len(partitions)
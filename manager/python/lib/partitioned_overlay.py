@@ -0,0 +1,263 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, NamedTuple
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor
+
+from lib.query_supervision import current_supervisor
+from utils import cap_pool_concurrency, logger, pool
+
+
+class GridTile(NamedTuple):
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+    # outer tiles are open ended, so no reference point falls outside the grid
+    first_column: bool
+    first_row: bool
+    last_column: bool
+    last_row: bool
+    column: int
+    row: int
+
+
+def get_geoprocessing_concurrency(additional_config: dict | None) -> int:
+    config = additional_config or {}
+    # every tile query holds a pooled connection, next to the ones of the actor,
+    # its progress reports and the broker
+    return cap_pool_concurrency(
+        int(config.get("concurrency", os.environ.get("GEOPROCESSING_CONCURRENCY", 4))),
+        reserved=3,
+    )
+
+
+def use_partitioned_overlay(
+    cur: cursor, tables: list[str], additional_config: dict | None
+) -> bool:
+    """
+    Returns whether the overlay should run tile by tile. Unless forced with the
+    "partitioned" option, this is decided from the estimated input row count.
+    """
+    partitioned = (additional_config or {}).get("partitioned", "auto")
+    if partitioned != "auto":
+        return bool(partitioned)
+
+    cur.execute(
+        "SELECT COALESCE(SUM(GREATEST(reltuples, 0)), 0) FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = ANY(%s)",
+        [tables],
+    )
+    (estimated_rows,) = cur.fetchone()
+    return estimated_rows >= int(
+        os.environ.get("GEOPROCESSING_PARTITION_MIN_ROWS", 100000)
+    )
+
+
+def get_grid_tiles(
+    cur: cursor, tables: str | list[str], grid_size: int
+) -> list[GridTile]:
+    """
+    Splits the extent of the tables into a grid of at most grid_size x grid_size
+    tiles. Column and row edges are quantiles of the feature lower left corners,
+    so each tile gets a similar number of features.
+    """
+    if isinstance(tables, str):
+        tables = [tables]
+    fractions = [i / grid_size for i in range(1, grid_size)]
+    cur.execute(
+        sql.SQL(""" SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e), xs, ys
+                FROM (
+                  SELECT ST_Extent(geom) e,
+                    percentile_cont(%(fractions)s::float8[]) WITHIN GROUP (ORDER BY ST_XMin(geom)) xs,
+                    percentile_cont(%(fractions)s::float8[]) WITHIN GROUP (ORDER BY ST_YMin(geom)) ys
+                  FROM ({features}) f
+                ) s """).format(
+            features=sql.SQL(" UNION ALL ").join(
+                sql.SQL("SELECT geom FROM {}").format(sql.Identifier(table))
+                for table in tables
+            )
+        ),
+        {"fractions": fractions},
+    )
+    xmin, ymin, xmax, ymax, x_cuts, y_cuts = cur.fetchone()
+    if xmin is None:
+        return []
+
+    x_edges = [xmin] + sorted(set(x_cuts or []) - {xmin, xmax}) + [xmax]
+    y_edges = [ymin] + sorted(set(y_cuts or []) - {ymin, ymax}) + [ymax]
+    return [
+        GridTile(
+            x_edges[col],
+            y_edges[row],
+            x_edges[col + 1],
+            y_edges[row + 1],
+            col == 0,
+            row == 0,
+            col == len(x_edges) - 2,
+            row == len(y_edges) - 2,
+            col,
+            row,
+        )
+        for col in range(len(x_edges) - 1)
+        for row in range(len(y_edges) - 1)
+    ]
+
+
+def tile_envelope(tile: GridTile) -> sql.Composable:
+    return sql.SQL("ST_MakeEnvelope({}, {}, {}, {}, 4326)").format(
+        sql.Literal(tile.xmin),
+        sql.Literal(tile.ymin),
+        sql.Literal(tile.xmax),
+        sql.Literal(tile.ymax),
+    )
+
+
+def tile_contains_point(
+    tile: GridTile, x: sql.Composable, y: sql.Composable
+) -> sql.Composable:
+    # half open tiles, a point on a shared edge belongs to the upper right tile
+    conditions = [sql.SQL("TRUE")]
+    if not tile.first_column:
+        conditions.append(sql.SQL("{} >= {}").format(x, sql.Literal(tile.xmin)))
+    if not tile.last_column:
+        conditions.append(sql.SQL("{} < {}").format(x, sql.Literal(tile.xmax)))
+    if not tile.first_row:
+        conditions.append(sql.SQL("{} >= {}").format(y, sql.Literal(tile.ymin)))
+    if not tile.last_row:
+        conditions.append(sql.SQL("{} < {}").format(y, sql.Literal(tile.ymax)))
+    return sql.SQL(" AND ").join(conditions)
+
+
+def tile_feature_filter(tile: GridTile, geom: sql.Composable) -> sql.Composable:
+    """
+    Selects the features owned by the tile, those whose bbox lower left corner
+    lies in it. Every feature is owned by exactly one tile.
+    """
+    return sql.SQL("{geom} && {envelope} AND {contains}").format(
+        geom=geom,
+        envelope=tile_envelope(tile),
+        contains=tile_contains_point(
+            tile,
+            sql.SQL("ST_XMin({})").format(geom),
+            sql.SQL("ST_YMin({})").format(geom),
+        ),
+    )
+
+
+def tile_pair_filter(
+    tile: GridTile, geom_a: sql.Composable, geom_b: sql.Composable
+) -> sql.Composable:
+    """
+    Selects the feature pairs owned by the tile, those whose bbox intersection
+    lower left corner lies in it. That corner is inside both bboxes, so both
+    features are found through the index and every pair is owned by one tile.
+    """
+    envelope = tile_envelope(tile)
+    return sql.SQL(
+        "{geom_a} && {envelope} AND {geom_b} && {envelope} AND {contains}"
+    ).format(
+        geom_a=geom_a,
+        geom_b=geom_b,
+        envelope=envelope,
+        contains=tile_contains_point(
+            tile,
+            sql.SQL("GREATEST(ST_XMin({}), ST_XMin({}))").format(geom_a, geom_b),
+            sql.SQL("GREATEST(ST_YMin({}), ST_YMin({}))").format(geom_a, geom_b),
+        ),
+    )
+
+
+def get_grid_size(additional_config: dict | None) -> int:
+    concurrency = get_geoprocessing_concurrency(additional_config)
+    return int(
+        (additional_config or {}).get(
+            "grid_size", math.ceil(math.sqrt(concurrency * 4))
+        )
+    )
+
+
+def run_concurrent_queries(
+    queries: list[sql.Composable],
+    concurrency: int,
+    query_params: list | None = None,
+    on_done: Callable[[int], None] | None = None,
+) -> int:
+    """
+    Runs the queries concurrently, each on its own pooled connection and
+    transaction. Pending queries are dropped as soon as one of them fails.
+
+    :param queries: Statements to run
+    :param concurrency: Maximum number of queries running at once
+    :param query_params: Parameters shared by every statement
+    :param on_done: Called with the number of finished queries
+    :return: Total number of affected rows
+    """
+
+    # tile connections share the time limit of the actor
+    supervisor = current_supervisor.get()
+
+    def run_query(query: sql.Composable) -> int:
+        query_conn = pool.getconn()
+        try:
+            if supervisor:
+                supervisor.attach(query_conn)
+            with query_conn:
+                with query_conn.cursor() as query_cur:
+                    query_cur.execute(query, query_params)
+                    return query_cur.rowcount
+        finally:
+            if supervisor:
+                supervisor.detach(query_conn)
+            pool.putconn(query_conn)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        futures = [executor.submit(run_query, query) for query in queries]
+        row_count = 0
+        for done, future in enumerate(as_completed(futures), 1):
+            row_count += future.result()
+            if on_done:
+                on_done(done)
+    finally:
+        # pending queries are dropped when one fails or the actor is interrupted
+        executor.shutdown(wait=False, cancel_futures=True)
+    return row_count
+
+
+def run_partitioned_overlay(
+    cur: cursor,
+    grid_table: str | list[str],
+    build_tile_query: Callable[[GridTile], sql.Composable],
+    additional_config: dict | None,
+    query_params: list | None = None,
+) -> dict:
+    """
+    Runs the overlay query of every grid tile concurrently, each on its own pooled
+    connection and transaction, inserting straight into the output table. The
+    output table must already be committed.
+
+    :param cur: Cursor used to compute the grid
+    :param grid_table: Table or tables whose features define the grid
+    :param build_tile_query: Returns the INSERT statement of a single tile
+    :param query_params: Parameters of the INSERT statement
+    :return: Partitioning stats
+    """
+    concurrency = get_geoprocessing_concurrency(additional_config)
+    tiles = get_grid_tiles(cur, grid_table, get_grid_size(additional_config))
+    logger.info(f"Running overlay in {len(tiles)} tiles")
+
+    row_count = run_concurrent_queries(
+        [build_tile_query(tile) for tile in tiles],
+        concurrency,
+        query_params,
+        lambda done: logger.info(f"Tile {done}/{len(tiles)} done"),
+    )
+    return {"tiles": len(tiles), "concurrency": concurrency, "rows": row_count}
+
+
+def drop_table(conn, table: str):
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+    conn.commit()
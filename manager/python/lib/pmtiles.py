@@ -0,0 +1,339 @@
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import shutil
+import struct
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Callable, Iterable, Iterator, NamedTuple
+
+HEADER_SIZE = 127
+# the header and the root directory must fit in the first 16 KiB
+ROOT_DIRECTORY_MAX_SIZE = 16384 - HEADER_SIZE
+# larger directories are split into leaves without trying to fit them in the root
+ROOT_DIRECTORY_MAX_ENTRIES = 16384
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+TILE_TYPE_PNG = 2
+# object name of the archive, under the raster-tiles/{layer_id}/ prefix
+TILE_ARCHIVE_NAME = "tiles.pmtiles"
+# scratch file record of a directory entry
+ENTRY_RECORD = struct.Struct("<4Q")
+# entries sorted in memory at once when assembling the archive
+SORT_RUN_ENTRIES = 1 << 20
+DEDUP_MAX_TILES = int(os.environ.get("PMTILES_DEDUP_MAX_TILES", 1 << 20))
+
+
+class Entry(NamedTuple):
+    tile_id: int
+    offset: int
+    length: int
+    # 0 for entries pointing to a leaf directory
+    run_length: int
+
+
+def zxy_to_tile_id(z: int, x: int, y: int) -> int:
+    """
+    Returns the PMTiles tile id, the position of the tile on the Hilbert curve
+    of its zoom level after all the tiles of the lower zoom levels.
+    """
+    tile_id = ((1 << (z * 2)) - 1) // 3
+    for level in range(z - 1, -1, -1):
+        size = 1 << level
+        rx = 1 if x & size else 0
+        ry = 1 if y & size else 0
+        tile_id += ((3 * rx) ^ ry) << (level * 2)
+        # rotate the quadrant
+        if ry == 0:
+            if rx == 1:
+                x = size - 1 - x
+                y = size - 1 - y
+            x, y = y, x
+    return tile_id
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def serialize_directory(entries: list[Entry]) -> bytes:
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_tile_id = 0
+    for entry in entries:
+        write_varint(buffer, entry.tile_id - last_tile_id)
+        last_tile_id = entry.tile_id
+    for entry in entries:
+        write_varint(buffer, entry.run_length)
+    for entry in entries:
+        write_varint(buffer, entry.length)
+    for i, entry in enumerate(entries):
+        # 0 means right after the previous entry
+        if i > 0 and entry.offset == entries[i - 1].offset + entries[i - 1].length:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, entry.offset + 1)
+    return gzip.compress(bytes(buffer))
+
+
+def iter_chunks(entries: Iterable[Entry], size: int) -> Iterator[list[Entry]]:
+    iterator = iter(entries)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def build_directories(
+    entries: Callable[[], Iterable[Entry]], leaves_file: BinaryIO
+) -> tuple[bytes, int]:
+    """
+    Serializes the entries into a root directory, split into leaf directories
+    written to leaves_file when the root directory would not fit in the first
+    16 KiB.
+
+    :param entries: Returns the sorted entries, called once for every pass
+    :return: Root directory and number of leaves
+    """
+    first_entries = list(itertools.islice(entries(), ROOT_DIRECTORY_MAX_ENTRIES + 1))
+    if len(first_entries) <= ROOT_DIRECTORY_MAX_ENTRIES:
+        root = serialize_directory(first_entries)
+        if len(root) <= ROOT_DIRECTORY_MAX_SIZE:
+            return root, 0
+
+    leaf_size = 4096
+    while True:
+        leaves_file.seek(0)
+        leaves_file.truncate()
+        root_entries = []
+        leaves_length = 0
+        for chunk in iter_chunks(entries(), leaf_size):
+            leaf = serialize_directory(chunk)
+            root_entries.append(Entry(chunk[0].tile_id, leaves_length, len(leaf), 0))
+            leaves_file.write(leaf)
+            leaves_length += len(leaf)
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_DIRECTORY_MAX_SIZE:
+            return root, len(root_entries)
+        leaf_size *= 2
+
+
+def write_entries(path: str, entries: Iterable[Entry]):
+    with open(path, "wb") as entries_file:
+        for entry in entries:
+            entries_file.write(ENTRY_RECORD.pack(*entry))
+
+
+def read_entries(path: str) -> Iterator[Entry]:
+    with open(path, "rb") as entries_file:
+        while chunk := entries_file.read(ENTRY_RECORD.size * 65536):
+            for values in ENTRY_RECORD.iter_unpack(chunk):
+                yield Entry(*values)
+
+
+def sort_entries(path: str) -> Iterator[Entry]:
+    """
+    Sorts the entries of a scratch file by tile id, in sorted runs of
+    SORT_RUN_ENTRIES merged back together, so they are never all in memory.
+    """
+    run_paths = []
+    try:
+        for chunk in iter_chunks(read_entries(path), SORT_RUN_ENTRIES):
+            run_path = f"{path}.{len(run_paths)}"
+            write_entries(run_path, sorted(chunk))
+            run_paths.append(run_path)
+        yield from heapq.merge(*(read_entries(run_path) for run_path in run_paths))
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+
+
+def merge_tile_runs(entries: Iterable[Entry]) -> Iterator[Entry]:
+    """
+    Collapses consecutive tile ids pointing to the same tile data into a
+    single entry with a run length.
+    """
+    last_entry = None
+    for entry in entries:
+        if (
+            last_entry
+            and entry.offset == last_entry.offset
+            and entry.tile_id == last_entry.tile_id + last_entry.run_length
+        ):
+            last_entry = last_entry._replace(run_length=last_entry.run_length + 1)
+            continue
+        if last_entry:
+            yield last_entry
+        last_entry = entry
+    if last_entry:
+        yield last_entry
+
+
+def tile_to_lon_lat(z: int, x: int, y: int) -> tuple[float, float]:
+    # north west corner of the tile
+    n = 2**z
+    lon = x / n * 360 - 180
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon, lat
+
+
+class PMTilesWriter:
+    """
+    Writes tiles into a PMTiles v3 archive. Tiles can be added in any order and
+    from several threads, their data and directory entries are appended to
+    scratch files and the archive is assembled once every tile is in, so memory
+    does not grow with the number of tiles.
+
+    Tile data is content addressed, a repeated tile is stored once and every
+    copy points to it. Consecutive copies collapse into a single directory entry.
+    Only the most recently seen DEDUP_MAX_TILES distinct tiles are remembered,
+    which keeps the frequent ones like blank or uniform tiles.
+    """
+
+    def __init__(self, path: str, tile_type: int = TILE_TYPE_PNG):
+        self.path = path
+        self.tile_type = tile_type
+        self.lock = threading.Lock()
+        self.data_path = f"{path}.data"
+        self.data_file = open(self.data_path, "wb")
+        self.data_length = 0
+        self.entries_path = f"{path}.entries"
+        self.entries_file = open(self.entries_path, "wb")
+        self.tile_count = 0
+        # offset and length of the recently seen distinct tiles, by SHA-256
+        self.contents: OrderedDict[bytes, tuple[int, int]] = OrderedDict()
+        self.unique_tiles = 0
+        self.duplicate_tiles = 0
+        self.duplicate_bytes = 0
+        # tile range of every zoom level, as [min_x, min_y, max_x, max_y]
+        self.tile_ranges: dict[int, list[int]] = {}
+
+    def add_tile(self, z: int, x: int, y: int, data: bytes):
+        tile_id = zxy_to_tile_id(z, x, y)
+        digest = hashlib.sha256(data).digest()
+        with self.lock:
+            content = self.contents.get(digest)
+            if content is None:
+                content = (self.data_length, len(data))
+                self.data_file.write(data)
+                self.data_length += len(data)
+                self.unique_tiles += 1
+                self.contents[digest] = content
+                if len(self.contents) > DEDUP_MAX_TILES:
+                    self.contents.popitem(last=False)
+            else:
+                self.contents.move_to_end(digest)
+                self.duplicate_tiles += 1
+                self.duplicate_bytes += len(data)
+            self.entries_file.write(ENTRY_RECORD.pack(tile_id, *content, 1))
+            self.tile_count += 1
+            tile_range = self.tile_ranges.setdefault(z, [x, y, x, y])
+            tile_range[0] = min(tile_range[0], x)
+            tile_range[1] = min(tile_range[1], y)
+            tile_range[2] = max(tile_range[2], x)
+            tile_range[3] = max(tile_range[3], y)
+
+    def close(self, metadata: dict | None = None) -> dict:
+        """
+        Assembles the archive, the scratch files are removed.
+
+        :return: Archive stats
+        """
+        self.data_file.close()
+        self.entries_file.close()
+        self.contents.clear()
+        directory_path = f"{self.path}.directory"
+        leaves_path = f"{self.path}.leaves"
+        try:
+            if not self.tile_count:
+                raise Exception("Tile archive does not have any tile")
+
+            # sorted and merged once, then read back for every directory pass
+            entry_count = 0
+            clustered = True
+            next_offset = 0
+            with open(directory_path, "wb") as directory_file:
+                for entry in merge_tile_runs(sort_entries(self.entries_path)):
+                    clustered = clustered and entry.offset == next_offset
+                    next_offset = entry.offset + entry.length
+                    directory_file.write(ENTRY_RECORD.pack(*entry))
+                    entry_count += 1
+
+            with open(leaves_path, "w+b") as leaves_file:
+                root, leaf_count = build_directories(
+                    lambda: read_entries(directory_path), leaves_file
+                )
+                leaves_length = leaves_file.tell()
+                metadata_bytes = gzip.compress(json.dumps(metadata or {}).encode())
+
+                min_zoom = min(self.tile_ranges)
+                max_zoom = max(self.tile_ranges)
+                min_x, min_y, max_x, max_y = self.tile_ranges[max_zoom]
+                min_lon, max_lat = tile_to_lon_lat(max_zoom, min_x, min_y)
+                max_lon, min_lat = tile_to_lon_lat(max_zoom, max_x + 1, max_y + 1)
+
+                metadata_offset = HEADER_SIZE + len(root)
+                leaves_offset = metadata_offset + len(metadata_bytes)
+                data_offset = leaves_offset + leaves_length
+                header = struct.pack(
+                    "<7sB11Q6B4iB2i",
+                    b"PMTiles",
+                    3,
+                    HEADER_SIZE,
+                    len(root),
+                    metadata_offset,
+                    len(metadata_bytes),
+                    leaves_offset,
+                    leaves_length,
+                    data_offset,
+                    self.data_length,
+                    self.tile_count,
+                    entry_count,
+                    self.unique_tiles,
+                    1 if clustered else 0,
+                    COMPRESSION_GZIP,
+                    COMPRESSION_NONE,
+                    self.tile_type,
+                    min_zoom,
+                    max_zoom,
+                    round(min_lon * 10000000),
+                    round(min_lat * 10000000),
+                    round(max_lon * 10000000),
+                    round(max_lat * 10000000),
+                    min_zoom,
+                    round((min_lon + max_lon) / 2 * 10000000),
+                    round((min_lat + max_lat) / 2 * 10000000),
+                )
+
+                with open(self.path, "wb") as archive:
+                    archive.write(header)
+                    archive.write(root)
+                    archive.write(metadata_bytes)
+                    leaves_file.seek(0)
+                    shutil.copyfileobj(leaves_file, archive)
+                    with open(self.data_path, "rb") as data_file:
+                        shutil.copyfileobj(data_file, archive)
+        finally:
+            for scratch_path in [
+                self.data_path,
+                self.entries_path,
+                directory_path,
+                leaves_path,
+            ]:
+                if os.path.exists(scratch_path):
+                    os.remove(scratch_path)
+
+        return {
+            "tiles": self.tile_count,
+            "unique_tiles": self.unique_tiles,
+            "duplicate_tiles": self.duplicate_tiles,
+            "duplicate_bytes": self.duplicate_bytes,
+            "directory_entries": entry_count,
+            "leaf_directories": leaf_count,
+            "bytes": data_offset + self.data_length,
+        }
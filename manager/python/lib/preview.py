@@ -0,0 +1,152 @@
+import time
+from typing import TypedDict
+
+from psycopg2 import sql
+from psycopg2.extensions import connection, cursor
+
+from utils import logger
+
+
+class PreviewRun(TypedDict):
+    sample_percent: float
+    bbox: list[float] | None
+    max_features: int
+    # sampled and full row count of every input table
+    inputs: dict[str, dict[str, float]]
+    started: float
+
+
+def get_preview_config(additional_config: dict | None) -> dict | None:
+    """
+    Returns the preview options of a run, None when it is not a preview. The
+    "preview" option is either true or an object with sample_percent, bbox
+    ([xmin, ymin, xmax, ymax] in EPSG:4326) and max_features.
+    """
+    preview = (additional_config or {}).get("preview")
+    if not preview:
+        return None
+    preview = preview if isinstance(preview, dict) else {}
+
+    bbox = preview.get("bbox")
+    if bbox is not None and (
+        not isinstance(bbox, list)
+        or len(bbox) != 4
+        or bbox[0] >= bbox[2]
+        or bbox[1] >= bbox[3]
+    ):
+        raise ValueError("preview bbox must be [xmin, ymin, xmax, ymax]")
+    sample_percent = float(preview.get("sample_percent", 5))
+    if not 0 < sample_percent <= 100:
+        raise ValueError("preview sample_percent must be between 0 and 100")
+
+    return {
+        "sample_percent": sample_percent,
+        "bbox": bbox,
+        "max_features": int(preview.get("max_features", 500)),
+    }
+
+
+def prepare_preview(
+    cur: cursor, input_tables: list[str], preview_config: dict
+) -> PreviewRun:
+    """
+    Replaces every input table with a temporary copy of a sample of it, either
+    the features in the preview bbox or a TABLESAMPLE of the table. Temporary
+    tables come first in the search path, so the geoprocessing SQL runs
+    unchanged on the samples. The copies are dropped at the end of the
+    transaction.
+    """
+    bbox = preview_config["bbox"]
+    inputs = {}
+    for table in input_tables:
+        table_ident = sql.Identifier(table)
+        if bbox:
+            sample_query = sql.SQL(
+                "SELECT * FROM {table} WHERE geom && ST_MakeEnvelope({xmin}, {ymin}, {xmax}, {ymax}, 4326)"
+            ).format(
+                table=sql.Identifier("public", table),
+                xmin=sql.Literal(bbox[0]),
+                ymin=sql.Literal(bbox[1]),
+                xmax=sql.Literal(bbox[2]),
+                ymax=sql.Literal(bbox[3]),
+            )
+        else:
+            sample_query = sql.SQL(
+                "SELECT * FROM {table} TABLESAMPLE SYSTEM ({percent}) REPEATABLE (0)"
+            ).format(
+                table=sql.Identifier("public", table),
+                percent=sql.Literal(preview_config["sample_percent"]),
+            )
+        cur.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE {table} ON COMMIT DROP AS {sample_query}"
+            ).format(table=table_ident, sample_query=sample_query)
+        )
+        sampled_rows = cur.rowcount
+        cur.execute(
+            sql.SQL("CREATE INDEX ON {table} USING gist (geom)").format(
+                table=table_ident
+            )
+        )
+        cur.execute(sql.SQL("ANALYZE {}").format(table_ident))
+        cur.execute(
+            "SELECT GREATEST(reltuples, 0) FROM pg_class WHERE relnamespace = 'public'::regnamespace AND relname = %s",
+            [table],
+        )
+        (full_rows,) = cur.fetchone()
+        inputs[table] = {"sampled_rows": sampled_rows, "rows": full_rows}
+    logger.info("Preview inputs sampled")
+
+    return {**preview_config, "inputs": inputs, "started": time.perf_counter()}
+
+
+def finish_preview(
+    conn: connection, cur: cursor, output_table: str, preview_run: PreviewRun
+) -> dict:
+    """
+    Builds the preview result from the output table, then rolls everything back
+    so no table or layer is left behind.
+
+    The full run time is extrapolated linearly from the largest sampling ratio
+    of the inputs, it is a rough estimate only.
+    """
+    elapsed = time.perf_counter() - preview_run["started"]
+    output_table_ident = sql.Identifier(output_table)
+    cur.execute(
+        sql.SQL("SELECT COUNT(*) FROM {}").format(output_table_ident),
+    )
+    (feature_count,) = cur.fetchone()
+    cur.execute(
+        sql.SQL(
+            """ SELECT json_build_object(
+                  'type', 'FeatureCollection',
+                  'features', COALESCE(json_agg(ST_AsGeoJSON(t.*, 'geom', 6)::json), '[]'::json)
+                )
+                FROM (SELECT * FROM {output_table} ORDER BY ogc_fid LIMIT %s) t """
+        ).format(output_table=output_table_ident),
+        [preview_run["max_features"]],
+    )
+    (geojson,) = cur.fetchone()
+
+    scale = max(
+        (
+            table_input["rows"] / table_input["sampled_rows"]
+            for table_input in preview_run["inputs"].values()
+            if table_input["sampled_rows"] > 0
+        ),
+        default=None,
+    )
+    conn.rollback()
+    logger.info("Preview finished, changes rolled back")
+
+    return {
+        "preview": {
+            "geojson": geojson,
+            "feature_count": feature_count,
+            "inputs": preview_run["inputs"],
+            "elapsed_seconds": round(elapsed, 3),
+            "estimated_seconds": (
+                round(elapsed * max(scale, 1), 1) if scale is not None else None
+            ),
+        }
+    }
@@ -0,0 +1,148 @@
+import threading
+import time
+from contextvars import ContextVar
+
+import dramatiq
+from dramatiq.middleware import CurrentMessage
+from psycopg2.extensions import connection, cursor
+
+from utils import logger
+
+DEFAULT_TIME_LIMIT = 1800000
+SLOW_STATEMENT_SECONDS = 1.0
+
+current_supervisor: ContextVar["QuerySupervisor | None"] = ContextVar(
+    "current_supervisor", default=None
+)
+
+
+def get_actor_time_limit() -> int:
+    """
+    Returns the time limit in milliseconds of the running actor.
+    """
+    message = CurrentMessage.get_current_message()
+    if message is not None:
+        time_limit = message.options.get("time_limit")
+        if time_limit is None:
+            actor = dramatiq.get_broker().get_actor(message.actor_name)
+            time_limit = actor.options.get("time_limit")
+        if time_limit:
+            return int(time_limit)
+    return DEFAULT_TIME_LIMIT
+
+
+class QuerySupervisor:
+    """
+    Keeps the database work of an actor within its time limit. Supervised
+    connections get a statement_timeout of the remaining time, which still
+    holds if the worker dies. A watchdog cancels every running statement once
+    the time limit is reached, since the time limit exception only reaches the
+    actor thread after the statement it waits on returns. Statement runtimes
+    are recorded.
+    """
+
+    def __init__(self, conn: connection, time_limit: int):
+        self.conn = conn
+        self.deadline = time.monotonic() + time_limit / 1000
+        self.timed_out = False
+        self.lock = threading.Lock()
+        self.running: set[connection] = set()
+        self.timings: list[tuple[float, str]] = []
+        self.cursor_factory = self.create_cursor_factory()
+        self.attach(conn)
+        self.watchdog = threading.Timer(time_limit / 1000, self.on_time_limit)
+        self.watchdog.daemon = True
+        self.watchdog.start()
+        self.token = current_supervisor.set(self)
+
+    def create_cursor_factory(self):
+        supervisor = self
+
+        class SupervisedCursor(cursor):
+            def execute(self, query, vars=None):
+                with supervisor.lock:
+                    supervisor.running.add(self.connection)
+                started = time.perf_counter()
+                try:
+                    return super().execute(query, vars)
+                finally:
+                    duration = time.perf_counter() - started
+                    with supervisor.lock:
+                        supervisor.running.discard(self.connection)
+                    supervisor.record(self, query, duration)
+
+        return SupervisedCursor
+
+    def record(self, cur: cursor, query, duration: float):
+        statement = query if isinstance(query, str) else query.as_string(cur)
+        statement = " ".join(statement.split())[:200]
+        with self.lock:
+            self.timings.append((duration, statement))
+        if duration >= SLOW_STATEMENT_SECONDS:
+            logger.info(f"Statement took {duration:.1f}s: {statement}")
+
+    def attach(self, conn: connection):
+        remaining = max(1000, int((self.deadline - time.monotonic()) * 1000))
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT set_config('statement_timeout', %s, false)", [str(remaining)]
+            )
+        conn.commit()
+        conn.cursor_factory = self.cursor_factory
+
+    def detach(self, conn: connection):
+        conn.cursor_factory = None
+        try:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("RESET statement_timeout")
+            conn.commit()
+        except Exception as err:
+            logger.warning(f"Failed to reset statement timeout: {err}")
+
+    def cancel_running(self):
+        # same as pg_cancel_backend, without needing another connection
+        with self.lock:
+            running = list(self.running)
+        for conn in running:
+            try:
+                conn.cancel()
+                logger.warning(f"Cancelled backend {conn.get_backend_pid()}")
+            except Exception as err:
+                logger.warning(f"Failed to cancel backend: {err}")
+
+    def on_time_limit(self):
+        self.timed_out = True
+        logger.warning("Time limit reached, cancelling running statements")
+        self.cancel_running()
+
+    def stop(self):
+        """
+        Stops supervising. Statements still running on other connections, like
+        the tile workers of an interrupted partitioned run, are cancelled. Those
+        connections are detached by their own thread.
+        """
+        self.watchdog.cancel()
+        self.cancel_running()
+        current_supervisor.reset(self.token)
+        self.detach(self.conn)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            timings = sorted(self.timings, reverse=True)
+        return {
+            "statements": len(timings),
+            "total_seconds": round(sum(duration for duration, _ in timings), 3),
+            "slowest": [
+                {"seconds": round(duration, 3), "statement": statement}
+                for duration, statement in timings[:5]
+            ],
+        }
+
+
+def supervise_queries(conn: connection) -> QuerySupervisor:
+    """
+    Starts supervising the queries of the running actor on the connection. The
+    returned supervisor must be stopped before the connection is put back.
+    """
+    return QuerySupervisor(conn, get_actor_time_limit())
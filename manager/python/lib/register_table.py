@@ -45,6 +45,7 @@ def register_table_to_directus(
     additional_config: dict | None,
     with_invalidate: bool = True,
     kml_style_id: int | None = None,
+    bounds: list[float] | None = None,
 ):
     layer_alias = None
     listed = False
@@ -105,16 +106,18 @@ def register_table_to_directus(
                     case "POINT" | "MULTIPOINT":
                         circle_style = kml_style_id
 
-            # Calculate bbox from PostGIS using ST_Extent
-            cur.execute(f"SELECT ST_Extent(geom) FROM {table_name}")
-            bbox_result = cur.fetchone()
-            if bbox_result is None or bbox_result[0] is None:
-                raise Exception(f"Could not calculate bbox for table: {table_name}")
-
-            bbox_str = bbox_result[0]
-            bbox_str_clean = bbox_str.replace("BOX(", "").replace(")", "")
-            bbox_values = bbox_str_clean.replace(",", " ").split()
-            lon_min, lat_min, lon_max, lat_max = map(float, bbox_values)
+            if bounds is not None:
+                # bounds accumulated while loading the table
+                lon_min, lat_min, lon_max, lat_max = bounds
+            else:
+                # Calculate bbox from PostGIS using ST_Extent
+                cur.execute(
+                    f"SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(geom) e FROM {table_name}) t"
+                )
+                bbox_result = cur.fetchone()
+                if bbox_result is None or bbox_result[0] is None:
+                    raise Exception(f"Could not calculate bbox for table: {table_name}")
+                lon_min, lat_min, lon_max, lat_max = bbox_result
             bbox_polygon = create_bbox_polygon(lon_min, lat_min, lon_max, lat_max)
 
             # Insert data into vector_tiles table
@@ -173,6 +176,7 @@ def register_raster_tile(
     is_terrain: bool,
     cog_file: str | None,
     additional_config: dict | None,
+    tile_archive: str | None = None,
 ):
     listed = False
     permission_type = "admin"
@@ -197,8 +201,8 @@ def register_raster_tile(
     with conn:
         with conn.cursor() as cur:
             cur.execute(
-                """INSERT INTO raster_tiles(layer_id, layer_alias, bounds, minzoom, maxzoom, terrain_rgb, protocol, color_steps, cog_file, user_created, listed, permission_type, preview, description)
-            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                """INSERT INTO raster_tiles(layer_id, layer_alias, bounds, minzoom, maxzoom, terrain_rgb, protocol, color_steps, cog_file, user_created, listed, permission_type, preview, description, tile_archive)
+            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
                 [
                     layer_id,
                     raster_alias,
@@ -214,6 +218,7 @@ def register_raster_tile(
                     permission_type,
                     preview,
                     description,
+                    tile_archive,
                 ],
             )
             if allowed_role:
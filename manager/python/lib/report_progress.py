@@ -0,0 +1,28 @@
+from dramatiq.middleware import CurrentMessage
+
+from utils import logger, pool
+
+
+def report_progress(status: str):
+    """
+    Shows the progress of the running actor as the status of its queue message,
+    until the actor result replaces it with success or error.
+    """
+    logger.info(status)
+    message = CurrentMessage.get_current_message()
+    if message is None:
+        return
+
+    # own connection, the actor transaction is not committed yet
+    conn = pool.getconn()
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "UPDATE geoprocessing_queue SET status=%s WHERE message_id=%s AND result IS NULL",
+                    [status, message.message_id],
+                )
+    except Exception as err:
+        logger.warning(f"Failed to report progress: {err}")
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+
+from psycopg2 import sql
+from psycopg2.extensions import cursor
+
+from lib.output_table import create_output_table
+from lib.parse_filter import parse_filter
+from utils import logger
+
+# bump whenever an actor changes its output for the same inputs
+RESULT_CACHE_VERSION = 2
+RESULT_CACHE_SCHEMA = "geoprocessing_cache"
+RESULT_CACHE_MAX_BYTES = int(
+    os.environ.get("GEOPROCESSING_RESULT_CACHE_MAX_BYTES", 5 * 1024**3)
+)
+# options that only change how a result is computed, not the result itself
+EXECUTION_CONFIG_KEYS = {
+    "concurrency",
+    "grid_size",
+    "partitioned",
+    "strategy",
+    "subdivide_max_vertices",
+    "unlogged_output",
+    "use_cache",
+}
+
+
+def is_result_cache_enabled(additional_config: dict | None = None) -> bool:
+    return (
+        os.environ.get("GEOPROCESSING_RESULT_CACHE_ENABLED", "true").lower() == "true"
+        and RESULT_CACHE_MAX_BYTES > 0
+        and bool((additional_config or {}).get("use_cache", True))
+    )
+
+
+def get_table_version(cur: cursor, table: str) -> list | None:
+    """
+    Returns a version stamp of the table, which changes whenever the table is
+    recreated or rewritten, or a statement writing to it commits. Tables without
+    the version trigger, like the ones not created by the worker, have none.
+    """
+    cur.execute(
+        """ SELECT c.oid::bigint, c.relfilenode::bigint, v.version
+            FROM pg_class c
+            JOIN pg_trigger t ON t.tgrelid = c.oid AND t.tgname = 'on_geoprocessing_table_write'
+            JOIN geoprocessing_table_versions v ON v.table_oid = c.oid
+            WHERE c.relnamespace = 'public'::regnamespace AND c.relname = %s """,
+        [table],
+    )
+    version = cur.fetchone()
+    if version is None:
+        return None
+    return list(version)
+
+
+def canonicalize_filter(
+    cur: cursor, table_name: str, filter: list[dict] | None
+) -> list[str]:
+    # conditions are ANDed, so their order does not matter
+    if not filter:
+        return []
+    return sorted(
+        condition.as_string(cur) for condition in parse_filter(table_name, filter)
+    )
+
+
+def get_result_cache_key(
+    cur: cursor,
+    actor: str,
+    params: dict,
+    input_tables: list[str],
+    additional_config: dict | None = None,
+) -> str | None:
+    """
+    Returns the cache key of a geoprocessing run, from the actor, its
+    parameters, the options affecting its result and the version of each input
+    table. Returns None when the result should not be cached.
+    """
+    if not is_result_cache_enabled(additional_config):
+        return None
+
+    versions = {}
+    for table in input_tables:
+        version = get_table_version(cur, table)
+        if version is None:
+            return None
+        versions[table] = version
+
+    payload = json.dumps(
+        {
+            "version": RESULT_CACHE_VERSION,
+            "actor": actor,
+            "params": params,
+            "config": {
+                key: value
+                for key, value in (additional_config or {}).items()
+                if key not in EXECUTION_CONFIG_KEYS
+            },
+            "inputs": versions,
+        },
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def clone_cached_result(
+    cur: cursor, cache_key: str, output_table: str, unlogged: bool = False
+) -> bool:
+    """
+    Creates the output table from the cached result of the key, if any.
+
+    :return: Whether the result was found in the cache
+    """
+    # locked, so the entry cannot be evicted while it is being copied
+    cur.execute(
+        "SELECT cache_table FROM geoprocessing_result_cache WHERE cache_key=%s FOR SHARE",
+        [cache_key],
+    )
+    row = cur.fetchone()
+    if row is None:
+        return False
+    (cache_table,) = row
+
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_schema=%s AND table_name=%s AND column_name NOT IN ('ogc_fid','geom') ORDER BY ordinal_position",
+        [RESULT_CACHE_SCHEMA, cache_table],
+    )
+    columns = [column_name for (column_name,) in cur.fetchall()]
+    create_output_table(
+        cur,
+        output_table,
+        columns,
+        sql.SQL("SELECT {columns}geom FROM {cache_table} ORDER BY ogc_fid").format(
+            columns=sql.SQL("").join(
+                sql.SQL("{},").format(sql.Identifier(column)) for column in columns
+            ),
+            cache_table=sql.Identifier(RESULT_CACHE_SCHEMA, cache_table),
+        ),
+        unlogged=unlogged,
+    )
+    cur.execute(
+        "UPDATE geoprocessing_result_cache SET hits=hits+1, last_used=CURRENT_TIMESTAMP WHERE cache_key=%s",
+        [cache_key],
+    )
+    logger.info(f"Result cloned from cache {cache_table}")
+    return True
+
+
+def store_cached_result(cur: cursor, cache_key: str, actor: str, output_table: str):
+    """
+    Keeps a private copy of the output table as the cached result of the key,
+    then evicts the least recently used results over the storage budget.
+    """
+    cache_table = f"result_{cache_key[:40]}"
+    cur.execute(
+        "SELECT pg_table_size(%s::regclass)",
+        [sql.Identifier(output_table).as_string(cur)],
+    )
+    (result_bytes,) = cur.fetchone()
+    if result_bytes > RESULT_CACHE_MAX_BYTES:
+        # would be evicted right after being copied
+        logger.info(f"Result of {result_bytes} bytes is over the cache budget")
+        return
+
+    cur.execute(
+        "INSERT INTO geoprocessing_result_cache (cache_key,actor,cache_table) VALUES (%s,%s,%s) ON CONFLICT (cache_key) DO NOTHING RETURNING cache_key",
+        [cache_key, actor, cache_table],
+    )
+    if cur.fetchone() is None:
+        # cached meanwhile by an identical run
+        return
+
+    cache_table_ident = sql.Identifier(RESULT_CACHE_SCHEMA, cache_table)
+    cur.execute(
+        sql.SQL("CREATE TABLE {cache_table} AS SELECT * FROM {output_table}").format(
+            cache_table=cache_table_ident,
+            output_table=sql.Identifier(output_table),
+        )
+    )
+    cur.execute(
+        "UPDATE geoprocessing_result_cache SET size_bytes=pg_total_relation_size(%s::regclass) WHERE cache_key=%s",
+        [cache_table_ident.as_string(cur), cache_key],
+    )
+    logger.info(f"Result stored in cache {cache_table}")
+    evict_result_cache(cur)
+
+
+def evict_result_cache(cur: cursor):
+    cur.execute(
+        """ DELETE FROM geoprocessing_result_cache
+            WHERE cache_key IN (
+              SELECT cache_key
+              FROM (
+                SELECT cache_key, SUM(size_bytes) OVER (ORDER BY last_used DESC, cache_key) used_bytes
+                FROM geoprocessing_result_cache
+              ) s
+              WHERE used_bytes > %s
+            )
+            RETURNING cache_table """,
+        [RESULT_CACHE_MAX_BYTES],
+    )
+    for (cache_table,) in cur.fetchall():
+        cur.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(
+                sql.Identifier(RESULT_CACHE_SCHEMA, cache_table)
+            )
+        )
+        logger.info(f"Evicted {cache_table} from result cache")
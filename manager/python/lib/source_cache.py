@@ -0,0 +1,152 @@
+import hashlib
+import os
+import threading
+import time
+from tempfile import gettempdir
+from uuid import uuid4
+
+from utils import logger, minio_client
+
+SOURCE_CACHE_DIR = os.environ.get(
+    "SOURCE_CACHE_DIR", os.path.join(gettempdir(), "geodashboard_source_cache")
+)
+# soft limit, the cache can grow past it while every entry is within the grace
+# period, e.g. during a burst of large uploads
+SOURCE_CACHE_MAX_BYTES = int(os.environ.get("SOURCE_CACHE_MAX_BYTES", 10 * 1024**3))
+# entries used more recently than this are never evicted, another actor or a
+# partition process may still be opening them, lower it on small disks
+SOURCE_CACHE_GRACE_SECONDS = int(os.environ.get("SOURCE_CACHE_GRACE_SECONDS", 3600))
+
+# shared by every actor thread of the worker process
+cache_lock = threading.Lock()
+# lock of every object being fetched, with the number of threads using it
+key_locks: dict[str, tuple[threading.Lock, int]] = {}
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "downloaded_bytes": 0}
+
+
+def is_source_cache_enabled():
+    return (
+        os.environ.get("SOURCE_CACHE_ENABLED", "true").lower() == "true"
+        and SOURCE_CACHE_MAX_BYTES > 0
+    )
+
+
+def get_source_cache_stats(since: dict | None = None) -> dict:
+    """
+    Returns the source cache counters of the worker process. The counters are
+    cumulative, pass a snapshot taken when a run started to get the change since,
+    which also includes fetches of actors running concurrently in the process.
+    """
+    with cache_lock:
+        stats = dict(cache_stats)
+    if since is not None:
+        stats = {key: value - since.get(key, 0) for key, value in stats.items()}
+    return stats
+
+
+def get_storage_object_key(object_key: str):
+    storage_root = (
+        os.environ.get("STORAGE_S3_ROOT", "") + "/"
+        if os.environ.get("STORAGE_S3_ROOT")
+        else ""
+    )
+    return storage_root + object_key
+
+
+def evict_source_cache(keep_path: str):
+    entries = []
+    for entry in os.scandir(SOURCE_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".part"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    now = time.time()
+    # least recently used first
+    for mtime, size, path in sorted(entries):
+        if total_size <= SOURCE_CACHE_MAX_BYTES:
+            break
+        if path == keep_path or now - mtime < SOURCE_CACHE_GRACE_SECONDS:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+        with cache_lock:
+            cache_stats["evictions"] += 1
+        logger.info(f"Evicted {os.path.basename(path)} from source cache")
+
+    if total_size > SOURCE_CACHE_MAX_BYTES:
+        logger.warning("Source cache is over quota, all entries are in use")
+
+
+def fetch_source_file(bucket: str, object_key: str) -> str:
+    """
+    Returns a local path of the storage object, downloading it only when the
+    object (identified by bucket, key and ETag) is not in the source cache yet.
+
+    :param bucket: Storage bucket
+    :param object_key: Object key, relative to STORAGE_S3_ROOT
+    :return: Local file path of the cached object
+    """
+    storage_key = get_storage_object_key(object_key)
+    object_stat = minio_client.stat_object(bucket, storage_key)
+    digest = hashlib.sha256(
+        f"{bucket}/{storage_key}:{object_stat.etag}".encode()
+    ).hexdigest()
+    # keep the extension, some GDAL drivers rely on it
+    cache_path = os.path.join(
+        SOURCE_CACHE_DIR, digest + os.path.splitext(object_key)[1].lower()
+    )
+
+    with cache_lock:
+        key_lock, users = key_locks.get(digest, (threading.Lock(), 0))
+        key_locks[digest] = (key_lock, users + 1)
+
+    try:
+        # concurrent requests for the same object wait for a single download
+        with key_lock:
+            if os.path.isfile(cache_path):
+                os.utime(cache_path)
+                with cache_lock:
+                    cache_stats["hits"] += 1
+                logger.info(f"Source cache hit for {object_key}")
+                return cache_path
+
+            os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+            part_path = f"{cache_path}.{uuid4().hex}.part"
+            try:
+                minio_client.fget_object(bucket, storage_key, part_path)
+                # atomic, other worker processes never see a partial file
+                os.replace(part_path, cache_path)
+            finally:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+            with cache_lock:
+                cache_stats["misses"] += 1
+                cache_stats["downloaded_bytes"] += object_stat.size
+            logger.info(f"Source cache miss for {object_key}")
+    finally:
+        # dropped by the last thread using it, so locks do not pile up
+        with cache_lock:
+            key_lock, users = key_locks[digest]
+            if users > 1:
+                key_locks[digest] = (key_lock, users - 1)
+            else:
+                del key_locks[digest]
+
+    evict_source_cache(cache_path)
+    return cache_path
+
+
+def get_source_path(bucket: str, object_key: str, is_zipped: bool = False) -> str:
+    """
+    Returns a GDAL path of the storage object, read from the local source cache
+    when enabled and streamed over /vsis3 otherwise.
+    """
+    if is_source_cache_enabled():
+        src_path = fetch_source_file(bucket, object_key)
+    else:
+        src_path = f"/vsis3/{bucket}/{get_storage_object_key(object_key)}"
+    return f"/vsizip/{src_path}" if is_zipped else src_path
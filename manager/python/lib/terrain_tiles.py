@@ -0,0 +1,200 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from tempfile import TemporaryDirectory
+from uuid import uuid4
+
+import numpy as np
+from osgeo import gdal
+
+from lib.dem_to_terrain_rgb import encode_terrain_rgb
+from lib.pmtiles import TILE_ARCHIVE_NAME, PMTilesWriter
+from lib.source_cache import get_source_path, get_storage_object_key
+from lib.tile_pyramid import add_tile_savings, get_tile_bounds, iter_tiles
+from lib.tile_raster_data import get_raster_bounds, get_zoom_range
+from utils import logger, minio_client
+
+TILE_SIZE = 256
+
+
+def encode_png(data: np.ndarray) -> bytes:
+    """
+    Encodes a band sequential byte array of shape (bands, rows, columns) to PNG.
+    """
+    band_count, height, width = data.shape
+    mem_ds: gdal.Dataset = gdal.GetDriverByName("MEM").Create(
+        "", width, height, band_count, gdal.GDT_Byte
+    )
+    mem_ds.WriteRaster(
+        0, 0, width, height, data.tobytes(), band_list=list(range(1, band_count + 1))
+    )
+    png_path = f"/vsimem/{uuid4().hex}.png"
+    try:
+        png_ds = gdal.GetDriverByName("PNG").CreateCopy(png_path, mem_ds)
+        png_ds = None
+        png_file = gdal.VSIFOpenL(png_path, "rb")
+        try:
+            return gdal.VSIFReadL(1, gdal.VSIStatL(png_path).size, png_file)
+        finally:
+            gdal.VSIFCloseL(png_file)
+    finally:
+        gdal.Unlink(png_path)
+
+
+def render_terrain_tile(
+    src_ds: gdal.Dataset, z: int, x: int, y: int, resample_alg: str = "bilinear"
+) -> bytes | None:
+    """
+    Warps the tile straight from the DEM and encodes it to a terrain-RGB PNG.
+    Pixels without data are transparent and encoded at elevation 0.
+
+    :param resample_alg: "average" below the native zoom of the DEM, so
+        downsampled elevations are not aliased
+    :return: PNG data, None when the tile has no data at all
+    """
+    tile_ds: gdal.Dataset = gdal.Warp(
+        "",
+        src_ds,
+        format="MEM",
+        dstSRS="EPSG:3857",
+        outputBounds=get_tile_bounds(z, x, y),
+        width=TILE_SIZE,
+        height=TILE_SIZE,
+        resampleAlg=resample_alg,
+        outputType=gdal.GDT_Float64,
+        dstAlpha=True,
+    )
+    alpha = np.frombuffer(
+        tile_ds.GetRasterBand(2).ReadRaster(buf_type=gdal.GDT_Byte), np.uint8
+    ).reshape(TILE_SIZE, TILE_SIZE)
+    if not alpha.any():
+        return None
+    elevation = np.frombuffer(
+        tile_ds.GetRasterBand(1).ReadRaster(), np.float64
+    ).reshape(TILE_SIZE, TILE_SIZE)
+    has_data = alpha > 0
+    rgb = encode_terrain_rgb(np.where(has_data, elevation, 0))
+    return encode_png(
+        np.concatenate((rgb, (has_data * 255).astype(np.uint8)[np.newaxis]))
+    )
+
+
+def tile_terrain_data(
+    bucket: str,
+    object_key: str,
+    min_zoom: int | None,
+    max_zoom: int | None,
+    output: str = "xyz",
+):
+    """
+    Tiles a DEM to terrain-RGB XYZ tiles. Every tile is warped straight from the
+    DEM, encoded and uploaded while the next ones are rendered, so no full size
+    intermediate raster is written and only a few tiles are held at once.
+
+    With the "pmtiles" output, tiles are appended to a local PMTiles archive
+    instead, uploaded as a single object at the end.
+
+    :return: Layer id, WGS84 bounds, zoom range and tiling stats
+    """
+    input_file = get_source_path(bucket, object_key)
+    src_ds: gdal.Dataset = gdal.Open(input_file)
+    if src_ds.GetSpatialRef() is None:
+        raise Exception("Raster doesn't have spatial reference system")
+    if src_ds.RasterCount != 1:
+        raise Exception("Raster must have single band")
+
+    layer_id = str(uuid4())
+    wgs84_bounds = get_raster_bounds(src_ds)
+    min_zoom, max_zoom = get_zoom_range(src_ds, min_zoom, max_zoom)
+    _, native_zoom = get_zoom_range(src_ds, None, None)
+    tiles_prefix = get_storage_object_key(f"raster-tiles/{layer_id}")
+
+    # GDAL datasets are not thread safe, every thread warps from its own handle
+    thread_datasets = threading.local()
+    stats = {"tiles": 0, "empty_tiles": 0, "bytes": 0, "objects": 0}
+    stats_lock = threading.Lock()
+
+    def process_tile(tile: tuple[int, int, int]):
+        if not hasattr(thread_datasets, "src_ds"):
+            thread_datasets.src_ds = gdal.Open(input_file)
+        z, x, y = tile
+        png = render_terrain_tile(
+            thread_datasets.src_ds,
+            z,
+            x,
+            y,
+            # warps read from the DEM overviews when it has some
+            "average" if z < native_zoom else "bilinear",
+        )
+        if png is None:
+            with stats_lock:
+                stats["empty_tiles"] += 1
+            return
+        if writer:
+            writer.add_tile(z, x, y, png)
+        else:
+            minio_client.put_object(
+                bucket,
+                f"{tiles_prefix}/{z}/{x}/{y}.png",
+                io.BytesIO(png),
+                len(png),
+                content_type="image/png",
+            )
+        with stats_lock:
+            stats["tiles"] += 1
+            stats["bytes"] += len(png)
+            if not writer:
+                stats["objects"] += 1
+
+    concurrency = int(os.environ.get("RASTER_TILING_CONCURRENCY", os.cpu_count()))
+    started = time.perf_counter()
+    with TemporaryDirectory(prefix="geodashboard_tiles_") as staging_dir:
+        writer = (
+            PMTilesWriter(os.path.join(staging_dir, TILE_ARCHIVE_NAME))
+            if output == "pmtiles"
+            else None
+        )
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # submitted as they are done, so tiles are never all queued in memory
+            pending = set()
+            for tile in iter_tiles(get_raster_bounds(src_ds, 3857), min_zoom, max_zoom):
+                if len(pending) >= concurrency * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(process_tile, tile))
+            for future in pending:
+                future.result()
+
+        if writer:
+            archive_stats = writer.close({"format": "png", "type": "baselayer"})
+            # large objects are uploaded in parts
+            minio_client.fput_object(
+                bucket,
+                f"{tiles_prefix}/{TILE_ARCHIVE_NAME}",
+                writer.path,
+                content_type="application/vnd.pmtiles",
+            )
+            stats.update(archive_stats)
+            stats["objects"] = 1
+        add_tile_savings(stats)
+    elapsed = time.perf_counter() - started
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["tiles_per_second"] = round(stats["tiles"] / elapsed, 1) if elapsed else None
+    stats["bytes_per_second"] = round(stats["bytes"] / elapsed) if elapsed else None
+    logger.info(
+        f"Terrain tiled with {stats['tiles']} tiles, {stats['empty_tiles']} empty tiles skipped"
+    )
+
+    return (
+        layer_id,
+        wgs84_bounds[1],
+        wgs84_bounds[0],
+        wgs84_bounds[3],
+        wgs84_bounds[2],
+        min_zoom,
+        max_zoom,
+        stats,
+    )
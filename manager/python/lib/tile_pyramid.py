@@ -0,0 +1,258 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+from typing import NamedTuple
+
+from osgeo import gdal
+
+from lib.pmtiles import TILE_ARCHIVE_NAME, PMTilesWriter
+from utils import init_gdal_config, logger, minio_client
+
+WEB_MERCATOR_EXTENT = 20037508.342789244
+# jobs of a zoom level are split by columns above this number of tiles
+TILES_PER_JOB = int(os.environ.get("RASTER_TILES_PER_JOB", 4096))
+
+
+class TileJob(NamedTuple):
+    zoom: int
+    min_x: int
+    max_x: int
+    min_y: int
+    max_y: int
+
+
+def get_tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """
+    Returns the EPSG:3857 bounds of an XYZ tile.
+    """
+    tile_span = 2 * WEB_MERCATOR_EXTENT / 2**z
+    xmin = -WEB_MERCATOR_EXTENT + x * tile_span
+    ymax = WEB_MERCATOR_EXTENT - y * tile_span
+    return (xmin, ymax - tile_span, xmin + tile_span, ymax)
+
+
+def get_tile_range(
+    bounds: tuple[float, float, float, float], z: int
+) -> tuple[int, int, int, int]:
+    """
+    Returns the first and last column and row of the XYZ tiles of the zoom
+    level covering the EPSG:3857 bounds.
+    """
+    tile_span = 2 * WEB_MERCATOR_EXTENT / 2**z
+    last_tile = 2**z - 1
+
+    def to_tile(offset: float) -> int:
+        return min(max(math.floor(offset / tile_span), 0), last_tile)
+
+    xmin, ymin, xmax, ymax = bounds
+    return (
+        to_tile(xmin + WEB_MERCATOR_EXTENT),
+        to_tile(WEB_MERCATOR_EXTENT - ymax),
+        # a bound on a tile edge does not reach into the next tile
+        to_tile(math.nextafter(xmax + WEB_MERCATOR_EXTENT, -math.inf)),
+        to_tile(math.nextafter(WEB_MERCATOR_EXTENT - ymin, -math.inf)),
+    )
+
+
+def iter_tiles(bounds: tuple[float, float, float, float], min_zoom: int, max_zoom: int):
+    for z in range(min_zoom, max_zoom + 1):
+        first_x, first_y, last_x, last_y = get_tile_range(bounds, z)
+        for x in range(first_x, last_x + 1):
+            for y in range(first_y, last_y + 1):
+                yield (z, x, y)
+
+
+def get_tile_jobs(
+    bounds: tuple[float, float, float, float],
+    min_zoom: int,
+    max_zoom: int,
+    concurrency: int,
+) -> list[TileJob]:
+    """
+    Splits the pyramid into one job per zoom level, large zoom levels into
+    column strips. The deepest zoom levels come first, so the largest jobs are
+    not left for last.
+    """
+    jobs = []
+    for z in range(max_zoom, min_zoom - 1, -1):
+        first_x, first_y, last_x, last_y = get_tile_range(bounds, z)
+        columns = last_x - first_x + 1
+        tile_count = columns * (last_y - first_y + 1)
+        strips = min(math.ceil(tile_count / TILES_PER_JOB), concurrency * 4, columns)
+        for i in range(max(strips, 1)):
+            jobs.append(
+                TileJob(
+                    z,
+                    first_x + i * columns // strips,
+                    first_x + (i + 1) * columns // strips - 1,
+                    first_y,
+                    last_y,
+                )
+            )
+    return jobs
+
+
+def render_tile_job(input_file: str, staging_dir: str, job: TileJob, threads: int):
+    # runs inside a spawned process, so it needs its own GDAL config
+    init_gdal_config()
+    gdal.Run(
+        "raster tile",
+        {
+            "input": input_file,
+            "output": staging_dir,
+            "min-zoom": job.zoom,
+            "max-zoom": job.zoom,
+            "min-x": job.min_x,
+            "max-x": job.max_x,
+            "min-y": job.min_y,
+            "max-y": job.max_y,
+            "num-threads": threads,
+            # fully transparent tiles are not written at all
+            "skip-blank": True,
+            "webviewer": "none",
+        },
+    )
+
+
+def add_tile_savings(stats: dict):
+    """
+    Adds the storage objects and bytes saved by skipping empty tiles and by
+    storing duplicate tiles once to the tiling stats.
+    """
+    rendered_tiles = stats["tiles"] + stats.get("empty_tiles", 0)
+    stats["savings"] = {
+        "objects": rendered_tiles - stats["objects"],
+        "bytes": stats.get("duplicate_bytes", 0),
+    }
+
+
+def upload_tile(bucket: str, object_key: str, path: str) -> int:
+    size = os.path.getsize(path)
+    minio_client.fput_object(bucket, object_key, path, content_type="image/png")
+    # staged tiles are removed right away, to keep the scratch space small
+    os.remove(path)
+    return size
+
+
+def tile_pyramid(
+    input_file: str,
+    bounds: tuple[float, float, float, float],
+    bucket: str,
+    tiles_prefix: str,
+    min_zoom: int,
+    max_zoom: int,
+    output: str = "xyz",
+) -> dict:
+    """
+    Renders the XYZ tile pyramid of the raster on a process pool into local
+    scratch space. Tiles of every finished job are uploaded by a thread pool
+    while the next jobs render, or appended to a PMTiles archive uploaded as a
+    single object once all are in.
+
+    :param bounds: EPSG:3857 bounds of the raster
+    :param tiles_prefix: Storage key of the pyramid, tiles are put under
+        {tiles_prefix}/{z}/{x}/{y}.png, an archive at
+        {tiles_prefix}/tiles.pmtiles
+    :param output: "xyz" for one object per tile, "pmtiles" for an archive
+    :return: Tiling stats, with throughput in tiles and bytes per second
+    """
+    concurrency = int(os.environ.get("RASTER_TILING_CONCURRENCY", os.cpu_count()))
+    upload_concurrency = int(os.environ.get("RASTER_TILE_UPLOAD_CONCURRENCY", 16))
+    jobs = get_tile_jobs(bounds, min_zoom, max_zoom, concurrency)
+    logger.info(f"Tiling in {len(jobs)} jobs")
+
+    started = time.perf_counter()
+    stats = {"jobs": len(jobs), "tiles": 0, "empty_tiles": 0, "bytes": 0, "objects": 0}
+    with TemporaryDirectory(
+        prefix="geodashboard_tiles_"
+    ) as staging_dir, ThreadPoolExecutor(
+        max_workers=upload_concurrency
+    ) as upload_executor, ProcessPoolExecutor(
+        # spawn instead of fork, forked children would inherit the parent's
+        # pooled connections and GDAL handles
+        max_workers=concurrency,
+        mp_context=get_context("spawn"),
+    ) as render_executor:
+        writer = (
+            PMTilesWriter(os.path.join(staging_dir, TILE_ARCHIVE_NAME))
+            if output == "pmtiles"
+            else None
+        )
+        render_futures = {
+            render_executor.submit(
+                render_tile_job,
+                input_file,
+                staging_dir,
+                job,
+                max(1, os.cpu_count() // concurrency),
+            ): job
+            for job in jobs
+        }
+        upload_futures = []
+        for render_future in as_completed(render_futures):
+            if render_future.exception():
+                # no point in rendering the remaining jobs
+                for pending_future in render_futures:
+                    pending_future.cancel()
+                render_future.result()
+            job = render_futures[render_future]
+            # the tiles of the job not written are the skipped blank ones
+            stats["empty_tiles"] += (job.max_x - job.min_x + 1) * (
+                job.max_y - job.min_y + 1
+            )
+            for x in range(job.min_x, job.max_x + 1):
+                column_dir = os.path.join(staging_dir, str(job.zoom), str(x))
+                if not os.path.isdir(column_dir):
+                    continue
+                for entry in os.scandir(column_dir):
+                    # only {y}.png, not the temporary files GDAL may leave
+                    y, extension = os.path.splitext(entry.name)
+                    if extension != ".png" or not y.isdigit():
+                        continue
+                    stats["empty_tiles"] -= 1
+                    if writer:
+                        with open(entry.path, "rb") as tile_file:
+                            writer.add_tile(job.zoom, x, int(y), tile_file.read())
+                        os.remove(entry.path)
+                        continue
+                    upload_futures.append(
+                        upload_executor.submit(
+                            upload_tile,
+                            bucket,
+                            f"{tiles_prefix}/{job.zoom}/{x}/{entry.name}",
+                            entry.path,
+                        )
+                    )
+        render_seconds = time.perf_counter() - started
+
+        for upload_future in upload_futures:
+            stats["bytes"] += upload_future.result()
+            stats["tiles"] += 1
+            stats["objects"] += 1
+
+        if writer:
+            archive_stats = writer.close({"format": "png", "type": "baselayer"})
+            # large objects are uploaded in parts
+            minio_client.fput_object(
+                bucket,
+                f"{tiles_prefix}/{TILE_ARCHIVE_NAME}",
+                writer.path,
+                content_type="application/vnd.pmtiles",
+            )
+            stats.update(archive_stats)
+            stats["objects"] = 1
+        add_tile_savings(stats)
+
+    elapsed = time.perf_counter() - started
+    stats["render_seconds"] = round(render_seconds, 3)
+    stats["elapsed_seconds"] = round(elapsed, 3)
+    stats["tiles_per_second"] = round(stats["tiles"] / elapsed, 1) if elapsed else None
+    stats["bytes_per_second"] = round(stats["bytes"] / elapsed) if elapsed else None
+    logger.info(f"Tiled {stats['tiles']} tiles at {stats['tiles_per_second']} tiles/s")
+    logger.info(
+        f"Skipped {stats['empty_tiles']} empty tiles, saved {stats['savings']['objects']} objects and {stats['savings']['bytes']} bytes"
+    )
+    return stats
@@ -5,6 +5,8 @@ from uuid import uuid4
 from minio.deleteobjects import DeleteObject
 from osgeo import gdal, osr
 
+from lib.source_cache import get_source_path
+from lib.tile_pyramid import tile_pyramid
 from utils import minio_client
 
 
@@ -34,13 +36,26 @@ def delete_generated_tiles(bucket: str, layer_id: str):
     return errors
 
 
-def tile_raster_data(
-    bucket: str,
-    min_zoom: int | None,
-    max_zoom: int | None,
-    object_key: str | None = None,
-    file_path: str | None = None,
-):
+def get_tile_output(additional_config: dict | None) -> str:
+    """
+    Returns how tiles are stored, "xyz" for one object per tile or "pmtiles"
+    for a single archive.
+    """
+    output = (additional_config or {}).get(
+        "tile_output", os.environ.get("RASTER_TILE_OUTPUT", "xyz")
+    )
+    if output not in ["xyz", "pmtiles"]:
+        raise Exception("Tile output must be xyz or pmtiles")
+    return output
+
+
+def get_zoom_range(
+    src_ds: gdal.Dataset, min_zoom: int | None, max_zoom: int | None
+) -> tuple[int, int]:
+    """
+    Validates the user defined zoom range, then fills in the undefined zoom
+    levels from the raster resolution.
+    """
     min_zoom = int(min_zoom) if min_zoom is not None else min_zoom
     max_zoom = int(max_zoom) if max_zoom is not None else max_zoom
 
@@ -50,39 +65,9 @@ def tile_raster_data(
         elif min_zoom > max_zoom:
             raise Exception("Min zoom must be lower than or equal to max_zoom")
 
-    layer_id = str(uuid4())
-    storage_root = (
-        os.environ.get("STORAGE_S3_ROOT", "") + "/"
-        if os.environ.get("STORAGE_S3_ROOT")
-        else ""
-    )
-    if object_key:
-        input_file = f"/vsis3/{bucket}/{storage_root}{object_key}"
-    elif file_path:
-        input_file = file_path
-    else:
-        raise Exception("Neither object_key nor file_path defined")
-    output_dir = f"/vsis3/{bucket}/{storage_root}raster-tiles/{layer_id}"
-    src_ds: gdal.Dataset = gdal.Open(input_file)
-
-    # Get bounds in WGS84
-    xmin, xres, _, ymax, _, yres = src_ds.GetGeoTransform()
-    xmax = xmin + (src_ds.RasterXSize * xres)
-    ymin = ymax + (src_ds.RasterYSize * yres)
-    src_srs: osr.SpatialReference = src_ds.GetSpatialRef()
-    wgs84_srs = osr.SpatialReference()
-    wgs84_srs.ImportFromEPSG(4326)
-    src2wgs84 = osr.CoordinateTransformation(src_srs, wgs84_srs)
-    wgs84_bounds: tuple[float, float, float, float] = src2wgs84.TransformBounds(
-        xmin, ymin, xmax, ymax, 21
-    )
-
-    del src2wgs84
-    del wgs84_srs
-    del src_srs
-
     # Determine min max zoom if not defined yet
     if min_zoom is None or max_zoom is None:
+        _, xres, _, _, _, _ = src_ds.GetGeoTransform()
         # Transform to web mercator and save it into in memory VRT to get pixel size
         vrt_ds: gdal.Dataset = gdal.Warp(
             "",
@@ -102,15 +87,61 @@ def tile_raster_data(
         if min_zoom > max_zoom:
             max_zoom = min_zoom
 
-    gdal.Run(
-        "raster tile",
-        {
-            "input": src_ds,
-            "output": output_dir,
-            "min-zoom": min_zoom,
-            "max-zoom": max_zoom,
-            "webviewer": "none",
-        },
+    return (min_zoom, max_zoom)
+
+
+def get_raster_bounds(
+    src_ds: gdal.Dataset, epsg: int = 4326
+) -> tuple[float, float, float, float]:
+    """
+    Returns the bounds of the raster in the given EPSG, in the axis order of
+    that EPSG (latitude first for EPSG:4326).
+    """
+    xmin, xres, _, ymax, _, yres = src_ds.GetGeoTransform()
+    xmax = xmin + (src_ds.RasterXSize * xres)
+    ymin = ymax + (src_ds.RasterYSize * yres)
+    src_srs: osr.SpatialReference = src_ds.GetSpatialRef()
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromEPSG(epsg)
+    src2dst = osr.CoordinateTransformation(src_srs, dst_srs)
+    return src2dst.TransformBounds(xmin, ymin, xmax, ymax, 21)
+
+
+def tile_raster_data(
+    bucket: str,
+    min_zoom: int | None,
+    max_zoom: int | None,
+    object_key: str | None = None,
+    file_path: str | None = None,
+    output: str = "xyz",
+):
+    layer_id = str(uuid4())
+    storage_root = (
+        os.environ.get("STORAGE_S3_ROOT", "") + "/"
+        if os.environ.get("STORAGE_S3_ROOT")
+        else ""
+    )
+    if object_key:
+        input_file = get_source_path(bucket, object_key)
+    elif file_path:
+        input_file = file_path
+    else:
+        raise Exception("Neither object_key nor file_path defined")
+    src_ds: gdal.Dataset = gdal.Open(input_file)
+
+    # Get bounds in WGS84
+    wgs84_bounds = get_raster_bounds(src_ds)
+    min_zoom, max_zoom = get_zoom_range(src_ds, min_zoom, max_zoom)
+
+    # rendered by a process pool into local scratch, then uploaded concurrently
+    tiling_stats = tile_pyramid(
+        input_file,
+        get_raster_bounds(src_ds, 3857),
+        bucket,
+        f"{storage_root}raster-tiles/{layer_id}",
+        min_zoom,
+        max_zoom,
+        output,
     )
 
     return (
@@ -121,4 +152,5 @@ def tile_raster_data(
         wgs84_bounds[2],
         min_zoom,
         max_zoom,
+        tiling_stats,
     )
@@ -9,7 +9,27 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import (
+    create_output_table,
+    finalize_output_table,
+    use_unlogged_output,
+)
 from lib.parse_filter import parse_filter
+from lib.partitioned_overlay import (
+    GridTile,
+    drop_table,
+    run_partitioned_overlay,
+    tile_feature_filter,
+    use_partitioned_overlay,
+)
+from lib.preview import finish_preview, get_preview_config, prepare_preview
+from lib.query_supervision import supervise_queries
+from lib.result_cache import (
+    canonicalize_filter,
+    clone_cached_result,
+    get_result_cache_key,
+    store_cached_result,
+)
 from utils import (
     logger,
     pool,
@@ -24,15 +44,32 @@ def clip(
     output_table: str,
     user_id: str,
     filter: list[dict] | None,
+    additional_config: dict | None = None,
 ):
     conn = None
+    supervisor = None
+    output_committed = False
+    partition_stats = None
+    parts_table = None
     try:
+        preview_config = get_preview_config(additional_config)
+        if preview_config:
+            # samples are temporary tables, only visible to this connection
+            additional_config = {
+                **additional_config,
+                "partitioned": False,
+                "use_cache": False,
+            }
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
                     cur, "Clip"
                 )
+                preview_run = None
+                if preview_config:
+                    preview_run = prepare_preview(cur, [input_table, clip_table], preview_config)
 
                 # fetch input table column names and types except geom
                 cur.execute(
@@ -57,79 +94,183 @@ def clip(
                     dim = 1
                 logger.info("Layer config fetched")
 
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [
-                        (
-                            f'"{column[0]}_old" {column[1]}'
-                            if column[0].startswith("ogc_fid")
-                            else f'"{column[0]}" {column[1]}'
-                        )
-                        for column in columns
-                    ]
-                    + ["geom geometry(Geometry, 4326)"]
-                )
                 output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
-                    )
+
+                # identical runs on unchanged inputs reuse the previous result
+                cache_key = get_result_cache_key(
+                    cur,
+                    "clip",
+                    {
+                        "input_table": input_table,
+                        "clip_table": clip_table,
+                        "filter": canonicalize_filter(cur, "i", filter),
+                    },
+                    [input_table, clip_table],
+                    additional_config,
                 )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
+                cache_hit = bool(cache_key) and clone_cached_result(
+                    cur, cache_key, output_table, use_unlogged_output(additional_config)
                 )
-                logger.info("Table created")
-
-                # insert data
-                cur.execute(
-                    sql.SQL(
-                        """ INSERT INTO {output_table} ({output_fields},geom)
-                            WITH u AS (
-                              SELECT ST_Union(geom) geom
-                              FROM {clip_table}
+                if not cache_hit:
+                    # split clip geometries into small indexed pieces, so every input
+                    # feature is only intersected with the few pieces it touches
+                    strategy = (additional_config or {}).get("strategy", "subdivide")
+                    if strategy == "subdivide":
+                        parts_table = f"tmp_clip_parts_{uuid4().hex}"
+                        cur.execute(
+                            sql.SQL(
+                                """ CREATE UNLOGGED TABLE {parts_table} AS
+                                    SELECT ST_Subdivide(geom, {max_vertices}) geom
+                                    FROM {clip_table}
+                                    WHERE NOT ST_IsEmpty(geom) """
+                            ).format(
+                                parts_table=sql.Identifier(parts_table),
+                                max_vertices=sql.Literal(
+                                    int(
+                                        (additional_config or {}).get(
+                                            "subdivide_max_vertices", 256
+                                        )
+                                    )
+                                ),
+                                clip_table=sql.Identifier(clip_table),
                             )
-                            SELECT *
-                            FROM (
-                              SELECT {input_fields},ST_Multi(CASE WHEN ST_Covers(u.geom,i.geom) THEN i.geom ELSE ST_CollectionExtract(ST_Intersection(u.geom,i.geom),{dim}) END) geom
-                              FROM {input_table} i
-                              INNER JOIN u ON ST_Intersects(u.geom,i.geom)
-                              {filter_query}
-                            ) clipped
-                            WHERE NOT ST_IsEmpty(geom) """
-                    ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            (
-                                sql.Identifier(column[0] + "_old")
-                                if column[0].startswith("ogc_fid")
-                                else sql.Identifier(column[0])
+                        )
+                        cur.execute(
+                            sql.SQL("CREATE INDEX ON {} USING gist (geom)").format(
+                                sql.Identifier(parts_table)
                             )
-                            for column in columns
-                        ),
-                        clip_table=sql.Identifier(clip_table),
-                        input_fields=sql.SQL(",").join(
-                            sql.Identifier(column[0]) for column in columns
-                        ),
-                        dim=sql.Literal(dim),
-                        input_table=sql.Identifier(input_table),
-                        filter_query=(
+                        )
+                        cur.execute(
+                            sql.SQL("ANALYZE {}").format(sql.Identifier(parts_table))
+                        )
+                        logger.info("Clip geometry subdivided")
+
+                    # insert data
+                    output_columns = [
+                        column[0] + "_old" if column[0].startswith("ogc_fid") else column[0]
+                        for column in columns
+                    ]
+                    unlogged = use_unlogged_output(additional_config)
+
+                    def build_select_query(tile: GridTile | None):
+                        filter_conditions = parse_filter("i", filter) if filter else []
+                        if tile is not None:
+                            filter_conditions.append(
+                                tile_feature_filter(tile, sql.SQL("i.geom"))
+                            )
+                        filter_query = (
                             sql.SQL("WHERE {}").format(
-                                sql.SQL(" AND ").join(parse_filter("i", filter))
+                                sql.SQL(" AND ").join(filter_conditions)
                             )
-                            if filter
+                            if filter_conditions
                             else sql.SQL("")
-                        ),
-                    )
-                )
+                        )
+                        input_fields = sql.SQL(",").join(
+                            sql.Identifier(column[0]) for column in columns
+                        )
+
+                        if strategy == "subdivide":
+                            # pieces covering the whole feature keep it untouched,
+                            # the others are intersected and reassembled per feature
+                            return sql.SQL(
+                                """ SELECT *
+                                    FROM (
+                                      SELECT {input_fields},ST_Multi(CASE WHEN c.covered THEN i.geom ELSE c.geom END) geom
+                                      FROM {input_table} i
+                                      CROSS JOIN LATERAL (
+                                        SELECT bool_or(ST_Covers(p.geom,i.geom)) covered,
+                                          ST_Union(CASE WHEN ST_Covers(p.geom,i.geom) THEN NULL ELSE ST_CollectionExtract(ST_Intersection(p.geom,i.geom),{dim}) END) geom
+                                        FROM {parts_table} p
+                                        WHERE ST_Intersects(p.geom,i.geom)
+                                      ) c
+                                      {filter_query}
+                                    ) clipped
+                                    WHERE NOT ST_IsEmpty(geom) """
+                            ).format(
+                                input_fields=input_fields,
+                                dim=sql.Literal(dim),
+                                input_table=sql.Identifier(input_table),
+                                parts_table=sql.Identifier(parts_table),
+                                filter_query=filter_query,
+                            )
+
+                        clip_filter = sql.SQL("")
+                        if tile is not None:
+                            # only the clip features around the features of the tile
+                            clip_filter = sql.SQL(
+                                "WHERE geom && (SELECT ST_Extent(x.geom) FROM {input_table} x WHERE {tile_filter})::geometry"
+                            ).format(
+                                input_table=sql.Identifier(input_table),
+                                tile_filter=tile_feature_filter(tile, sql.SQL("x.geom")),
+                            )
+                        return sql.SQL(
+                            """ WITH u AS (
+                                  SELECT ST_Union(geom) geom
+                                  FROM {clip_table}
+                                  {clip_filter}
+                                )
+                                SELECT *
+                                FROM (
+                                  SELECT {input_fields},ST_Multi(CASE WHEN ST_Covers(u.geom,i.geom) THEN i.geom ELSE ST_CollectionExtract(ST_Intersection(u.geom,i.geom),{dim}) END) geom
+                                  FROM {input_table} i
+                                  INNER JOIN u ON ST_Intersects(u.geom,i.geom)
+                                  {filter_query}
+                                ) clipped
+                                WHERE NOT ST_IsEmpty(geom) """
+                        ).format(
+                            clip_table=sql.Identifier(clip_table),
+                            clip_filter=clip_filter,
+                            input_fields=input_fields,
+                            dim=sql.Literal(dim),
+                            input_table=sql.Identifier(input_table),
+                            filter_query=filter_query,
+                        )
+
+                    def build_insert_query(tile: GridTile):
+                        return sql.SQL(
+                            "INSERT INTO {output_table} ({output_fields},geom) {select_query}"
+                        ).format(
+                            output_table=output_table_ident,
+                            output_fields=sql.SQL(",").join(
+                                sql.Identifier(column) for column in output_columns
+                            ),
+                            select_query=build_select_query(tile),
+                        )
+
+                    if use_partitioned_overlay(
+                        cur, [input_table, clip_table], additional_config
+                    ):
+                        # tile workers insert through their own connections into an
+                        # empty output table, indexed once they are done
+                        create_output_table(
+                            cur,
+                            output_table,
+                            output_columns,
+                            build_select_query(None),
+                            unlogged=unlogged,
+                            with_data=False,
+                        )
+                        conn.commit()
+                        output_committed = True
+                        partition_stats = run_partitioned_overlay(
+                            cur, input_table, build_insert_query, additional_config
+                        )
+                        finalize_output_table(cur, output_table, unlogged)
+                    else:
+                        create_output_table(
+                            cur,
+                            output_table,
+                            output_columns,
+                            build_select_query(None),
+                            unlogged=unlogged,
+                        )
+                    if cache_key:
+                        store_cached_result(cur, cache_key, "clip", output_table)
                 logger.info("New table created")
 
+                if preview_run:
+                    return finish_preview(conn, cur, output_table, preview_run)
+
                 # get new bounding box
                 cur.execute(
                     sql.SQL(
@@ -173,15 +314,37 @@ def clip(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        result = {"layer_id": layer_id, "cached": cache_hit}
+        if partition_stats:
+            result["partitions"] = partition_stats
+        result["queries"] = supervisor.get_stats()
+        return result
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if output_committed:
+            # tile queries still running would keep the output table locked
+            supervisor.cancel_running()
+            try:
+                drop_table(conn, output_table)
+            except Exception:
+                logger.error(traceback.format_exc())
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
+            if parts_table:
+                try:
+                    drop_table(conn, parts_table)
+                except Exception:
+                    logger.error(traceback.format_exc())
             pool.putconn(conn)
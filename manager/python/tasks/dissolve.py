@@ -1,3 +1,4 @@
+import math
 import traceback
 from uuid import uuid4
 
@@ -10,7 +11,26 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import create_output_table, use_unlogged_output
 from lib.parse_filter import parse_filter
+from lib.partitioned_overlay import (
+    drop_table,
+    get_geoprocessing_concurrency,
+    get_grid_size,
+    get_grid_tiles,
+    run_concurrent_queries,
+    tile_feature_filter,
+    use_partitioned_overlay,
+)
+from lib.preview import finish_preview, get_preview_config, prepare_preview
+from lib.query_supervision import supervise_queries
+from lib.report_progress import report_progress
+from lib.result_cache import (
+    canonicalize_filter,
+    clone_cached_result,
+    get_result_cache_key,
+    store_cached_result,
+)
 from utils import (
     logger,
     pool,
@@ -25,74 +45,204 @@ def dissolve(
     output_table: str,
     user_id: str,
     filter: list[dict] | None,
+    additional_config: dict | None = None,
 ):
     conn = None
+    supervisor = None
+    partition_stats = None
+    partials_table = None
     try:
+        preview_config = get_preview_config(additional_config)
+        if preview_config:
+            # samples are temporary tables, only visible to this connection
+            additional_config = {
+                **additional_config,
+                "partitioned": False,
+                "use_cache": False,
+            }
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
                     cur, "Dissolve"
                 )
+                preview_run = None
+                if preview_config:
+                    preview_run = prepare_preview(cur, [input_table], preview_config)
 
-                # fetch input table column names and types
-                cur.execute(
-                    sql.SQL(
-                        "SELECT column_name,data_type FROM information_schema.columns WHERE table_schema='public' AND table_name=%s AND column_name IN ({fields})"
-                    ).format(
-                        fields=sql.SQL(",").join(
-                            sql.Literal(field) for field in fields
-                        ),
-                    ),
+                # identical runs on unchanged inputs reuse the previous result
+                cache_key = get_result_cache_key(
+                    cur,
+                    "dissolve",
+                    {
+                        "input_table": input_table,
+                        "fields": fields,
+                        "filter": canonicalize_filter(cur, input_table, filter),
+                    },
                     [input_table],
+                    additional_config,
                 )
-                columns = cur.fetchall()
-                logger.info("Column types fetched")
-
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [f'"{column[0]}" {column[1]}' for column in columns]
-                    + ["geom geometry(Geometry, 4326)"]
+                cache_hit = bool(cache_key) and clone_cached_result(
+                    cur, cache_key, output_table, use_unlogged_output(additional_config)
                 )
-                output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
+                if not cache_hit:
+                    # insert data
+                    fields_sql = sql.SQL(",").join(
+                        sql.Identifier(field) for field in fields
                     )
-                )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
-                )
-                logger.info("Table created")
+                    filter_conditions = parse_filter(input_table, filter) if filter else []
+                    if use_partitioned_overlay(cur, [input_table], additional_config):
+                        # partial unions per grid cell, reduced level by level like a
+                        # quadtree until a single cell is left
+                        partials_table = f"tmp_dissolve_partials_{uuid4().hex}"
+                        partials_ident = sql.Identifier(partials_table)
+                        cur.execute(
+                            sql.SQL(
+                                "CREATE UNLOGGED TABLE {partials_table} AS SELECT {fields},0 AS tree_level,0 AS cell_x,0 AS cell_y,geom::geometry AS geom FROM {input_table} WITH NO DATA"
+                            ).format(
+                                partials_table=partials_ident,
+                                fields=fields_sql,
+                                input_table=sql.Identifier(input_table),
+                            )
+                        )
+                        cur.execute(
+                            sql.SQL(
+                                "CREATE INDEX ON {partials_table} (tree_level,cell_x,cell_y)"
+                            ).format(partials_table=partials_ident)
+                        )
 
-                # insert data
-                cur.execute(
-                    sql.SQL(
-                        "INSERT INTO {output_table} ({fields},geom) SELECT {fields},ST_Union(geom) geom FROM {input_table} {filter} GROUP BY {fields}"
-                    ).format(
-                        output_table=output_table_ident,
-                        fields=sql.SQL(",").join(
-                            sql.Identifier(field) for field in fields
-                        ),
-                        input_table=sql.Identifier(input_table),
-                        filter=(
-                            sql.SQL("WHERE {}").format(
-                                sql.SQL(" AND ").join(parse_filter(input_table, filter))
+                        concurrency = get_geoprocessing_concurrency(additional_config)
+                        tiles = get_grid_tiles(
+                            cur, input_table, get_grid_size(additional_config)
+                        )
+                        grid_columns = max((tile.column + 1 for tile in tiles), default=1)
+                        grid_rows = max((tile.row + 1 for tile in tiles), default=1)
+
+                        # every cell of every level is one step of the estimate
+                        total_steps = len(tiles)
+                        columns, rows = grid_columns, grid_rows
+                        while columns > 1 or rows > 1:
+                            columns, rows = math.ceil(columns / 2), math.ceil(rows / 2)
+                            total_steps += columns * rows
+                        completed_steps = 0
+
+                        def on_step_done(done: int):
+                            progress = min(
+                                99, math.floor(100 * (completed_steps + done) / total_steps)
                             )
-                            if filter
-                            else sql.SQL("")
-                        ),
-                    )
-                )
+                            report_progress(f"dissolving {progress}%")
+
+                        # workers insert through their own connections
+                        conn.commit()
+                        run_concurrent_queries(
+                            [
+                                sql.SQL(
+                                    "INSERT INTO {partials_table} ({fields},tree_level,cell_x,cell_y,geom) SELECT {fields},0,{cell_x},{cell_y},ST_Union(geom) FROM {input_table} WHERE {conditions} GROUP BY {fields}"
+                                ).format(
+                                    partials_table=partials_ident,
+                                    fields=fields_sql,
+                                    cell_x=sql.Literal(tile.column),
+                                    cell_y=sql.Literal(tile.row),
+                                    input_table=sql.Identifier(input_table),
+                                    conditions=sql.SQL(" AND ").join(
+                                        [
+                                            tile_feature_filter(
+                                                tile, sql.Identifier(input_table, "geom")
+                                            )
+                                        ]
+                                        + filter_conditions
+                                    ),
+                                )
+                                for tile in tiles
+                            ],
+                            concurrency,
+                            on_done=on_step_done,
+                        )
+                        completed_steps += len(tiles)
+
+                        level = 0
+                        columns, rows = grid_columns, grid_rows
+                        while columns > 1 or rows > 1:
+                            columns, rows = math.ceil(columns / 2), math.ceil(rows / 2)
+                            cur.execute(
+                                sql.SQL(
+                                    "SELECT DISTINCT cell_x/2,cell_y/2 FROM {partials_table} WHERE tree_level=%s"
+                                ).format(partials_table=partials_ident),
+                                [level],
+                            )
+                            parent_cells = cur.fetchall()
+                            run_concurrent_queries(
+                                [
+                                    sql.SQL(
+                                        "INSERT INTO {partials_table} ({fields},tree_level,cell_x,cell_y,geom) SELECT {fields},{parent_level},{cell_x},{cell_y},ST_Union(geom) FROM {partials_table} WHERE tree_level={level} AND cell_x/2={cell_x} AND cell_y/2={cell_y} GROUP BY {fields}"
+                                    ).format(
+                                        partials_table=partials_ident,
+                                        fields=fields_sql,
+                                        parent_level=sql.Literal(level + 1),
+                                        level=sql.Literal(level),
+                                        cell_x=sql.Literal(cell_x),
+                                        cell_y=sql.Literal(cell_y),
+                                    )
+                                    for cell_x, cell_y in parent_cells
+                                ],
+                                concurrency,
+                                on_done=on_step_done,
+                            )
+                            completed_steps += columns * rows
+
+                            # reduced partials are not needed anymore
+                            cur.execute(
+                                sql.SQL(
+                                    "DELETE FROM {partials_table} WHERE tree_level=%s"
+                                ).format(partials_table=partials_ident),
+                                [level],
+                            )
+                            conn.commit()
+                            level += 1
+
+                        create_output_table(
+                            cur,
+                            output_table,
+                            fields,
+                            sql.SQL(
+                                "SELECT {fields},geom FROM {partials_table} WHERE tree_level=%s"
+                            ).format(fields=fields_sql, partials_table=partials_ident),
+                            [level],
+                            unlogged=use_unlogged_output(additional_config),
+                        )
+                        partition_stats = {
+                            "tiles": len(tiles),
+                            "levels": level,
+                            "concurrency": concurrency,
+                        }
+                    else:
+                        create_output_table(
+                            cur,
+                            output_table,
+                            fields,
+                            sql.SQL(
+                                "SELECT {fields},ST_Union(geom) geom FROM {input_table} {filter} GROUP BY {fields}"
+                            ).format(
+                                fields=fields_sql,
+                                input_table=sql.Identifier(input_table),
+                                filter=(
+                                    sql.SQL("WHERE {}").format(
+                                        sql.SQL(" AND ").join(filter_conditions)
+                                    )
+                                    if filter
+                                    else sql.SQL("")
+                                ),
+                            ),
+                            unlogged=use_unlogged_output(additional_config),
+                        )
+                    if cache_key:
+                        store_cached_result(cur, cache_key, "dissolve", output_table)
                 logger.info("Data inserted")
 
+                if preview_run:
+                    return finish_preview(conn, cur, output_table, preview_run)
+
                 # fetch input layer configuration
                 cur.execute(
                     "SELECT geometry_type,bounds FROM vector_tiles WHERE layer_name=%s",
@@ -133,15 +283,30 @@ def dissolve(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        result = {"layer_id": layer_id, "cached": cache_hit}
+        if partition_stats:
+            result["partitions"] = partition_stats
+        result["queries"] = supervisor.get_stats()
+        return result
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
+            if partials_table:
+                try:
+                    drop_table(conn, partials_table)
+                except Exception:
+                    logger.error(traceback.format_exc())
             pool.putconn(conn)
@@ -54,7 +54,7 @@ def download_sentinel(ids: list[str], output: list[str], user_id: str):
                         raise Exception("Asset visual not found")
 
                     logger.info(f"Fetching and tiling {item.id} true color...")
-                    (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom) = (
+                    (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom, _) = (
                         tile_raster_data(
                             bucket,
                             None,
@@ -146,7 +146,7 @@ def download_sentinel(ids: list[str], output: list[str], user_id: str):
                         scaleParams=[[-1, 1, 0, 255]],
                     )
                     logger.info(f"Tiling {item.id} NDVI...")
-                    (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom) = (
+                    (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom, _) = (
                         tile_raster_data(bucket, None, None, file_path=scaled_file_path)
                     )
 
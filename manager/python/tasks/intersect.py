@@ -9,6 +9,26 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import (
+    create_output_table,
+    finalize_output_table,
+    use_unlogged_output,
+)
+from lib.overlay_planner import materialize_step, plan_intersection_order
+from lib.partitioned_overlay import (
+    GridTile,
+    drop_table,
+    run_partitioned_overlay,
+    tile_pair_filter,
+    use_partitioned_overlay,
+)
+from lib.preview import finish_preview, get_preview_config, prepare_preview
+from lib.query_supervision import supervise_queries
+from lib.result_cache import (
+    clone_cached_result,
+    get_result_cache_key,
+    store_cached_result,
+)
 from utils import (
     logger,
     pool,
@@ -21,15 +41,31 @@ def intersect(
     input_table: list[str],
     output_table: str,
     user_id: str,
+    additional_config: dict | None = None,
 ):
     conn = None
+    supervisor = None
+    output_committed = False
+    partition_stats = None
     try:
+        preview_config = get_preview_config(additional_config)
+        if preview_config:
+            # samples are temporary tables, only visible to this connection
+            additional_config = {
+                **additional_config,
+                "partitioned": False,
+                "use_cache": False,
+            }
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
                     cur, "Intersect"
                 )
+                preview_run = None
+                if preview_config:
+                    preview_run = prepare_preview(cur, input_table, preview_config)
 
                 # fetch input layer configuration
                 cur.execute(
@@ -68,177 +104,182 @@ def intersect(
                 table_columns = cur.fetchall()
                 logger.info("Columns fetched")
 
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [
-                        f'"{col_name}_{table_name}" {col_type}'
-                        for table_name, columns in table_columns
-                        for col_name, col_type in columns.items()
-                    ]
-                    + ["geom geometry(Geometry, 4326)"]
-                )
                 output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
-                    )
+
+                # identical runs on unchanged inputs reuse the previous result
+                cache_key = get_result_cache_key(
+                    cur,
+                    "intersect",
+                    {"input_table": input_table},
+                    input_table,
+                    additional_config,
                 )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
+                cache_hit = bool(cache_key) and clone_cached_result(
+                    cur, cache_key, output_table, use_unlogged_output(additional_config)
                 )
-                logger.info("Table created")
+                if not cache_hit:
+                    # insert data
+                    total_input_table = len(input_table)
+                    if total_input_table == 2:
 
-                # insert data
-                total_input_table = len(input_table)
-                if total_input_table == 2:
-                    select_query = sql.SQL(
-                        """ SELECT *
-                            FROM (
-                              SELECT {input_fields},
-                              ST_Multi(
-                                    CASE
-                                    WHEN ST_Covers({table_a}.geom,{table_b}.geom)
-                                    THEN {table_b}.geom
-                                    ELSE ST_CollectionExtract(
-                                        ST_Intersection({table_a}.geom,{table_b}.geom), 
-                                    %s)
-                                    END
-                                ) geom
-                              FROM {table_a}
-                              INNER JOIN {table_b}
-                              ON ST_Intersects({table_a}.geom,{table_b}.geom)
-                            ) intersected
-                            WHERE NOT ST_IsEmpty(geom); """
-                    ).format(
-                        input_fields=sql.SQL(",").join(
-                            sql.Identifier(table_name, col_name)
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
-                        table_a=sql.Identifier(input_table[0]),
-                        table_b=sql.Identifier(input_table[1]),
-                    )
-                else:
-                    # create intersection for first 2 table in cte
-                    table_columns_selected = table_columns[0:2]
-                    cte_queries = [
-                        sql.SQL(
-                            "WITH cte_1 AS (SELECT {input_fields},CASE WHEN ST_Covers({table_a}.geom,{table_b}.geom) THEN {table_b}.geom ELSE ST_Intersection({table_a}.geom,{table_b}.geom) END geom FROM {table_a} INNER JOIN {table_b} ON ST_Intersects({table_a}.geom,{table_b}.geom))"
-                        ).format(
-                            input_fields=sql.SQL(",").join(
-                                sql.SQL("{} {}").format(
-                                    sql.Identifier(table_name, col_name),
-                                    sql.Identifier(f"{col_name}_{table_name}"),
-                                )
-                                for table_name, columns in table_columns_selected
-                                for col_name in columns
-                            ),
-                            table_a=sql.Identifier(input_table[0]),
-                            table_b=sql.Identifier(input_table[1]),
-                        )
-                    ]
+                        def build_select_query(tile: GridTile | None):
+                            return sql.SQL(
+                                """ SELECT *
+                                    FROM (
+                                      SELECT {input_fields},
+                                      ST_Multi(
+                                            CASE
+                                            WHEN ST_Covers({table_a}.geom,{table_b}.geom)
+                                            THEN {table_b}.geom
+                                            ELSE ST_CollectionExtract(
+                                                ST_Intersection({table_a}.geom,{table_b}.geom), 
+                                            %s)
+                                            END
+                                        ) geom
+                                      FROM {table_a}
+                                      INNER JOIN {table_b}
+                                      ON ST_Intersects({table_a}.geom,{table_b}.geom)
+                                      {tile_filter}
+                                    ) intersected
+                                    WHERE NOT ST_IsEmpty(geom) """
+                            ).format(
+                                input_fields=sql.SQL(",").join(
+                                    sql.Identifier(table_name, col_name)
+                                    for table_name, columns in table_columns
+                                    for col_name in columns
+                                ),
+                                table_a=sql.Identifier(input_table[0]),
+                                table_b=sql.Identifier(input_table[1]),
+                                tile_filter=(
+                                    sql.SQL("WHERE {}").format(
+                                        tile_pair_filter(
+                                            tile,
+                                            sql.Identifier(input_table[0], "geom"),
+                                            sql.Identifier(input_table[1], "geom"),
+                                        )
+                                    )
+                                    if tile
+                                    else sql.SQL("")
+                                ),
+                            )
 
-                    # rest of the table
-                    cte_count = 2
-                    final_query = sql.SQL("")
-                    for i, table_column in enumerate(table_columns[2:], 2):
-                        (current_table_name, current_columns) = table_column
-                        if i != total_input_table - 1:
-                            # append to cte query if not last input table
-                            cte_queries.append(
+                        select_query = build_select_query(None)
+                    else:
+                        # intersect in the planned order, every intermediate result is
+                        # materialized so the next join uses its index and statistics
+                        columns_by_table = dict(table_columns)
+                        order = plan_intersection_order(cur, input_table)
+
+                        step_table = order[0]
+                        step_fields = [
+                            sql.SQL("{} {}").format(
+                                sql.Identifier(order[0], col_name),
+                                sql.Identifier(f"{col_name}_{order[0]}"),
+                            )
+                            for col_name in columns_by_table.get(order[0], {})
+                        ]
+                        for step, current_table_name in enumerate(order[1:], 1):
+                            next_step_table = f"tmp_intersect_step_{step}"
+                            materialize_step(
+                                cur,
+                                next_step_table,
                                 sql.SQL(
-                                    "{cte_name} AS (SELECT {input_fields},CASE WHEN ST_Covers({table_a}.geom,{table_b}.geom) THEN {table_b}.geom ELSE ST_Intersection({table_a}.geom,{table_b}.geom) END geom FROM {table_a} INNER JOIN {table_b} ON ST_Intersects({table_a}.geom,{table_b}.geom))"
+                                    "SELECT {input_fields},CASE WHEN ST_Covers({table_a}.geom,{table_b}.geom) THEN {table_b}.geom ELSE ST_Intersection({table_a}.geom,{table_b}.geom) END geom FROM {table_a} INNER JOIN {table_b} ON ST_Intersects({table_a}.geom,{table_b}.geom)"
                                 ).format(
-                                    cte_name=sql.Identifier("cte_" + str(cte_count)),
                                     input_fields=sql.SQL(",").join(
-                                        [
-                                            sql.Identifier(
-                                                "cte_" + str(cte_count - 1),
-                                                f"{col_name}_{table_name_sel}",
-                                            )
-                                            for table_name_sel, columns_sel in table_columns_selected
-                                            for col_name in columns_sel
-                                        ]
+                                        step_fields
                                         + [
                                             sql.SQL("{} {}").format(
-                                                sql.Identifier(
-                                                    current_table_name, col_name
-                                                ),
+                                                sql.Identifier(current_table_name, col_name),
                                                 sql.Identifier(
                                                     f"{col_name}_{current_table_name}"
                                                 ),
                                             )
-                                            for col_name in current_columns
+                                            for col_name in columns_by_table.get(
+                                                current_table_name, {}
+                                            )
                                         ]
                                     ),
                                     table_a=sql.Identifier(current_table_name),
-                                    table_b=sql.Identifier("cte_" + str(cte_count - 1)),
-                                )
-                            )
-                            table_columns_selected.append(table_column)
-                            cte_count += 1
-                        else:
-                            # set last input table as final select query
-                            final_query = sql.SQL(
-                                """ SELECT *
-                                    FROM (
-                                      SELECT {input_fields},ST_Multi(CASE WHEN ST_Covers({table_a}.geom,{table_b}.geom) THEN {table_b}.geom ELSE ST_CollectionExtract(ST_Intersection({table_a}.geom,{table_b}.geom),%s) END) geom
-                                      FROM {table_a}
-                                      INNER JOIN {table_b} ON ST_Intersects({table_a}.geom,{table_b}.geom)
-                                    ) intersected
-                                    WHERE NOT ST_IsEmpty(geom)"""
-                            ).format(
-                                input_fields=sql.SQL(",").join(
-                                    [
-                                        sql.Identifier(
-                                            "cte_" + str(cte_count - 1),
-                                            f"{col_name}_{table_name_sel}",
-                                        )
-                                        for table_name_sel, columns_sel in table_columns_selected
-                                        for col_name in columns_sel
-                                    ]
-                                    + [
-                                        sql.SQL("{} {}").format(
-                                            sql.Identifier(
-                                                current_table_name, col_name
-                                            ),
-                                            sql.Identifier(
-                                                f"{col_name}_{current_table_name}"
-                                            ),
-                                        )
-                                        for col_name in current_columns
-                                    ]
+                                    table_b=sql.Identifier(step_table),
                                 ),
-                                table_a=sql.Identifier(current_table_name),
-                                table_b=sql.Identifier("cte_" + str(cte_count - 1)),
                             )
-                    select_query = sql.SQL("{} {}").format(
-                        sql.SQL(",").join(cte_queries), final_query
-                    )
+                            step_table = next_step_table
+                            step_fields = [
+                                sql.Identifier(step_table, f"{col_name}_{table_name}")
+                                for table_name in order[: step + 1]
+                                for col_name in columns_by_table.get(table_name, {})
+                            ]
 
-                cur.execute(
-                    sql.SQL(
-                        "INSERT INTO {output_table} ({output_fields}, geom) {select_query}"
-                    ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            sql.Identifier(f"{col_name}_{table_name}")
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
-                        select_query=select_query,
-                    ),
-                    [dim],
-                )
+                        select_query = sql.SQL(
+                            """ SELECT *
+                                FROM (
+                                  SELECT {input_fields},ST_Multi(ST_CollectionExtract(geom,%s)) geom
+                                  FROM {step_table}
+                                ) intersected
+                                WHERE NOT ST_IsEmpty(geom)"""
+                        ).format(
+                            input_fields=sql.SQL(",").join(
+                                sql.Identifier(f"{col_name}_{table_name}")
+                                for table_name, columns in table_columns
+                                for col_name in columns
+                            ),
+                            step_table=sql.Identifier(step_table),
+                        )
+
+                    output_columns = [
+                        f"{col_name}_{table_name}"
+                        for table_name, columns in table_columns
+                        for col_name in columns
+                    ]
+                    unlogged = use_unlogged_output(additional_config)
+
+                    def build_insert_query(select_query: sql.Composable):
+                        return sql.SQL(
+                            "INSERT INTO {output_table} ({output_fields}, geom) {select_query}"
+                        ).format(
+                            output_table=output_table_ident,
+                            output_fields=sql.SQL(",").join(
+                                sql.Identifier(column) for column in output_columns
+                            ),
+                            select_query=select_query,
+                        )
+
+                    if total_input_table == 2 and use_partitioned_overlay(
+                        cur, input_table, additional_config
+                    ):
+                        # tile workers insert through their own connections into an
+                        # empty output table, indexed once they are done
+                        create_output_table(
+                            cur,
+                            output_table,
+                            output_columns,
+                            select_query,
+                            [dim],
+                            unlogged,
+                            with_data=False,
+                        )
+                        conn.commit()
+                        output_committed = True
+                        partition_stats = run_partitioned_overlay(
+                            cur,
+                            input_table[0],
+                            lambda tile: build_insert_query(build_select_query(tile)),
+                            additional_config,
+                            [dim],
+                        )
+                        finalize_output_table(cur, output_table, unlogged)
+                    else:
+                        create_output_table(
+                            cur, output_table, output_columns, select_query, [dim], unlogged
+                        )
+                    if cache_key:
+                        store_cached_result(cur, cache_key, "intersect", output_table)
                 logger.info("Data inserted")
 
+                if preview_run:
+                    return finish_preview(conn, cur, output_table, preview_run)
+
                 # get new bounding box
                 cur.execute(
                     sql.SQL(
@@ -278,15 +319,32 @@ def intersect(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        result = {"layer_id": layer_id, "cached": cache_hit}
+        if partition_stats:
+            result["partitions"] = partition_stats
+        result["queries"] = supervisor.get_stats()
+        return result
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if output_committed:
+            # tile queries still running would keep the output table locked
+            supervisor.cancel_running()
+            try:
+                drop_table(conn, output_table)
+            except Exception:
+                logger.error(traceback.format_exc())
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
             pool.putconn(conn)
@@ -9,6 +9,8 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import create_output_table, use_unlogged_output
+from lib.query_supervision import supervise_queries
 from utils import (
     logger,
     pool,
@@ -23,8 +25,10 @@ def merge(
     user_id: str,
 ):
     conn = None
+    supervisor = None
     try:
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
@@ -51,41 +55,22 @@ def merge(
                     output_column_names_types[column_name] = data_type
                     input_table_columns[table_name].append(column_name)
 
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [
-                        f'"{col_name}" {col_type}'
-                        for col_name, col_type in output_column_names_types.items()
-                    ]
-                    + ["geom geometry(Geometry, 4326)"]
-                )
                 output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
-                    )
-                )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
-                )
-                logger.info("Table created")
 
                 # insert data
+                # every branch is cast to the output column type, so the UNION
+                # does not have to match the types of same named columns
                 select_queries: list[sql.Composable] = []
                 for table_name in input_table_columns.keys():
                     select_columns: list[sql.Composable] = []
-                    for col_name in output_column_names_types.keys():
+                    for col_name, col_type in output_column_names_types.items():
                         if col_name in input_table_columns[table_name]:
-                            select_columns.append(sql.Identifier(col_name))
+                            select_column = sql.Identifier(col_name)
                         else:
-                            select_columns.append(sql.Literal(None))
+                            select_column = sql.SQL("NULL")
+                        select_columns.append(
+                            sql.SQL("{}::{}").format(select_column, sql.SQL(col_type))
+                        )
                     select_queries.append(
                         sql.SQL(
                             "SELECT {select_columns},geom FROM {input_table}"
@@ -94,17 +79,12 @@ def merge(
                             input_table=sql.Identifier(table_name),
                         )
                     )
-                cur.execute(
-                    sql.SQL(
-                        "INSERT INTO {output_table} ({output_fields},geom) {select_queries}"
-                    ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            sql.Identifier(col_name)
-                            for col_name in output_column_names_types.keys()
-                        ),
-                        select_queries=sql.SQL(" UNION ALL ").join(select_queries),
-                    )
+                create_output_table(
+                    cur,
+                    output_table,
+                    list(output_column_names_types.keys()),
+                    sql.SQL(" UNION ALL ").join(select_queries),
+                    unlogged=use_unlogged_output(),
                 )
                 logger.info("Data inserted")
 
@@ -155,15 +135,21 @@ def merge(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        return {"layer_id": layer_id, "queries": supervisor.get_stats()}
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
             pool.putconn(conn)
@@ -1,15 +1,20 @@
 import os
-from tempfile import TemporaryDirectory
 import traceback
 
 from dramatiq.middleware import TimeLimitExceeded
 import dramatiq
 
-from lib.tile_raster_data import delete_generated_tiles, tile_raster_data
+from lib.pmtiles import TILE_ARCHIVE_NAME
+from lib.tile_raster_data import (
+    delete_generated_tiles,
+    get_tile_output,
+    tile_raster_data,
+)
 from lib.register_table import (
     register_raster_tile,
 )
-from lib.dem_to_terrain_rgb import dem_to_terrain_rgb
+from lib.terrain_tiles import tile_terrain_data
+from lib.source_cache import get_source_cache_stats
 from utils import pool, logger, init_gdal_config
 
 
@@ -27,38 +32,62 @@ def raster_tiling(
     conn = None
     bucket = os.environ.get("STORAGE_S3_BUCKET")
     layer_id = ""
+    tiling_stats = None
+    source_cache_start = get_source_cache_stats()
     try:
         if not bucket:
             raise Exception("S3 bucket not configured")
         init_gdal_config()
+        tile_output = get_tile_output(additional_config)
 
-        with TemporaryDirectory(prefix="geodashboard_geoprocessing_") as tmpdir:
-            if is_terrain:
-                terrain_rgb_path = dem_to_terrain_rgb(bucket, object_key, tmpdir)
-                (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom) = tile_raster_data(
-                    bucket, minzoom, maxzoom, file_path=terrain_rgb_path
-                )
-            else:
-                (layer_id, xmin, ymin, xmax, ymax, minzoom, maxzoom) = tile_raster_data(
-                    bucket, minzoom, maxzoom, object_key
-                )
-            conn = pool.getconn()
-            register_raster_tile(
-                conn,
+        if is_terrain:
+            # tiles are encoded straight from the DEM, without an
+            # intermediate terrain-RGB raster
+            (
+                layer_id,
+                xmin,
+                ymin,
+                xmax,
+                ymax,
+                minzoom,
+                maxzoom,
+                tiling_stats,
+            ) = tile_terrain_data(bucket, object_key, minzoom, maxzoom, tile_output)
+        else:
+            (
                 layer_id,
-                raster_alias,
                 xmin,
                 ymin,
                 xmax,
                 ymax,
                 minzoom,
                 maxzoom,
-                uploader,
-                is_terrain,
-                None,
-                additional_config,
+                tiling_stats,
+            ) = tile_raster_data(
+                bucket, minzoom, maxzoom, object_key, output=tile_output
             )
-        return {
+        conn = pool.getconn()
+        register_raster_tile(
+            conn,
+            layer_id,
+            raster_alias,
+            xmin,
+            ymin,
+            xmax,
+            ymax,
+            minzoom,
+            maxzoom,
+            uploader,
+            is_terrain,
+            None,
+            additional_config,
+            (
+                f"raster-tiles/{layer_id}/{TILE_ARCHIVE_NAME}"
+                if tile_output == "pmtiles"
+                else None
+            ),
+        )
+        result = {
             "layer_id": layer_id,
             "lon_min": xmin,
             "lat_min": ymin,
@@ -66,7 +95,11 @@ def raster_tiling(
             "lat_max": ymax,
             "z_min": minzoom,
             "z_max": maxzoom,
+            "source_cache": get_source_cache_stats(source_cache_start),
         }
+        if tiling_stats:
+            result["tiles"] = tiling_stats
+        return result
     except (TimeLimitExceeded, Exception) as err:
         del_errs = []
         if layer_id and bucket:
@@ -10,7 +10,9 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import create_output_table, use_unlogged_output
 from lib.parse_filter import parse_filter
+from lib.query_supervision import supervise_queries
 from utils import (
     logger,
     pool,
@@ -27,8 +29,10 @@ def spatial_join(
     filter: list[dict] | None,
 ):
     conn = None
+    supervisor = None
     try:
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
@@ -48,47 +52,20 @@ def spatial_join(
                 table_columns = cur.fetchall()
                 logger.info("Columns fetched")
 
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [
-                        f'"{col_name}_{table_name}" {col_type}'
+                create_output_table(
+                    cur,
+                    output_table,
+                    [
+                        f"{col_name}_{table_name}"
                         for table_name, columns in table_columns
-                        for col_name, col_type in columns.items()
-                    ]
-                    + ["geom geometry(Geometry, 4326)"]
-                )
-                output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
-                    )
-                )
-                cur.execute(
+                        for col_name in columns
+                    ],
                     sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
-                )
-                logger.info("Table created")
-
-                cur.execute(
-                    sql.SQL(
-                        """ INSERT INTO {output_table} ({output_fields},geom)
-                            SELECT {input_fields},{target_table}.geom
+                        """ SELECT {input_fields},{target_table}.geom
                             FROM {target_table}
                             LEFT JOIN {join_table} ON ST_Intersects({target_table}.geom,{join_table}.geom)
                             {filter} """
                     ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            sql.Identifier(f"{col_name}_{table_name}")
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
                         input_fields=sql.SQL(",").join(
                             sql.Identifier(table_name, col_name)
                             for table_name, columns in table_columns
@@ -105,7 +82,8 @@ def spatial_join(
                             if filter
                             else sql.SQL("")
                         ),
-                    )
+                    ),
+                    unlogged=use_unlogged_output(),
                 )
                 logger.info("Data inserted")
 
@@ -149,15 +127,21 @@ def spatial_join(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        return {"layer_id": layer_id, "queries": supervisor.get_stats()}
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
             pool.putconn(conn)
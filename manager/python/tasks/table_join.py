@@ -10,7 +10,9 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import create_output_table, use_unlogged_output
 from lib.parse_filter import parse_filter
+from lib.query_supervision import supervise_queries
 from utils import (
     logger,
     pool,
@@ -29,8 +31,10 @@ def table_join(
     filter: list[dict] | None,
 ):
     conn = None
+    supervisor = None
     try:
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, _) = fetch_geoprocessing_default_values(
@@ -50,50 +54,20 @@ def table_join(
                 table_columns = cur.fetchall()
                 logger.info("Columns fetched")
 
-                # create table with serial fid
-                columns_sql = sql.SQL(",").join(
+                create_output_table(
+                    cur,
+                    output_table,
                     [
-                        sql.SQL("{} {}").format(
-                            sql.Identifier(f"{col_name}_{table_name}"),
-                            sql.SQL(col_type),
-                        )
+                        f"{col_name}_{table_name}"
                         for table_name, columns in table_columns
-                        for col_name, col_type in columns.items()
-                    ]
-                )
-                output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL(
-                        "CREATE TABLE {output_table} (ogc_fid serial PRIMARY KEY,{columns_sql},geom geometry(Geometry, 4326))"
-                    ).format(
-                        output_table=output_table_ident,
-                        columns_sql=columns_sql,
-                    )
-                )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
-                    )
-                )
-                logger.info("Table created")
-
-                cur.execute(
+                        for col_name in columns
+                    ],
                     sql.SQL(
-                        """ INSERT INTO {output_table} ({output_fields},geom)
-                            SELECT {input_fields},{target_table}.geom
+                        """ SELECT {input_fields},{target_table}.geom
                             FROM {target_table}
                             LEFT JOIN {join_table} ON {target_table}.{target_col} = {join_table}.{join_col}
                             {filter} """
                     ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            sql.Identifier(f"{col_name}_{table_name}")
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
                         input_fields=sql.SQL(",").join(
                             sql.Identifier(table_name, col_name)
                             for table_name, columns in table_columns
@@ -112,7 +86,8 @@ def table_join(
                             if filter
                             else sql.SQL("")
                         ),
-                    )
+                    ),
+                    unlogged=use_unlogged_output(),
                 )
                 logger.info("Data inserted")
 
@@ -155,15 +130,21 @@ def table_join(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        return {"layer_id": layer_id, "queries": supervisor.get_stats()}
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
             pool.putconn(conn)
@@ -9,6 +9,16 @@ from lib.clear_directus_cache import clear_directus_cache
 from lib.fetch_geoprocessing_default_values import (
     fetch_geoprocessing_default_values,
 )
+from lib.output_table import create_output_table, use_unlogged_output
+from lib.partitioned_overlay import (
+    GridTile,
+    drop_table,
+    run_partitioned_overlay,
+    tile_envelope,
+    use_partitioned_overlay,
+)
+from lib.preview import finish_preview, get_preview_config, prepare_preview
+from lib.query_supervision import supervise_queries
 from utils import (
     logger,
     pool,
@@ -21,15 +31,31 @@ def union(
     input_table: list[str],
     output_table: str,
     user_id: str,
+    additional_config: dict | None = None,
 ):
     conn = None
+    supervisor = None
+    partition_stats = None
+    faces_table = None
     try:
+        preview_config = get_preview_config(additional_config)
+        if preview_config:
+            # samples are temporary tables, only visible to this connection
+            additional_config = {
+                **additional_config,
+                "partitioned": False,
+                "use_cache": False,
+            }
         conn = pool.getconn()
+        supervisor = supervise_queries(conn)
         with conn:
             with conn.cursor() as cur:
                 (category_id, fill_style) = fetch_geoprocessing_default_values(
                     cur, "Union"
                 )
+                preview_run = None
+                if preview_config:
+                    preview_run = prepare_preview(cur, input_table, preview_config)
 
                 # fetch input table column names and types except geom column
                 cur.execute(
@@ -44,78 +70,150 @@ def union(
                 table_columns = cur.fetchall()
                 logger.info("Columns fetched")
 
-                # create table with serial fid
-                columns_sql = ", ".join(
-                    ["ogc_fid serial PRIMARY KEY"]
-                    + [
-                        f'"{col_name}_{table_name}" {col_type}'
-                        for table_name, columns in table_columns
-                        for col_name, col_type in columns.items()
-                    ]
-                    + ["geom geometry(Geometry, 4326)"]
-                )
                 output_table_ident = sql.Identifier(output_table)
-                cur.execute(
-                    sql.SQL("CREATE TABLE {output_table} ({columns_sql})").format(
-                        output_table=output_table_ident,
-                        columns_sql=sql.SQL(columns_sql),
-                    )
+
+                # insert data
+                select_fields = sql.SQL(",").join(
+                    sql.Identifier(table_name, col_name)
+                    for table_name, columns in table_columns
+                    for col_name in columns
                 )
-                cur.execute(
-                    sql.SQL(
-                        "CREATE INDEX IF NOT EXISTS {idx_name} ON {output_table} USING gist (geom)"
-                    ).format(
-                        idx_name=sql.Identifier(f"{output_table}_geom_geom_idx"),
-                        output_table=output_table_ident,
+                output_columns = [
+                    f"{col_name}_{table_name}"
+                    for table_name, columns in table_columns
+                    for col_name in columns
+                ]
+                joins_query = sql.SQL(" ").join(
+                    sql.SQL("LEFT JOIN {table} ON ST_Covers({table}.geom,r.pos)").format(
+                        table=sql.Identifier(table_name)
                     )
+                    for table_name, _ in table_columns
+                )
+                where_query = sql.SQL(" OR ").join(
+                    sql.SQL("{}.ogc_fid IS NOT NULL").format(sql.Identifier(table_name))
+                    for table_name, _ in table_columns
                 )
-                logger.info("Table created")
+                if use_partitioned_overlay(cur, input_table, additional_config):
+                    # faces of every tile, keyed by the covering input features
+                    faces_table = f"tmp_union_faces_{uuid4().hex}"
+                    fid_fields = [
+                        sql.Identifier(f"fid_{i}") for i in range(len(table_columns))
+                    ]
+                    cur.execute(
+                        sql.SQL(
+                            "CREATE UNLOGGED TABLE {faces_table} ({fid_columns}, on_border boolean, geom geometry(Polygon, 4326))"
+                        ).format(
+                            faces_table=sql.Identifier(faces_table),
+                            fid_columns=sql.SQL(",").join(
+                                sql.SQL("{} bigint").format(fid_field)
+                                for fid_field in fid_fields
+                            ),
+                        )
+                    )
 
-                # insert data
-                cur.execute(
-                    sql.SQL(
-                        """ INSERT INTO {output_table} ({output_fields}, geom)
-                            WITH lines AS ({boundary_query}),
-                            noded_lines AS (SELECT ST_Union(geom) geom FROM lines),
-                            resultants AS (SELECT geom,ST_PointOnSurface(geom) pos FROM ST_Dump((SELECT ST_Polygonize(geom) geom FROM noded_lines)))
-                            SELECT {select_fields},ST_Multi(r.geom)
-                            FROM resultants r
-                            {joins_query}
-                            WHERE {where_query} """
-                    ).format(
-                        output_table=output_table_ident,
-                        output_fields=sql.SQL(",").join(
-                            sql.Identifier(f"{col_name}_{table_name}")
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
-                        boundary_query=sql.SQL(" UNION ALL ").join(
-                            sql.SQL("SELECT ST_Boundary(geom) AS geom FROM {}").format(
-                                sql.Identifier(table_name)
-                            )
-                            for table_name, _ in table_columns
-                        ),
-                        select_fields=sql.SQL(",").join(
-                            sql.Identifier(table_name, col_name)
-                            for table_name, columns in table_columns
-                            for col_name in columns
-                        ),
-                        joins_query=sql.SQL(" ").join(
-                            sql.SQL(
-                                "LEFT JOIN {table} ON ST_Covers({table}.geom,r.pos)"
-                            ).format(table=sql.Identifier(table_name))
-                            for table_name, _ in table_columns
+                    def build_tile_query(tile: GridTile):
+                        # boundaries are clipped to the tile and closed with the
+                        # tile outline, so only the tile linework is noded at once
+                        envelope = tile_envelope(tile)
+                        return sql.SQL(
+                            """ INSERT INTO {faces_table} ({fid_fields}, on_border, geom)
+                                WITH lines AS ({boundary_query} UNION ALL SELECT ST_Boundary({envelope})),
+                                noded_lines AS (SELECT ST_Union(geom) geom FROM lines),
+                                resultants AS (SELECT geom,ST_PointOnSurface(geom) pos FROM ST_Dump((SELECT ST_Polygonize(geom) geom FROM noded_lines)))
+                                SELECT {fid_select},ST_Intersects(r.geom,ST_Boundary({envelope})),r.geom
+                                FROM resultants r
+                                {joins_query}
+                                WHERE {where_query} """
+                        ).format(
+                            faces_table=sql.Identifier(faces_table),
+                            fid_fields=sql.SQL(",").join(fid_fields),
+                            boundary_query=sql.SQL(" UNION ALL ").join(
+                                sql.SQL(
+                                    "SELECT ST_CollectionExtract(ST_Intersection(ST_Boundary(geom),{envelope}),2) AS geom FROM {table} WHERE geom && {envelope}"
+                                ).format(
+                                    table=sql.Identifier(table_name), envelope=envelope
+                                )
+                                for table_name, _ in table_columns
+                            ),
+                            envelope=envelope,
+                            fid_select=sql.SQL(",").join(
+                                sql.Identifier(table_name, "ogc_fid")
+                                for table_name, _ in table_columns
+                            ),
+                            joins_query=joins_query,
+                            where_query=where_query,
+                        )
+
+                    # tile workers insert through their own connections
+                    conn.commit()
+                    partition_stats = run_partitioned_overlay(
+                        cur, input_table, build_tile_query, additional_config
+                    )
+
+                    # faces cut by tile edges are merged back with their
+                    # neighbours, which are covered by the same input features
+                    create_output_table(
+                        cur,
+                        output_table,
+                        output_columns,
+                        sql.SQL(
+                            """ WITH faces AS (
+                                  SELECT {fid_fields},geom FROM {faces_table} WHERE NOT on_border
+                                  UNION ALL
+                                  SELECT {fid_fields},(ST_Dump(ST_Union(geom))).geom FROM {faces_table} WHERE on_border GROUP BY {fid_fields}
+                                )
+                                SELECT {select_fields},ST_Multi(f.geom)
+                                FROM faces f
+                                {fid_joins_query} """
+                        ).format(
+                            fid_fields=sql.SQL(",").join(fid_fields),
+                            faces_table=sql.Identifier(faces_table),
+                            select_fields=select_fields,
+                            fid_joins_query=sql.SQL(" ").join(
+                                sql.SQL(
+                                    "LEFT JOIN {table} ON {table}.ogc_fid=f.{fid_field}"
+                                ).format(
+                                    table=sql.Identifier(table_name),
+                                    fid_field=fid_field,
+                                )
+                                for (table_name, _), fid_field in zip(
+                                    table_columns, fid_fields
+                                )
+                            ),
                         ),
-                        where_query=sql.SQL(" OR ").join(
-                            sql.SQL("{}.ogc_fid IS NOT NULL").format(
-                                sql.Identifier(table_name)
-                            )
-                            for table_name, _ in table_columns
+                        unlogged=use_unlogged_output(additional_config),
+                    )
+                else:
+                    create_output_table(
+                        cur,
+                        output_table,
+                        output_columns,
+                        sql.SQL(
+                            """ WITH lines AS ({boundary_query}),
+                                noded_lines AS (SELECT ST_Union(geom) geom FROM lines),
+                                resultants AS (SELECT geom,ST_PointOnSurface(geom) pos FROM ST_Dump((SELECT ST_Polygonize(geom) geom FROM noded_lines)))
+                                SELECT {select_fields},ST_Multi(r.geom)
+                                FROM resultants r
+                                {joins_query}
+                                WHERE {where_query} """
+                        ).format(
+                            boundary_query=sql.SQL(" UNION ALL ").join(
+                                sql.SQL(
+                                    "SELECT ST_Boundary(geom) AS geom FROM {}"
+                                ).format(sql.Identifier(table_name))
+                                for table_name, _ in table_columns
+                            ),
+                            select_fields=select_fields,
+                            joins_query=joins_query,
+                            where_query=where_query,
                         ),
+                        unlogged=use_unlogged_output(additional_config),
                     )
-                )
                 logger.info("Data inserted")
 
+                if preview_run:
+                    return finish_preview(conn, cur, output_table, preview_run)
+
                 # get new bounding box
                 cur.execute(
                     sql.SQL(
@@ -155,15 +253,30 @@ def union(
         if not is_dev_mode():
             clear_directus_cache()
 
-        return {"layer_id": layer_id}
+        result = {"layer_id": layer_id}
+        if partition_stats:
+            result["partitions"] = partition_stats
+        result["queries"] = supervisor.get_stats()
+        return result
     except (TimeLimitExceeded, Exception) as err:
         error_traceback = traceback.format_exc()
-        if isinstance(err, TimeLimitExceeded):
+        if isinstance(err, TimeLimitExceeded) or (supervisor and supervisor.timed_out):
             error_message = "Time limit exceeded. File might be too big to process."
         else:
             error_message = str(err)
             logger.error(error_traceback)
-        return {"error": error_message, "traceback": error_traceback}
+        result = {"error": error_message, "traceback": error_traceback}
+        if supervisor:
+            result["queries"] = supervisor.get_stats()
+        return result
     finally:
         if conn:
+            if supervisor:
+                # cancels tile queries still running after an interruption
+                supervisor.stop()
+            if faces_table:
+                try:
+                    drop_table(conn, faces_table)
+                except Exception:
+                    logger.error(traceback.format_exc())
             pool.putconn(conn)
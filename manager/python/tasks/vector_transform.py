@@ -1,18 +1,35 @@
 import os
 import shutil
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import dramatiq
 from dramatiq.middleware import TimeLimitExceeded
-from lib.create_table import create_table_from_header_info
-from lib.fill_table import fill_table_with_layer_feature
+from lib.create_table import (
+    create_table_from_header_info,
+    index_and_analyze_table,
+    track_table_version,
+)
+from lib.fill_table import (
+    ARROW_UNSUPPORTED_FIELD_TYPES,
+    get_coord_transform,
+    get_layer_loader,
+    get_pushdown_srid,
+    transform_table_geometry,
+)
 from lib.get_header_info import get_gdal_dataset, get_header_info_from_data_layer
-from lib.kml_style_parser import process_layer_style
+from lib.kml_style_parser import process_layer_styles
+from lib.partitioned_load import load_layer_partitioned
+from lib.source_cache import get_source_cache_stats
 from lib.register_table import (
     register_table_to_directus,
 )
 from osgeo import gdal, ogr
+from psycopg2 import sql
 from utils import (
+    cap_pool_concurrency,
     generate_local_temp_dir_path,
     generate_vrt_path,
     init_gdal_config,
@@ -23,6 +40,214 @@ from utils import (
 )
 
 
+def drop_table(conn, table_name: str):
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table_name))
+            )
+
+
+def ingest_layer(
+    conn,
+    dataset_args: tuple,
+    layer: ogr.Layer,
+    layer_index: int,
+    table_name: str,
+    uploader: str,
+    additional_config: dict | None,
+    kml_storage_path: str | None,
+    layer_concurrency: int = 1,
+    cancelled: threading.Event | None = None,
+):
+    load_config = additional_config or {}
+    load_method = load_config.get("load_method", "copy")
+    srs_string = load_config.get("source_srs", None)
+    # build spatial index and table statistics only after the bulk load
+    deferred_index = load_config.get("deferred_index", True)
+    # very large layers are split into feature ranges loaded by separate processes,
+    # the budget is for the whole actor and shared by the layers loaded at once
+    partition_count = int(
+        load_config.get(
+            "partitions", os.environ.get("VECTOR_LAYER_PARTITIONS", os.cpu_count())
+        )
+    ) // max(1, layer_concurrency)
+    partition_min_features = int(
+        load_config.get("partition_min_features", 1000000)
+    )
+
+    layer_header_info = get_header_info_from_data_layer(layer)
+    # let PostGIS reproject the whole table after load unless disabled
+    source_srid = (
+        get_pushdown_srid(conn, layer_header_info, srs_string)
+        if load_config.get("transform", "auto") == "auto"
+        else None
+    )
+    if (
+        load_method == "arrow"
+        and source_srid is None
+        and get_coord_transform(layer_header_info, srs_string)[1]
+    ):
+        # arrow batches can only be reprojected by PostGIS
+        logger.info("Source SRS is not an EPSG code, falling back to copy")
+        load_method = "copy"
+    if load_method == "arrow" and any(
+        field["type"] in ARROW_UNSUPPORTED_FIELD_TYPES
+        for field in layer_header_info["fields"]
+    ):
+        logger.info("Layer has time zone aware fields, falling back to copy")
+        load_method = "copy"
+    # arrow batches keep source dimensions, so they go into an unconstrained column
+    # that is forced to 2D and reprojected after load
+    table_srid = None if load_method == "arrow" else source_srid or 4326
+    timings = {}
+    phase_start = time.perf_counter()
+    create_table_from_header_info(
+        conn,
+        layer_header_info,
+        table_name,
+        not deferred_index,
+        table_srid,
+    )
+    timings["create"] = round(time.perf_counter() - phase_start, 3)
+
+    phase_start = time.perf_counter()
+    if (
+        partition_count > 1
+        and layer_header_info["num_features"] >= partition_min_features
+    ):
+        try:
+            load_stats, partition_count = load_layer_partitioned(
+                dataset_args,
+                layer,
+                layer_index,
+                table_name,
+                layer_header_info,
+                load_method,
+                srs_string,
+                source_srid,
+                partition_count,
+            )
+        except BaseException:
+            # rows committed by the other partitions must not be left behind, also
+            # when the actor hits its time limit
+            drop_table(conn, table_name)
+            raise
+    else:
+        partition_count = 1
+        load_stats = get_layer_loader(load_method)(
+            layer, layer_header_info, conn, table_name, srs_string, source_srid
+        )
+    row_count = load_stats["rows"]
+    load_seconds = time.perf_counter() - phase_start
+    timings["load"] = round(load_seconds, 3)
+
+    if source_srid or load_method == "arrow":
+        phase_start = time.perf_counter()
+        transform_table_geometry(
+            conn, table_name, source_srid, load_method == "arrow"
+        )
+        timings["transform"] = round(time.perf_counter() - phase_start, 3)
+
+    if deferred_index:
+        timings.update(
+            index_and_analyze_table(
+                conn,
+                table_name,
+                load_config.get("index_workers", None),
+                load_config.get("cluster", False),
+            )
+        )
+
+    geometry_types = load_stats["geometry_types"]
+    styleable_types = {
+        name: count
+        for name, count in geometry_types.items()
+        if name.endswith(("POINT", "LINESTRING", "POLYGON"))
+    }
+    if layer.GetGeomType() == ogr.wkbUnknown and styleable_types:
+        # generic geometry layers are registered with their most common type
+        layer_header_info["geom_name"] = max(
+            styleable_types, key=styleable_types.get
+        )
+
+    # KML styles are resolved for the geometry type the layer is registered with,
+    # so the style id lands in the matching style column
+    layer_style_id = None
+    if kml_storage_path:
+        phase_start = time.perf_counter()
+        layer_style_id = process_layer_styles(
+            kml_storage_path,
+            [(layer.GetName(), layer_header_info["geom_name"])],
+            conn,
+        )[layer.GetName()]
+        timings["style"] = round(time.perf_counter() - phase_start, 3)
+
+    if cancelled is not None and cancelled.is_set():
+        # the actor already returned its result, the layer must not show up
+        drop_table(conn, table_name)
+        raise Exception(f"Ingestion of {table_name} was cancelled")
+
+    with conn:
+        with conn.cursor() as cur:
+            track_table_version(cur, table_name)
+
+    phase_start = time.perf_counter()
+    register_table_to_directus(
+        conn,
+        table_name,
+        layer_header_info,
+        uploader,
+        additional_config,
+        not is_dev_mode(),
+        layer_style_id,
+        load_stats["bounds"],
+    )
+    timings["register"] = round(time.perf_counter() - phase_start, 3)
+
+    return {
+        "method": load_method,
+        "partitions": partition_count,
+        "rows": row_count,
+        "geometry_types": geometry_types,
+        "rows_per_second": (
+            round(row_count / load_seconds, 1) if load_seconds else None
+        ),
+        "timings": timings,
+    }
+
+
+def ingest_layer_with_own_dataset(
+    dataset_args: tuple,
+    layer_index: int,
+    table_name: str,
+    uploader: str,
+    additional_config: dict | None,
+    kml_storage_path: str | None,
+    layer_concurrency: int,
+    cancelled: threading.Event,
+):
+    # GDAL datasets and database connections must not be shared between threads
+    dataset = get_gdal_dataset(*dataset_args)
+    layer = dataset.GetLayerByIndex(layer_index)
+    conn = pool.getconn()
+    try:
+        return ingest_layer(
+            conn,
+            dataset_args,
+            layer,
+            layer_index,
+            table_name,
+            uploader,
+            additional_config,
+            kml_storage_path,
+            layer_concurrency,
+            cancelled,
+        )
+    finally:
+        pool.putconn(conn)
+
+
 @dramatiq.actor(store_results=True)
 def vector_transform(
     object_key: str,
@@ -34,60 +259,50 @@ def vector_transform(
     **kwargs,
 ):
     conn = None
+    executor = None
+    # set once the actor returns, layers still running are not registered
+    cancelled = threading.Event()
+    source_cache_start = get_source_cache_stats()
     try:
         init_gdal_config()
         bucket = os.environ.get("STORAGE_S3_BUCKET")
         if not bucket:
             raise Exception("S3 bucket not configured")
         table_name = table_name or os.path.splitext(os.path.basename(object_key))[0]
-        dataset = get_gdal_dataset(
-            format_file, bucket, object_key, is_zipped, table_name
-        )
+        dataset_args = (format_file, bucket, object_key, is_zipped, table_name)
+        dataset = get_gdal_dataset(*dataset_args)
+
+        # fail early on unexpected load method before any table is created
+        load_config = additional_config or {}
+        get_layer_loader(load_config.get("load_method", "copy"))
 
         layer_count = dataset.GetLayerCount()
         is_single_layer = layer_count == 1
-        conn = pool.getconn()
-        processed_tables = []
-        errors = []
+        layer_jobs = []
         for i in range(layer_count):
 
             layer = dataset.GetLayerByIndex(i)
             layer_name = layer.GetName()
-            geom_type: int = layer.GetGeomType()
-            temp_geom = ogr.Geometry(geom_type or 3)
-            geom_name = temp_geom.GetGeometryName()
-            layer_style_id = process_layer_style(object_key, layer_name, geom_name) if format_file == 'kml' else {}
-
             if layer_name == "layer_styles":
                 continue
+
             final_table_name = (
                 table_name
                 if is_single_layer
                 else sanitize_table_name(table_name + "_" + layer_name)
             )
+            layer_jobs.append((i, final_table_name))
+
+        # styles are registered per layer once its geometry type is known
+        kml_storage_path = object_key if format_file == "kml" else None
+
+        processed_tables = []
+        load_stats = {}
+        errors = []
+
+        def collect_layer_result(final_table_name: str, run_ingestion):
             try:
-                layer_header_info = get_header_info_from_data_layer(layer)
-                create_table_from_header_info(conn, layer_header_info, final_table_name)
-                fill_table_with_layer_feature(
-                    layer,
-                    layer_header_info,
-                    conn,
-                    final_table_name,
-                    (
-                        None
-                        if additional_config is None
-                        else additional_config.get("source_srs", None)
-                    ),
-                )
-                register_table_to_directus(
-                    conn,
-                    final_table_name,
-                    layer_header_info,
-                    uploader,
-                    additional_config,
-                    not is_dev_mode(),
-                    layer_style_id
-                )
+                load_stats[final_table_name] = run_ingestion()
                 processed_tables.append(final_table_name)
             except Exception as err:
                 error_traceback = traceback.format_exc()
@@ -99,7 +314,65 @@ def vector_transform(
                     }
                 )
                 logger.error(error_traceback)
-        result = {"processed": processed_tables}
+
+        # independent layers can be ingested concurrently, each with its own
+        # dataset handle and pooled connection
+        layer_concurrency = min(
+            cap_pool_concurrency(
+                int(
+                    load_config.get(
+                        "layer_concurrency",
+                        os.environ.get("VECTOR_LAYER_CONCURRENCY", 4),
+                    )
+                )
+            ),
+            len(layer_jobs),
+        )
+        if layer_concurrency > 1:
+            logger.info(f"Ingesting {len(layer_jobs)} layers concurrently")
+            executor = ThreadPoolExecutor(max_workers=layer_concurrency)
+            futures = [
+                (
+                    final_table_name,
+                    executor.submit(
+                        ingest_layer_with_own_dataset,
+                        dataset_args,
+                        i,
+                        final_table_name,
+                        uploader,
+                        additional_config,
+                        kml_storage_path,
+                        layer_concurrency,
+                        cancelled,
+                    ),
+                )
+                for i, final_table_name in layer_jobs
+            ]
+            for final_table_name, future in futures:
+                collect_layer_result(final_table_name, future.result)
+        else:
+            conn = pool.getconn()
+            for i, final_table_name in layer_jobs:
+                layer = dataset.GetLayerByIndex(i)
+                collect_layer_result(
+                    final_table_name,
+                    lambda: ingest_layer(
+                        conn,
+                        dataset_args,
+                        layer,
+                        i,
+                        final_table_name,
+                        uploader,
+                        additional_config,
+                        kml_storage_path,
+                    ),
+                )
+
+        result = {
+            "processed": processed_tables,
+            "load_stats": load_stats,
+            "source_cache": get_source_cache_stats(source_cache_start),
+        }
         if len(errors):
             result["error"] = errors
         return result
@@ -113,6 +386,9 @@ def vector_transform(
         return {"error": error_message, "traceback": error_traceback}
     finally:
         # cleanup
+        if executor:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
         if conn:
             pool.putconn(conn)
         temp_dir_path = generate_local_temp_dir_path(object_key)
@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from lib.dem_to_terrain_rgb import encode_terrain_rgb
+
+
+def decode_terrain_rgb(rgb: np.ndarray) -> np.ndarray:
+    r, g, b = rgb.astype(np.int64)
+    return -10000 + (r * 256 * 256 + g * 256 + b) * 0.1
+
+
+def test_encode_terrain_rgb_round_trip():
+    elevations = np.array([[-10000.0, -432.1], [0.0, 8848.86]])
+    rgb = encode_terrain_rgb(elevations)
+    assert rgb.shape == (3, 2, 2)
+    assert rgb.dtype == np.uint8
+    np.testing.assert_allclose(
+        decode_terrain_rgb(rgb), [[-10000, -432.1], [0, 8848.9]], atol=1e-6
+    )
+
+
+def test_encode_terrain_rgb_integers():
+    elevations = np.array([[0, 1, 255, 65535]], dtype=np.uint16)
+    np.testing.assert_allclose(
+        decode_terrain_rgb(encode_terrain_rgb(elevations)), elevations, atol=1e-6
+    )
+    # 0 m is 100000 in tenths of meters above -10000 m
+    assert encode_terrain_rgb(np.zeros((1, 1), np.int16))[:, 0, 0].tolist() == [
+        1,
+        134,
+        160,
+    ]
+
+
+def test_encode_terrain_rgb_clamps_out_of_range():
+    rgb = encode_terrain_rgb(np.array([[-20000.0, 2e6]]))
+    assert rgb[:, 0, 0].tolist() == [0, 0, 0]
+    assert rgb[:, 0, 1].tolist() == [255, 255, 255]
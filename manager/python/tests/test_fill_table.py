@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("osgeo")
+
+from lib.fill_table import (
+    decode_arrow_value,
+    escape_copy_text,
+    format_copy_value,
+    wkb_to_hex_ewkb,
+)
+
+
+def test_escape_copy_text():
+    assert escape_copy_text("plain") == "plain"
+    assert escape_copy_text("a\tb\nc\rd") == "a\\tb\\nc\\rd"
+    # backslashes first, so escapes are not escaped twice
+    assert escape_copy_text("C:\\dir\t") == "C:\\\\dir\\t"
+
+
+def test_format_copy_value_scalars():
+    assert format_copy_value(None) == "\\N"
+    assert format_copy_value(True) == "1"
+    assert format_copy_value(False) == "0"
+    assert format_copy_value(42) == "42"
+    assert format_copy_value(1.5) == "1.5"
+    assert format_copy_value("line\nbreak") == "line\\nbreak"
+    # a literal \N string is not taken as NULL
+    assert format_copy_value("\\N") == "\\\\N"
+
+
+def test_format_copy_value_bytes():
+    assert format_copy_value(b"\x00\xff") == "\\\\x00ff"
+
+
+def test_format_copy_value_arrays():
+    assert format_copy_value([1, 2, None]) == "{1,2,NULL}"
+    assert format_copy_value(["a b", 'say "hi"']) == '{"a b","say \\\\"hi\\\\""}'
+    assert format_copy_value(["tab\there"]) == '{"tab\\there"}'
+
+
+def test_decode_arrow_value():
+    assert decode_arrow_value("ñ".encode(), "String") == "ñ"
+    assert decode_arrow_value([b"a", None], "StringList") == ["a", None]
+    # only Binary fields are copied as bytea
+    assert decode_arrow_value(b"\x00\xff", "Binary") == b"\x00\xff"
+    assert decode_arrow_value(None, "String") is None
+    assert format_copy_value(decode_arrow_value(b"text", "String")) == "text"
+
+
+def test_wkb_to_hex_ewkb():
+    # POINT (1 2), little endian ISO WKB
+    wkb = bytes.fromhex("0101000000000000000000f03f0000000000000040")
+    assert wkb_to_hex_ewkb(wkb, 4326) == (
+        "0101000020e6100000000000000000f03f0000000000000040"
+    )
+    # big endian input keeps its byte order
+    wkb = bytes.fromhex("00000000013ff00000000000004000000000000000")
+    assert wkb_to_hex_ewkb(wkb, 4326) == (
+        "0020000001000010e63ff00000000000004000000000000000"
+    )
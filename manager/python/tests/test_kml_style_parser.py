@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("osgeo")
+pytest.importorskip("psycopg2")
+
+from lib.kml_style_parser import hex_color, opacity_from_kml, parse_kml_placemark_paints
+
+KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2">
+  <Document>
+    <StyleMap id="highlightable">
+      <Pair><key>normal</key><styleUrl>#red</styleUrl></Pair>
+      <Pair><key>highlight</key><styleUrl>#blue</styleUrl></Pair>
+    </StyleMap>
+    <Placemark>
+      <styleUrl>#highlightable</styleUrl>
+      <Polygon><outerBoundaryIs><LinearRing><coordinates>0,0 1,0 1,1 0,0</coordinates></LinearRing></outerBoundaryIs></Polygon>
+    </Placemark>
+    <Placemark>
+      <Style><LineStyle><color>ff0000ff</color><width>2</width></LineStyle></Style>
+      <LineString><coordinates>0,0 1,1</coordinates></LineString>
+    </Placemark>
+    <Placemark>
+      <Style><LineStyle><color>ff0000ff</color><width>2</width></LineStyle></Style>
+      <LineString><coordinates>1,1 2,2</coordinates></LineString>
+    </Placemark>
+    <Placemark>
+      <Point><coordinates>0,0</coordinates></Point>
+    </Placemark>
+    <Placemark>
+      <styleUrl>#blue</styleUrl>
+      <Polygon><outerBoundaryIs><LinearRing><coordinates>0,0 2,0 2,2 0,0</coordinates></LinearRing></outerBoundaryIs></Polygon>
+    </Placemark>
+    <Style id="red"><PolyStyle><color>800000ff</color><fill>1</fill></PolyStyle></Style>
+    <Style id="blue"><PolyStyle><color>ffff0000</color><fill>0</fill></PolyStyle></Style>
+  </Document>
+</kml>
+"""
+
+
+def test_parse_kml_placemark_paints(tmp_path):
+    kml_path = tmp_path / "styles.kml"
+    kml_path.write_text(KML)
+    paints = parse_kml_placemark_paints(str(kml_path))
+
+    assert len(paints) == 5
+    # style maps resolve to their normal style, defined after the placemark
+    assert paints[0] == {"fill": {"fill-color": "#ff0000", "fill-opacity": 0.5}}
+    line = {"line": {"line-color": "#ff0000", "line-opacity": 1.0, "line-width": 2.0}}
+    assert paints[1] == line
+    # identical inline styles share a single paint
+    assert paints[2] is paints[1]
+    assert paints[3] is None
+    assert paints[4] == {"fill": {"fill-color": "#0000ff", "fill-opacity": 0.0}}
+
+
+def test_kml_colors():
+    # KML colors are aabbggrr
+    assert hex_color("7f00ff00") == "#00ff00"
+    assert opacity_from_kml("7f00ff00") == 0.5
+    assert hex_color("red") == "#000000"
+    assert opacity_from_kml("") == 1.0
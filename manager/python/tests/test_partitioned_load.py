@@ -0,0 +1,37 @@
+import pytest
+
+pytest.importorskip("osgeo")
+
+from osgeo import gdal, ogr
+
+from lib.partitioned_load import get_layer_partitions, iterate_layer_range
+
+
+def create_layer(fids: list[int]) -> tuple[gdal.Dataset, ogr.Layer]:
+    dataset = gdal.GetDriverByName("MEM").Create("", 0, 0, 0, gdal.GDT_Unknown)
+    layer = dataset.CreateLayer("points", geom_type=ogr.wkbPoint)
+    for fid in fids:
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetFID(fid)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(f"POINT ({fid} 0)"))
+        layer.CreateFeature(feature)
+    return dataset, layer
+
+
+def test_index_partitions_cover_every_feature():
+    dataset, layer = create_layer(list(range(10)))
+    partitions = get_layer_partitions(layer, 10, 3)
+    assert partitions == [("index", 0, 4), ("index", 4, 4), ("index", 8, 4)]
+
+    fids = []
+    for _, start, count in partitions:
+        fids += [
+            feature.GetFID() for feature in iterate_layer_range(layer, start, count)
+        ]
+    assert fids == list(range(10))
+
+
+def test_fid_partitions_have_open_outer_bounds():
+    dataset, layer = create_layer(list(range(10, 20)))
+    partitions = get_layer_partitions(layer, 10, 3, allow_index_ranges=False)
+    assert partitions == [("fid", None, 14), ("fid", 14, 18), ("fid", 18, None)]
@@ -0,0 +1,177 @@
+import gzip
+import random
+import struct
+
+import pytest
+
+from lib import pmtiles
+from lib.pmtiles import (
+    Entry,
+    PMTilesWriter,
+    merge_tile_runs,
+    serialize_directory,
+    write_varint,
+    zxy_to_tile_id,
+)
+
+
+def read_varint(buffer: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def deserialize_directory(data: bytes) -> list[Entry]:
+    buffer = gzip.decompress(data)
+    count, position = read_varint(buffer, 0)
+    tile_ids = []
+    tile_id = 0
+    for _ in range(count):
+        delta, position = read_varint(buffer, position)
+        tile_id += delta
+        tile_ids.append(tile_id)
+    columns = []
+    for _ in range(2):
+        column = []
+        for _ in range(count):
+            value, position = read_varint(buffer, position)
+            column.append(value)
+        columns.append(column)
+    run_lengths, lengths = columns
+    entries = []
+    for i in range(count):
+        offset, position = read_varint(buffer, position)
+        if offset == 0 and i > 0:
+            offset = entries[-1].offset + entries[-1].length
+        else:
+            offset -= 1
+        entries.append(Entry(tile_ids[i], offset, lengths[i], run_lengths[i]))
+    return entries
+
+
+def read_tiles(archive: bytes) -> dict[int, bytes]:
+    header = struct.unpack("<7sB11Q6B4iB2i", archive[:127])
+    root_offset, root_length, _, _, leaves_offset, _, data_offset = header[2:9]
+    tiles = {}
+    directories = [archive[root_offset : root_offset + root_length]]
+    while directories:
+        for entry in deserialize_directory(directories.pop()):
+            if entry.run_length:
+                start = data_offset + entry.offset
+                for tile_id in range(entry.tile_id, entry.tile_id + entry.run_length):
+                    tiles[tile_id] = archive[start : start + entry.length]
+            else:
+                start = leaves_offset + entry.offset
+                directories.append(archive[start : start + entry.length])
+    return tiles
+
+
+def test_zxy_to_tile_id():
+    assert zxy_to_tile_id(0, 0, 0) == 0
+    # Hilbert curve order of zoom 1
+    assert [zxy_to_tile_id(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [
+        1,
+        2,
+        3,
+        4,
+    ]
+    assert zxy_to_tile_id(2, 0, 0) == 5
+    # every tile of a zoom level gets its own id, right after the lower levels
+    for z in range(1, 6):
+        tile_ids = {zxy_to_tile_id(z, x, y) for x in range(2**z) for y in range(2**z)}
+        first_id = (4**z - 1) // 3
+        assert tile_ids == set(range(first_id, first_id + 4**z))
+
+
+def test_write_varint():
+    for value, expected in [(0, b"\x00"), (127, b"\x7f"), (128, b"\x80\x01")]:
+        buffer = bytearray()
+        write_varint(buffer, value)
+        assert bytes(buffer) == expected
+    buffer = bytearray()
+    write_varint(buffer, 2**40)
+    assert read_varint(bytes(buffer), 0) == (2**40, len(buffer))
+
+
+def test_serialize_directory_round_trip():
+    entries = [
+        Entry(0, 0, 10, 1),
+        Entry(1, 10, 5, 3),
+        # not right after the previous entry
+        Entry(7, 100, 8, 1),
+        Entry(2**35, 0, 10, 1),
+    ]
+    assert deserialize_directory(serialize_directory(entries)) == entries
+
+
+def test_merge_tile_runs():
+    entries = [
+        Entry(1, 0, 5, 1),
+        Entry(2, 0, 5, 1),
+        Entry(3, 0, 5, 1),
+        Entry(4, 5, 5, 1),
+        # same data, not consecutive
+        Entry(6, 5, 5, 1),
+    ]
+    assert list(merge_tile_runs(entries)) == [
+        Entry(1, 0, 5, 3),
+        Entry(4, 5, 5, 1),
+        Entry(6, 5, 5, 1),
+    ]
+
+
+@pytest.mark.parametrize("max_zoom", [2, 8])
+def test_writer_round_trip(tmp_path, monkeypatch, max_zoom):
+    # sorted in several runs, and duplicates evicted from the dedup map
+    monkeypatch.setattr(pmtiles, "SORT_RUN_ENTRIES", 1000)
+    monkeypatch.setattr(pmtiles, "DEDUP_MAX_TILES", 16)
+
+    tiles = {}
+    for z in range(max_zoom + 1):
+        for x in range(2**z):
+            for y in range(2**z):
+                if (x + y) % 3:
+                    tiles[(z, x, y)] = b"blank"
+                else:
+                    tiles[(z, x, y)] = f"{z}/{x}/{y}".encode()
+    order = list(tiles)
+    random.Random(0).shuffle(order)
+
+    path = tmp_path / "tiles.pmtiles"
+    writer = PMTilesWriter(str(path))
+    for z, x, y in order:
+        writer.add_tile(z, x, y, tiles[(z, x, y)])
+    stats = writer.close({"format": "png"})
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["tiles.pmtiles"]
+    assert stats["tiles"] == len(tiles)
+    assert stats["unique_tiles"] + stats["duplicate_tiles"] == len(tiles)
+    assert stats["directory_entries"] < len(tiles)
+    assert (stats["leaf_directories"] > 0) == (max_zoom == 8)
+
+    archive = path.read_bytes()
+    assert stats["bytes"] == len(archive)
+    header = struct.unpack("<7sB11Q6B4iB2i", archive[:127])
+    assert header[0:2] == (b"PMTiles", 3)
+    assert header[10:13] == (
+        len(tiles),
+        stats["directory_entries"],
+        stats["unique_tiles"],
+    )
+    assert header[17:19] == (0, max_zoom)
+    assert read_tiles(archive) == {
+        zxy_to_tile_id(z, x, y): data for (z, x, y), data in tiles.items()
+    }
+
+
+def test_writer_without_tiles(tmp_path):
+    writer = PMTilesWriter(str(tmp_path / "tiles.pmtiles"))
+    with pytest.raises(Exception, match="does not have any tile"):
+        writer.close()
+    assert list(tmp_path.iterdir()) == []
@@ -6,8 +6,10 @@ import dramatiq.results
 import logging
 import os
 import psycopg2.pool
+import threading
 
 from dotenv import load_dotenv
+from dramatiq.middleware import CurrentMessage
 from minio import Minio
 from osgeo import gdal
 from urllib.parse import urlparse
@@ -16,12 +18,55 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
-pool = psycopg2.pool.ThreadedConnectionPool(
-    1, 8, dsn=os.environ.get("DB_CONNECTION_STRING")
+
+class BlockingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    """
+    Threaded pool waiting for a connection to be put back once all of them are
+    in use, instead of raising PoolError right away. It still raises after the
+    timeout, so threads holding a connection while waiting for another one
+    cannot wait on each other forever.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.timeout = timeout
+        self.semaphore = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        if not self.semaphore.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(
+                f"No connection put back to the pool within {self.timeout}s"
+            )
+        try:
+            return super().getconn(key)
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        super().putconn(conn, key, close)
+        self.semaphore.release()
+
+
+# room for the concurrent tile and layer connections of an actor on top of the
+# actor and broker connections
+pool = BlockingConnectionPool(
+    1,
+    int(
+        os.environ.get(
+            "DB_POOL_MAX_CONNECTIONS",
+            4 + int(os.environ.get("GEOPROCESSING_CONCURRENCY", 4)),
+        )
+    ),
+    float(os.environ.get("DB_POOL_TIMEOUT", 300)),
+    dsn=os.environ.get("DB_CONNECTION_STRING"),
 )
-dramatiq.set_broker(
-    dramatiq_pg.PostgresBroker(pool=pool, schema="public", table="geoprocessing_queue")
+broker = dramatiq_pg.PostgresBroker(
+    pool=pool, schema="public", table="geoprocessing_queue"
 )
+# lets long running actors report progress on their own queue message
+broker.add_middleware(CurrentMessage())
+dramatiq.set_broker(broker)
 
 urlparsed_s3_endpoint = urlparse(os.environ.get("STORAGE_S3_ENDPOINT", ""))
 s3_endpoint = (
@@ -57,6 +102,14 @@ def init_gdal_config():
     gdal.SetConfigOption("PG_USE_COPY", "YES")
 
 
+def cap_pool_concurrency(concurrency: int, reserved: int = 2) -> int:
+    """
+    Caps the number of threads each holding a pooled connection, so they fit in
+    the pool next to the connections of the actor and the broker.
+    """
+    return max(1, min(concurrency, pool.maxconn - reserved))
+
+
 def is_dev_mode():
     dev_mode = os.getenv(
         "DEV_MODE", "false"